@@ -1,102 +1,91 @@
 from . import models
-from django.db.models import F
 from django.contrib import admin
-from datetime import date, timedelta
 from django.dispatch import receiver
-from django.db.models.signals import post_save, pre_save
-from .utils import get_cashcall, calc_amount_due_membership, calc_amount_due_investment
+from .balances import BalanceChanges, bill_state
+from .cache import invalidate
+from django.db.models.signals import post_delete, post_save, pre_save
+from .cashcalls import assign_cashcalls
+from .utils import bill_deactivations, bill_new_members, bill_reactivations, first_instalments
 
 # Model registration
 admin.site.register(models.Investor)
 admin.site.register(models.Investment)
 admin.site.register(models.CashCall)
 admin.site.register(models.Bill)
+admin.site.register(models.BillingJob)
+admin.site.register(models.BillingRun)
+admin.site.register(models.MonthlySpend)
+admin.site.register(models.AgingSnapshot)
 
-# Create a dummy membership bill on Investor creation
+# Create a dummy membership bill on Investor creation, as onboard_investors does in bulk
 @receiver(post_save, sender=models.Investor)
-def bill_membership(sender, instance, created, **kwargs):
-    if created:
-        membership_cashcall = models.CashCall(
-            sent = True,
-            investor = instance,
-            sent_date = date.today(),
-            due_date = date.today() + timedelta(days=62),
-        )
-        membership_bill = models.Bill(
-            frequency = "Y1", 
-            bill_type = "MEMBERSHIP",
-            amount = 0,
-            investor = instance,
-            validated = True,
-            ignore = True,
-            fulfilled = True,
-            cashcall = membership_cashcall,
-        )
-        membership_cashcall.save()
-        membership_bill.save()
+def bill_membership(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        bill_new_members([instance])
 
-# Create a bill for Investment first instalment once Investment created
+# Create a bill for Investment first instalment once Investment created, as onboard_investments does in bulk
 @receiver(post_save, sender=models.Investment)
-def bill_investment(sender, instance, created, **kwargs):
-    if created:
-        to_pay, to_waive = calc_amount_due_investment(instance, 1)
-        investment_cashcall = get_cashcall(instance.investor, False)
-        investment_bill = models.Bill(
-            frequency = "Y1",
-            bill_type = "INVESTMENT",
-            amount = to_pay,
-            investor = instance.investor,
-            cashcall = investment_cashcall,
-            instalment_no = 1,
-            investment = instance,
-        )
-        investment_bill.save()
-        instance.amount_waived = to_waive
+def bill_investment(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        bills = first_instalments([instance])
+        assign_cashcalls(bills)
+        models.Bill.objects.bulk_create(bills)
         instance.save()
+        # Read back the balances the bills moved, which the response gives
+        instance.refresh_from_db(fields=instance.balance_fields)
 
 # Bill membership fee on active toggle. 0 EUR if reactivated, {days/yr_days * membership_fee} EUR if deactivated
 @receiver(pre_save, sender=models.Investor)
-def bill_membership_active_toggle(sender, instance, *args, **kwargs):
-    if instance.id: # Ensure the Investor already exists
-        investor_old = models.Investor.objects.get(pk=instance.id)
-        if investor_old.active_member==True and instance.active_member==False:
-            # deactivation of account
-            last_membership_bill = models.Bill.objects.filter(bill_type="MEMBERSHIP", investor=instance).order_by("-date").first()
-            pro_rata_days = (date.today() - last_membership_bill.date).days
-            membership_cashcall = get_cashcall(instance, False)
-            membership_bill = models.Bill(
-                frequency = "Y1",
-                bill_type = "MEMBERSHIP",
-                amount = calc_amount_due_membership(investor=instance, pro_rata_days=pro_rata_days),
-                investor = instance,
-                cashcall = membership_cashcall,
-            )
-            membership_bill.save()
-        elif investor_old.active_member==False and instance.active_member==True:
-            # reactivation of account
-            membership_cashcall = models.CashCall(
-                sent = True,
-                investor = instance,
-                sent_date = date.today(),
-                due_date = date.today() + timedelta(days=62),
-            )
-            membership_bill = models.Bill(
-                frequency = "Y1",
-                bill_type = "MEMBERSHIP",
-                amount = 0,
-                investor = instance,
-                validated = True,
-                ignore = True,
-                fulfilled = True,
-                cashcall = membership_cashcall,
-            )
-            membership_cashcall.save()
-            membership_bill.save()
+def bill_membership_active_toggle(sender, instance, raw=False, **kwargs):
+    if raw or not instance.id: # Ensure the Investor already exists, fixtures are loaded as is
+        return
+    investor_old = instance.loaded() or models.Investor.objects.filter(pk=instance.id).only("active_member").first()
+    if investor_old is None:
+        return
+    if investor_old.active_member==True and instance.active_member==False:
+        # deactivation of account
+        bill_deactivations([instance])
+    elif investor_old.active_member==False and instance.active_member==True:
+        # reactivation of account
+        bill_reactivations([instance])
 
 # Ensure that amount is set to 0 EUR when bill is set to ignored/not valid
 @receiver(pre_save, sender=models.Bill)
-def bill_membership_active_toggle(sender, instance, *args, **kwargs):
+def bill_ignore_toggle(sender, instance, raw=False, **kwargs):
+    instance._balance_state = None
+    if raw: # balances are recomputed once fixtures are loaded
+        return
     if instance.id: # Ensure the Bill already exists
-        bill_old = models.Bill.objects.get(pk=instance.id)
-        if bill_old.ignore==False and instance.ignore==True:
+        # Compared with the bill as loaded, read back only for bills not loaded from the database
+        bill_old = instance.loaded() or models.Bill.objects.filter(pk=instance.id).first()
+        if bill_old and bill_old.ignore==False and instance.ignore==True:
             instance.amount = 0
+        instance._balance_state = bill_state(bill_old)
+
+# Keep cashcall and investment balances in step with their bills, and drop the investor's cached responses
+# on every save, whatever fields it changes
+@receiver(post_save, sender=models.Bill)
+def bill_balances_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    changes = BalanceChanges()
+    changes.change(instance._balance_state, bill_state(instance))
+    changes.investors.add(instance.investor_id)
+    changes.save()
+
+@receiver(post_delete, sender=models.Bill)
+def bill_balances_deleted(sender, instance, **kwargs):
+    changes = BalanceChanges()
+    changes.change(bill_state(instance), None)
+    changes.investors.add(instance.investor_id)
+    changes.save()
+
+# Drop the cached responses of the investor whose rows changed, bill changes are dropped with their balances
+@receiver([post_save, post_delete], sender=models.Investor)
+def investor_changed(sender, instance, **kwargs):
+    invalidate([instance.pk])
+
+@receiver([post_save, post_delete], sender=models.Investment)
+@receiver([post_save, post_delete], sender=models.CashCall)
+def investor_rows_changed(sender, instance, **kwargs):
+    invalidate([instance.investor_id])
@@ -0,0 +1,126 @@
+from datetime import date, timedelta
+from django.db import transaction
+from django.db.models import F, FloatField, IntegerField, Q, Sum, Value
+from django.db.models.expressions import CombinedExpression
+from django.db.models.functions import Cast, Coalesce, Round
+from .fees import from_cents
+from .models import AgingSnapshot, CashCall, money_sum
+
+# Days past due (the day the report is as of less the due date) of each bucket, both inclusive, open ended when None
+BUCKETS = {
+    "current": (None, -1), # not due yet
+    "days_0_30": (0, 30),
+    "days_31_60": (31, 60),
+    "days_61_90": (61, 90),
+    "days_over_90": (91, None),
+}
+
+
+def bucket_filter(as_of: date, low, high):
+    """
+    Q on the due date of cashcalls between low and high days past due on as_of.
+    """
+    condition = Q()
+    if low is not None:
+        condition &= Q(due_date__lte=as_of - timedelta(days=low))
+    if high is not None:
+        condition &= Q(due_date__gte=as_of - timedelta(days=high))
+    return condition
+
+
+def cents_sum(expression, **kwargs):
+    """
+    Sum of a money expression with a FloatField output in whole cents, 0 when no rows match.
+    Typed as floats, as SQLite stores decimals, the sum is computed without the casts Django wraps decimal arithmetic in,
+    and ints are read back far quicker than decimals.
+    """
+    return Coalesce(Cast(Sum(Round(expression * Value(100)), **kwargs), IntegerField()), 0)
+
+
+def bucket_sums(as_of: date):
+    """
+    Aggregates of what is left to pay on cashcalls in each bucket on as_of, in cents.
+    Bills are paid in full or not at all, so what is left to pay on a cashcall is its materialized billed_total less paid_total,
+    and buckets are summed over cashcalls (read from cashcall_owing_idx alone) without reading their bills.
+    """
+    left = CombinedExpression(F("billed_total"), "-", F("paid_total"), output_field=FloatField())
+    return {name: cents_sum(left, filter=bucket_filter(as_of, low, high)) for name, (low, high) in BUCKETS.items()}
+
+
+def owing(investors=None):
+    cashcalls = CashCall.objects.owing()
+    if investors is not None:
+        cashcalls = cashcalls.filter(investor__in=investors)
+    return cashcalls
+
+
+def aging_rows(as_of=None, investors=None, after=None):
+    """
+    The grouped query behind aging(): (investor id, *bucket sums in cents) of each investor owing on sent cashcalls,
+    in investor id order from after (exclusive), so a page of them is read off the index as far as needed.
+    """
+    cashcalls = owing(investors)
+    if after is not None:
+        cashcalls = cashcalls.filter(investor__gt=after)
+    sums = bucket_sums(as_of or date.today())
+    return cashcalls.values("investor").annotate(**sums).values_list("investor", *BUCKETS).order_by("investor")
+
+
+def in_euros(cents):
+    """
+    {*BUCKETS, "total"} in EUR of bucket sums in cents.
+    """
+    return dict(zip([*BUCKETS, "total"], map(from_cents, [*cents, sum(cents)])))
+
+
+def aging(as_of=None, investors=None, after=None, limit=None):
+    """
+    What each investor (of all or of a queryset of them) owes on sent cashcalls, by how long past due on as_of (today by default).
+    Returns [{"investor_id", *BUCKETS, "total"}] in EUR, ordered by investor id, limit of them after investor id after if given.
+    """
+    rows = aging_rows(as_of, investors, after)
+    if limit is not None:
+        rows = rows[:limit]
+    return [{"investor_id": investor_id, **in_euros(cents)} for investor_id, *cents in rows]
+
+
+def aging_total(as_of=None, investors=None):
+    """
+    The buckets of aging() summed over all investors (or a queryset of them), in a single aggregate query.
+    """
+    sums = owing(investors).aggregate(**bucket_sums(as_of or date.today()))
+    return in_euros([sums[name] for name in BUCKETS])
+
+
+def take_snapshot(as_of=None):
+    """
+    Stores the aging of every investor on as_of (today by default), and its total, as AgingSnapshot rows,
+    replacing any taken that day. Returns how many investors owed.
+    """
+    as_of = as_of or date.today()
+    report = [*aging(as_of), {"investor_id": None, **aging_total(as_of)}]
+    with transaction.atomic():
+        AgingSnapshot.objects.filter(day=as_of).delete()
+        AgingSnapshot.objects.bulk_create(
+            (AgingSnapshot(day=as_of, investor_id=row["investor_id"], **{name: row[name] for name in BUCKETS}) for row in report),
+            batch_size=1000,
+        )
+    return len(report) - 1
+
+
+def history(date_from=None, date_to=None, investors=None):
+    """
+    Aging on each day snapshots were taken, of all investors (their total rows) or summed over a queryset of them.
+    Returns [{"day", *BUCKETS, "total"}] ordered by day.
+    """
+    snapshots = AgingSnapshot.objects.all()
+    if date_from:
+        snapshots = snapshots.filter(day__gte=date_from)
+    if date_to:
+        snapshots = snapshots.filter(day__lte=date_to)
+    if investors is None:
+        snapshots = snapshots.filter(investor__isnull=True)
+    else:
+        snapshots = snapshots.filter(investor__in=investors)
+    rows = snapshots.values("day").annotate(**{name: money_sum(name) for name in BUCKETS}).order_by("day")
+    return [{**row, "total": sum(row[name] for name in BUCKETS)} for row in rows]
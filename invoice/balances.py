@@ -0,0 +1,228 @@
+from collections import Counter, defaultdict
+from decimal import Decimal
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, Greatest, TruncMonth
+from .cache import invalidate
+from .models import CashCall, Investment, MonthlySpend, Bill, money_sum
+
+# Bill columns the cashcall and investment balances and monthly spends are derived from, in bill_state() order
+BALANCE_FIELDS = ("amount", "fulfilled", "validated", "cashcall_id", "investment_id", "instalment_no", "investor_id", "date")
+CENT = Decimal("0.01")
+
+
+def bill_state(bill: Bill):
+    """
+    The balance fields of a bill as a tuple, None for no bill.
+    The amount is rounded to the cent as it is saved, unsaved bills may hold the unrounded result of a fee calculation.
+    """
+    if bill is None:
+        return None
+    amount, *state = (getattr(bill, field) for field in BALANCE_FIELDS)
+    return (Decimal(amount or 0).quantize(CENT), *state)
+
+
+class BalanceChanges:
+    """
+    Accumulates what bill changes add to or take off cashcall and investment balances,
+    then applies it all with a few set-based updates on save().
+    """
+    chunk_size = 250
+
+    def __init__(self):
+        self.cashcalls = defaultdict(Counter)
+        self.investments = defaultdict(Counter)
+        self.last_instalments = {} # investment id -> highest instalment no. added
+        self.stale_instalments = set() # investments whose last instalment must be looked up again
+        self.investors = set() # whose cached responses are dropped
+        self.spends = Counter() # (investor id, first day of month) -> fulfilled amount
+
+    @classmethod
+    def from_bills(cls, bills):
+        changes = cls()
+        for bill in bills:
+            changes.change(None, bill_state(bill))
+        return changes
+
+    @classmethod
+    def chunks(cls, items):
+        for start in range(0, len(items), cls.chunk_size):
+            yield items[start:start+cls.chunk_size]
+
+    def add(self, state, sign: int, instalment=True):
+        amount, fulfilled, validated, cashcall_id, investment_id, instalment_no, investor_id, day = state
+        amount = amount or 0 # unsaved instances may still hold a 0 EUR int
+        self.investors.add(investor_id)
+        if fulfilled:
+            self.spends[(investor_id, day.replace(day=1))] += sign * amount
+        cashcall = self.cashcalls[cashcall_id]
+        cashcall["billed_total"] += sign * amount
+        cashcall["paid_total"] += sign * amount * fulfilled
+        cashcall["bill_count"] += sign
+        cashcall["validated_count"] += sign * validated
+        if investment_id is None:
+            return
+        investment = self.investments[investment_id]
+        investment["billed_total"] += sign * amount
+        investment["paid_total"] += sign * amount * fulfilled
+        if instalment and instalment_no is not None:
+            if sign > 0:
+                self.last_instalments[investment_id] = max(instalment_no, self.last_instalments.get(investment_id, instalment_no))
+            else:
+                self.stale_instalments.add(investment_id)
+
+    def change(self, before, after):
+        """
+        Records a bill going from the before state to the after state (None when created or deleted).
+        """
+        if before == after:
+            return
+        # The last instalment can only move if the bill's instalment does
+        instalment = not (before and after and before[4:6] == after[4:6])
+        if before:
+            self.add(before, -1, instalment)
+        if after:
+            self.add(after, 1, instalment)
+
+    def save(self):
+        with transaction.atomic():
+            self.bump(CashCall, self.cashcalls)
+            self.bump(Investment, self.investments)
+            raised = {pk: no for pk, no in self.last_instalments.items() if pk not in self.stale_instalments}
+            for chunk in self.chunks(sorted(raised.items())):
+                Investment.objects.filter(pk__in=[pk for pk, _ in chunk]).update(last_instalment_no=Greatest(
+                    F("last_instalment_no"), pk_case(Investment, "last_instalment_no", chunk, default=connection.ops.quote_name("last_instalment_no")),
+                ))
+            if self.stale_instalments:
+                recompute_balances(investments=Investment.objects.filter(pk__in=self.stale_instalments))
+            self.save_spends()
+            if self.investors:
+                invalidate(self.investors)
+
+    def save_spends(self):
+        """
+        Adds the spend deltas to the existing MonthlySpend rows, and creates the missing ones for spends added.
+        Spends taken off only update existing rows, so bills deleted with their investor
+        (after its MonthlySpend rows, or with them) never bring rows back for it.
+        """
+        spends = {key: delta for key, delta in self.spends.items() if delta}
+        rows = {}
+        for chunk in self.chunks(sorted(spends)):
+            months = MonthlySpend.objects.filter(investor__in={investor_id for investor_id, _ in chunk}, month__in={month for _, month in chunk})
+            rows.update({(investor_id, month): pk for pk, investor_id, month in months.values_list("pk", "investor_id", "month")})
+        self.bump(MonthlySpend, {rows[key]: {"fulfilled_amount": delta} for key, delta in spends.items() if key in rows})
+        MonthlySpend.objects.bulk_create([
+            MonthlySpend(investor_id=investor_id, month=month, fulfilled_amount=delta)
+            for (investor_id, month), delta in sorted(spends.items()) if (investor_id, month) not in rows and delta > 0
+        ])
+
+    @classmethod
+    def bump(cls, model, deltas: dict):
+        """
+        Adds deltas ({pk: {field: delta}}) to the rows of model, one UPDATE per chunk of rows.
+        """
+        deltas = {pk: {field: delta for field, delta in delta.items() if delta} for pk, delta in deltas.items()}
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+        for chunk in cls.chunks(sorted(deltas.items())):
+            fields = {field for _, delta in chunk for field in delta}
+            model.objects.filter(pk__in=[pk for pk, _ in chunk]).update(**{
+                field: F(field) + pk_case(model, field, [(pk, delta[field]) for pk, delta in chunk if field in delta])
+                for field in fields
+            })
+
+
+def pk_case(model, field: str, values: list, default="0"):
+    """
+    CASE on the pk of model giving the values ([(pk, value)]) of field, default (SQL) for other rows.
+    Written as SQL, as building it from When() expressions takes longer than running it once there are thousands of rows.
+    """
+    output_field = model._meta.get_field(field)
+    then = "CAST(%s AS NUMERIC)" if isinstance(output_field, models.DecimalField) else "%s"
+    return RawSQL(
+        f"CASE {connection.ops.quote_name(model._meta.pk.column)} {' '.join([f'WHEN %s THEN {then}'] * len(values))} ELSE {default} END",
+        [param for pk_value in values for param in pk_value],
+        output_field=output_field,
+    )
+
+
+def bill_totals(group_by: str, **totals):
+    """
+    Correlated subqueries of bill aggregates for the row whose pk the bills' group_by field points to.
+    """
+    bills = Bill.objects.filter(**{group_by: OuterRef("pk")}).order_by().values(group_by)
+    return {field: Subquery(bills.annotate(total=aggregate).values("total")) for field, aggregate in totals.items()}
+
+
+def recompute_balances(cashcalls=None, investments=None):
+    """
+    Recomputes the balances of cashcalls and investments (all of both by default) from the bill table.
+    Recomputing them all drops every cached response.
+    """
+    if cashcalls is None and investments is None:
+        cashcalls, investments = CashCall.objects.all(), Investment.objects.all()
+        invalidate(everything=True)
+    with transaction.atomic():
+        if cashcalls is not None:
+            totals = bill_totals("cashcall",
+                billed_total = money_sum("amount"),
+                paid_total = money_sum("amount", filter=Q(fulfilled=True)),
+                bill_count = Count("pk"),
+                validated_count = Count("pk", filter=Q(validated=True)),
+            )
+            cashcalls.update(**{field: Coalesce(total, 0, output_field=CashCall._meta.get_field(field)) for field, total in totals.items()})
+        if investments is not None:
+            totals = bill_totals("investment",
+                billed_total = money_sum("amount"),
+                paid_total = money_sum("amount", filter=Q(fulfilled=True)),
+                last_instalment_no = Coalesce(Max("instalment_no"), 0),
+            )
+            investments.update(**{field: Coalesce(total, 0, output_field=Investment._meta.get_field(field)) for field, total in totals.items()})
+
+
+def monthly_spends(bills=None):
+    """
+    Fulfilled amounts of bills (all by default) grouped by investor and month.
+    """
+    bills = Bill.objects.all() if bills is None else bills
+    return bills.filter(fulfilled=True).annotate(month=TruncMonth("date")).order_by().values("investor", "month").annotate(spent=money_sum("amount"))
+
+
+def recompute_spends(investors=None):
+    """
+    Rebuilds the MonthlySpend rows of investors (a queryset, all by default) from the bill table.
+    """
+    spends = MonthlySpend.objects.all()
+    bills = Bill.objects.all()
+    if investors is not None:
+        spends, bills = spends.filter(investor__in=investors), bills.filter(investor__in=investors)
+    with transaction.atomic():
+        spends.delete()
+        MonthlySpend.objects.bulk_create(
+            MonthlySpend(investor_id=row["investor"], month=row["month"], fulfilled_amount=row["spent"])
+            for row in monthly_spends(bills).iterator() if row["spent"]
+        )
+        invalidate(everything=True)
+
+
+def check_balances():
+    """
+    Compares the materialized balances and monthly spends with the bill table.
+    Returns (model name, pk, field, stored value, actual value) for each mismatch, pk being (investor id, month) for monthly spends.
+    """
+    checks = [
+        (CashCall.objects.with_totals(), {"billed_total": "billed_sum", "paid_total": "paid_sum", "bill_count": "bill_num", "validated_count": "validated_num"}),
+        (Investment.objects.with_totals(), {"billed_total": "billed_sum", "paid_total": "paid_sum", "last_instalment_no": "instalment_max"}),
+    ]
+    mismatches = []
+    for queryset, fields in checks:
+        for row in queryset.values("pk", *fields.keys(), *fields.values()).iterator():
+            for stored, actual in fields.items():
+                if row[stored] != row[actual]:
+                    mismatches.append((queryset.model.__name__, row["pk"], stored, row[stored], row[actual]))
+    stored = {(investor_id, month): amount for investor_id, month, amount in MonthlySpend.objects.values_list("investor", "month", "fulfilled_amount").iterator()}
+    actual = {(row["investor"], row["month"]): row["spent"] for row in monthly_spends().iterator()}
+    for investor_id, month in sorted(stored.keys() | actual.keys()):
+        if stored.get((investor_id, month), 0) != actual.get((investor_id, month), 0):
+            mismatches.append((MonthlySpend.__name__, (investor_id, month), "fulfilled_amount", stored.get((investor_id, month), 0), actual.get((investor_id, month), 0)))
+    return mismatches
@@ -0,0 +1,114 @@
+import platform
+import statistics
+import time
+from datetime import date, timedelta
+import django
+from django.db import connection, transaction
+from django.test import Client
+from .fees import investment_fees_cents, to_cents
+from .metrics import record_queries
+from .models import Investment, Investor
+from .portfolio import seed_portfolio
+from .utils import calc_amount_due_investment, calc_amount_due_membership, yearly_spends
+
+SCALES = (100, 1000)
+
+# Time differences under this are noise, never reported as regressions however large the ratio
+NOISE_MS = 1.0
+
+
+def list_endpoint(url):
+    return lambda client: client.get(url)
+
+
+def billing_action(url):
+    return lambda client: client.post(url, {"all": 1})
+
+
+def membership_fees(client):
+    spent = yearly_spends(Investor.objects.all(), date.today(), 1)
+    return [calc_amount_due_membership(investor, spent=spent.get(investor.pk, 0)) for investor in Investor.objects.all()]
+
+
+def investment_fees(client):
+    return [calc_amount_due_investment(investment, 2, investment.amount_not_billed) for investment in Investment.objects.all()]
+
+
+def investment_fees_batch(client):
+    investments = list(Investment.objects.all())
+    not_billed = [to_cents(investment.amount_not_billed) for investment in investments]
+    return investment_fees_cents(investments, [2] * len(investments), not_billed)
+
+
+# Run in this order on each repeat, the billing actions each working on what the one before left
+CASES = [
+    ("GET investor list", list_endpoint("/invoice/investor/")),
+    ("GET investment list", list_endpoint("/invoice/investment/")),
+    ("GET cashcall list", list_endpoint("/invoice/cashcall/")),
+    ("GET cashcall list cached", list_endpoint("/invoice/cashcall/")),
+    ("GET bill list", list_endpoint("/invoice/bill/")),
+    ("GET bill list fast", list_endpoint("/invoice/bill/?format=fast")),
+    ("GET aging report", list_endpoint("/invoice/reports/aging")),
+    ("fees membership", membership_fees),
+    ("fees investment", investment_fees),
+    ("fees investment batch", investment_fees_batch),
+    ("POST generate all", billing_action("/invoice/generate")),
+    ("POST validate all", billing_action("/invoice/validate")),
+    ("POST send all", billing_action("/invoice/send")),
+]
+
+
+def benchmark(scales=SCALES, years=3, repeat=3, seed=0):
+    """
+    Times each case against a portfolio of each scale (no. of investors), seeded as of a year ago so a year of bills is due.
+    Everything runs in a transaction rolled back at the end, and each repeat in a savepoint rolled back after it,
+    so repeats do the same work. Returns {scale: {case: timings}}, with the queries of the first repeat.
+    """
+    client = Client()
+    results = {}
+    for scale in scales:
+        with transaction.atomic():
+            seed_portfolio(scale, years, seed=seed, today=date.today() - timedelta(days=365))
+            timings = {name: [] for name, _ in CASES}
+            queries = {}
+            for _ in range(repeat):
+                savepoint = transaction.savepoint()
+                for name, case in CASES:
+                    start = time.perf_counter()
+                    with record_queries() as recorder:
+                        case(client)
+                    timings[name].append((time.perf_counter() - start) * 1000)
+                    queries.setdefault(name, recorder.count)
+                transaction.savepoint_rollback(savepoint)
+            transaction.set_rollback(True)
+        results[str(scale)] = {
+            name: {"median_ms": round(statistics.median(ms), 3), "min_ms": round(min(ms), 3), "queries": queries[name]}
+            for name, ms in timings.items()
+        }
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": f"{connection.vendor} {connection.Database.sqlite_version if connection.vendor == 'sqlite' else ''}".strip(),
+        "machine": platform.machine(),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float = 0.2):
+    """
+    Cases of results (as returned by benchmark) whose median is over (1 + threshold) times that of baseline,
+    by more than NOISE_MS. Returns (scale, case, baseline ms, ms) for each, cases missing from either are skipped.
+    """
+    regressions = []
+    for scale, cases in results.items():
+        for name, timings in cases.items():
+            before = baseline.get(scale, {}).get(name)
+            if before is None:
+                continue
+            ms, before_ms = timings["median_ms"], before["median_ms"]
+            if ms > before_ms * (1 + threshold) and ms - before_ms > NOISE_MS:
+                regressions.append((scale, name, before_ms, ms))
+    return regressions
@@ -0,0 +1,323 @@
+import time
+from bisect import bisect_right
+from uuid import uuid4
+from decimal import Decimal
+from datetime import date, timedelta
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import islice
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max, Min, OuterRef, Q, Subquery
+from django.db.models.functions import Mod
+from django.utils import timezone
+from .cache import invalidate
+from .cashcalls import CashCallIndex
+from .dates import next_year, shift_years, year_ago
+from .balances import CENT, BalanceChanges
+from .models import BillingRun, Investment, Investor, InvestorLock, Bill, money_sum
+from .utils import calc_amount_due_investment, calc_amount_due_membership, yearly_spends
+
+# How long to wait for investors billed by another run, and when a lock is deemed left behind by a dead run
+LOCK_TIMEOUT = timedelta(minutes=5)
+STALE_LOCK = timedelta(hours=1)
+
+# Bills written per transaction by generate_bills, a bill per subscription unless catching up
+BATCH_SIZE = 1000
+
+# Bill subscriptions are keyed on these Bill fields
+SUBSCRIPTION_KEYS = {
+    "MEMBERSHIP": ("investor",),
+    "INVESTMENT": ("investor", "investment"),
+}
+
+
+def last_bills(bill_type: str, date_lower_limit: date, investors=None):
+    """
+    Returns the most recent Y1 bill of each subscription of bill_type dated after date_lower_limit, in a single grouped query.
+    Rows hold the subscription keys, last_date and last_instalment, and are ordered by the subscription's oldest bill,
+    which is the order the bills used to be walked in.
+    """
+    keys = SUBSCRIPTION_KEYS[bill_type]
+    bills = Bill.objects.filter(bill_type=bill_type, frequency="Y1", date__gt=date_lower_limit)
+    subscription_bills = bills.filter(**{key: OuterRef(key) for key in keys})
+    if investors is not None:
+        bills = bills.filter(investor__in=investors)
+    return bills.values(*keys).annotate(
+        first_date = Min("date"),
+        first_id = Subquery(subscription_bills.order_by("date", "id").values("id")[:1]),
+        last_date = Max("date"),
+        last_instalment = Subquery(subscription_bills.order_by("-date", "-id").values("instalment_no")[:1]),
+    ).order_by("first_date", "first_id")
+
+
+class InvestorsLocked(Exception):
+    pass
+
+
+@contextmanager
+def lock_investors(investors, timeout: timedelta = None, holder: str = None):
+    """
+    Holds a lock on a queryset of investors, so concurrent runs never bill nor create cashcalls for the same investor.
+    InvestorLock rows are committed for them and deleted after, on every database, so the lock spans the run
+    without a transaction around it, and each batch the run writes commits on its own.
+    Locks left by a dead run of the same holder (a job run again, see jobs.reclaim()) are taken over.
+    Raises InvestorsLocked if some investor is still locked by another run after timeout (LOCK_TIMEOUT by default).
+    """
+    holder = holder or uuid4().hex
+    ids = list(investors.values_list("pk", flat=True))
+    deadline = time.monotonic() + (LOCK_TIMEOUT if timeout is None else timeout).total_seconds()
+    while True:
+        try:
+            with transaction.atomic():
+                InvestorLock.objects.filter(Q(acquired__lt=timezone.now() - STALE_LOCK) | Q(holder=holder)).delete()
+                InvestorLock.objects.bulk_create([InvestorLock(investor_id=pk, holder=holder) for pk in ids])
+            break
+        except IntegrityError:
+            if time.monotonic() > deadline:
+                raise InvestorsLocked("Investors are being billed by another run")
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        InvestorLock.objects.filter(holder=holder).delete()
+
+
+def shard(investors, shards: int, index: int):
+    """
+    The investors whose id falls in shard index of shards.
+    """
+    return investors.alias(shard=Mod("id", shards)).filter(shard=index)
+
+
+def generate_shard(shards: int, index: int, dry_run=False, years_back=2, as_of=None):
+    """
+    generate_bills() over one shard of all investors, run by the generate_bills command in worker processes.
+    """
+    try:
+        return generate_bills(investors=shard(Investor.objects.all(), shards, index), dry_run=dry_run, years_back=years_back, as_of=as_of)
+    finally:
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def billing_key(bill_type: str, row: dict, bill_date: date):
+    """
+    Idempotency key of the bill of a subscription (a last_bills() row) for the period starting on bill_date.
+    """
+    subscription = row["investment"] if bill_type == "INVESTMENT" else row["investor"]
+    return f"{bill_type}:{subscription}:{bill_date.isoformat()}"
+
+
+def generate_bills(investors=None, dry_run=False, years_back=2, batch_size=BATCH_SIZE, as_of=None, since=None, lock_holder=None):
+    """
+    Issues every membership and investment bill due by as_of (today by default), for all investors or a queryset of them.
+    Returns the lines reported by the generate action.
+    Runs that are not dry runs lock the investors (for lock_holder, see lock_investors()) and are recorded as a BillingRun.
+    With since, every period due from since to as_of is issued in the run (see catch_up()).
+    """
+    if batch_size < 1:
+        raise ValueError(f"Cannot write bills in batches of {batch_size}")
+    as_of = as_of or date.today()
+    if dry_run:
+        return bill_due(investors, years_back, batch_size, as_of=as_of, since=since)
+    run = BillingRun.objects.create(years_back=years_back, batch_size=batch_size)
+    try:
+        with lock_investors(Investor.objects.all() if investors is None else investors, holder=lock_holder):
+            response = bill_due(investors, years_back, batch_size, run, as_of=as_of, since=since)
+    except Exception as error:
+        BillingRun.objects.filter(pk=run.pk).update(status="failed", error=repr(error), finished=timezone.now())
+        invalidate(Bill.objects.filter(billing_run=run).values_list("investor", flat=True).order_by().distinct())
+        raise
+    run.status, run.finished = "done", timezone.now()
+    run.save(update_fields=["status", "finished"])
+    # Bills are listed with their run, whose counters and status have moved on since they were issued
+    invalidate(Bill.objects.filter(billing_run=run).values_list("investor", flat=True).order_by().distinct())
+    return response
+
+
+def catch_up(date_from: date, date_to: date, investors=None, dry_run=False, years_back=2, batch_size=BATCH_SIZE):
+    """
+    Issues in a single run the bills generate would have issued running every day from date_from to date_to,
+    after billing stopped (or to backfill). Returns the lines reported, one per bill.
+    """
+    if date_from > date_to:
+        raise ValueError(f"Cannot catch up from {date_from} back to {date_to}")
+    return generate_bills(investors=investors, dry_run=dry_run, years_back=years_back, batch_size=batch_size, as_of=date_to, since=date_from)
+
+
+def bill_due(investors, years_back, batch_size, run=None, as_of=None, since=None):
+    """
+    Body of generate_bills(), a dry run without run. Bills due are planned in memory (plan_bills()),
+    then grouped into cashcalls and written batch_size bills at a time, each batch in its own transaction.
+    Bills whose billing key was issued already, by this or an earlier run, are skipped, so an interrupted run can simply be rerun.
+    """
+    if batch_size < 1:
+        raise ValueError(f"Cannot write bills in batches of {batch_size}")
+    dry_run = run is None
+    as_of = as_of or date.today()
+    first_day = since or as_of
+    # How far back older bills should be considered. Should be a bit over the maximum period of any recurring bill.
+    bill_date_lower_limit = shift_years(first_day, -years_back)
+    dry_run_tag = '[DRY RUN!!] ' if dry_run else ''
+
+    planned = plan_bills(investors, bill_date_lower_limit, as_of, since)
+    response = []
+    while True:
+        # Priced a batch at a time, so the batches written stay if pricing a later one fails
+        batch = list(islice(planned, batch_size))
+        if not batch:
+            break
+        if not dry_run:
+            issued = set(Bill.objects.filter(billing_key__in=[bill.billing_key for bill, _ in batch]).values_list("billing_key", flat=True))
+            batch = [(bill, to_waive) for bill, to_waive in batch if bill.billing_key not in issued]
+        waived = defaultdict(Decimal) # investment id -> amount waived by the batch's bills
+        for bill, to_waive in batch:
+            subscription = "membership" if bill.bill_type == "MEMBERSHIP" else "investment"
+            response.append(f"{dry_run_tag}Billed {bill.investor.name} {round(bill.amount, 2)} EUR for yearly {subscription}")
+            if bill.investment_id is not None:
+                waived[bill.investment_id] += to_waive
+        if not dry_run:
+            with transaction.atomic():
+                # Counted first, so the transaction writes before it reads (SQLite cannot upgrade a read to a write under load)
+                run.batches += 1
+                run.bills_issued += len(batch)
+                run.bills_skipped += len(issued)
+                run.save(update_fields=["batches", "bills_issued", "bills_skipped"])
+                # Read for each batch, as cashcalls sent or validated since the last batch committed take none of its bills
+                cashcalls = CashCallIndex({bill.investor_id for bill, _ in batch})
+                for bill, _ in batch:
+                    bill.billing_run = run
+                    cashcalls.add(bill)
+                cashcalls.save_new()
+                Bill.objects.bulk_create([bill for bill, _ in batch])
+                BalanceChanges.bump(Investment, {pk: {"amount_waived": amount} for pk, amount in waived.items()})
+    return response
+
+
+def plan_bills(investors, bill_date_lower_limit: date, as_of: date, since=None):
+    """
+    Generates the bills due by as_of, unsaved and without cashcall, each with the amount it waives on its investment.
+    Without since, the next bill of each subscription whose period has started, priced as of as_of.
+    With since, every period started by as_of, each priced on the state the bills before it leave, as of its bill date,
+    or since for periods started before. Membership fees are waived on what the investor paid the year before.
+    """
+    sweep = since is not None
+    due_memberships = [row for row in last_bills("MEMBERSHIP", bill_date_lower_limit, investors) if next_year(row["last_date"]) <= as_of]
+    due_investments = [row for row in last_bills("INVESTMENT", bill_date_lower_limit, investors) if next_year(row["last_date"]) <= as_of]
+    investments = Investment.objects.in_bulk([row["investment"] for row in due_investments])
+    investor_map = Investor.objects.in_bulk({row["investor"] for row in due_memberships + due_investments})
+    if not due_memberships:
+        spent = lambda investor_id, day: 0
+    elif sweep:
+        spent = paid_over_year(investors, year_ago(since), as_of)
+    else:
+        yearly = yearly_spends(Investor.objects.all() if investors is None else investors, as_of, 1)
+        spent = lambda investor_id, day: yearly.get(investor_id, 0)
+
+    for row in due_memberships:
+        investor = investor_map[row["investor"]]
+        active = investor.active_member
+        bill_date = next_year(row["last_date"])
+        while bill_date <= as_of:
+            day = max(bill_date, since) if sweep else as_of
+            amount = calc_amount_due_membership(investor=investor, spent=spent(investor.pk, day), as_of=day)
+            yield Bill(
+                frequency = "Y1",
+                bill_type = "MEMBERSHIP",
+                amount = amount if active else 0,
+                validated = False if active else True,
+                ignore = False if active else True,
+                fulfilled = False if active else True,
+                investor = investor,
+                date = bill_date,
+                billing_key = billing_key("MEMBERSHIP", row, bill_date),
+            ), 0
+            if not sweep:
+                break
+            bill_date = next_year(bill_date)
+
+    for row in due_investments:
+        investment = investments[row["investment"]]
+        investor = investor_map[row["investor"]]
+        active = investor.active_member
+        # What the investment's bills add up to as each period is billed
+        billed, waived = investment.amount_billed, investment.amount_waived
+        instalment_no, last_instalment = row["last_instalment"], investment.last_instalment
+        bill_date = next_year(row["last_date"])
+        while bill_date <= as_of:
+            # Read back to the cent, as a run on each day would
+            not_billed = max(investment.total_amount - (waived.quantize(CENT) + billed), 0)
+            if not_billed <= 0 or last_instalment >= investment.total_instalments:
+                break
+            amount, to_waive = calc_amount_due_investment(investment=investment, instalment_no=instalment_no + 1, amount_not_billed=not_billed)
+            yield Bill(
+                frequency = "Y1",
+                bill_type = "INVESTMENT",
+                amount = amount if active else 0,
+                validated = False if active else True,
+                ignore = False if active else True,
+                fulfilled = False if active else True,
+                investor = investor,
+                date = bill_date,
+                investment = investment,
+                instalment_no = instalment_no + active,
+                billing_key = billing_key("INVESTMENT", row, bill_date),
+            ), to_waive
+            if not sweep:
+                break
+            if active:
+                billed += amount.quantize(CENT) # as the bill saves it
+            waived += to_waive
+            instalment_no += active
+            last_instalment = max(last_instalment, instalment_no)
+            bill_date = next_year(bill_date)
+
+
+def paid_over_year(investors, date_from: date, date_to: date):
+    """
+    Function of (investor id, day) giving what the investor paid over the year up to day (as yearly_spend counts it),
+    for days from a year after date_from to date_to. Fulfilled bills are read once, in a single query.
+    """
+    bills = Bill.objects.filter(fulfilled=True, date__gt=date_from, date__lte=date_to)
+    if investors is not None:
+        bills = bills.filter(investor__in=investors)
+    payments = defaultdict(lambda: ([], [0])) # investor id -> (payment dates, running totals)
+    for investor_id, day, amount in bills.values("investor", "date").annotate(paid=money_sum("amount")).order_by("investor", "date").values_list("investor", "date", "paid"):
+        dates, totals = payments[investor_id]
+        dates.append(day)
+        totals.append(totals[-1] + amount)
+
+    def spent(investor_id: int, day: date):
+        if investor_id not in payments:
+            return 0
+        dates, totals = payments[investor_id]
+        return totals[bisect_right(dates, day)] - totals[bisect_right(dates, year_ago(day))]
+    return spent
+
+
+def validate_cashcalls(cashcalls, dry_run=False):
+    """
+    Validates the bills of every non-empty unvalidated cashcall among cashcalls, with a select and two updates.
+    Returns the lines reported by the validate action, one per bill of each cashcall validated.
+    """
+    dry_run_tag = '[DRY RUN!!] ' if dry_run else ''
+    with transaction.atomic():
+        cashcalls = cashcalls.unvalidated().order_by("id")
+        bill_counts = list(cashcalls.values_list("id", "bill_count"))
+        if bill_counts and not dry_run:
+            cashcalls.validate_bills()
+    return [f"{dry_run_tag}Cashcall {cashcall_id} successfully validated" for cashcall_id, bill_count in bill_counts for _ in range(bill_count)]
+
+
+def send_cashcalls(cashcalls, dry_run=False, as_of=None):
+    """
+    Sends every validated cashcall among cashcalls not sent yet on as_of (today by default), with a select and an update.
+    Returns the lines reported by the send action.
+    """
+    dry_run_tag = '[DRY RUN!!] ' if dry_run else ''
+    with transaction.atomic():
+        cashcalls = cashcalls.sendable().order_by("id")
+        recipients = list(cashcalls.values_list("id", "investor__name", "investor__email"))
+        if recipients and not dry_run:
+            cashcalls.mark_sent(as_of or date.today())
+    return [f"{dry_run_tag}Successfully sent cashcall {cashcall_id} to {name} ({email})" for cashcall_id, name, email in recipients]
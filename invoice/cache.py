@@ -0,0 +1,108 @@
+import hashlib
+import uuid
+from datetime import date
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from rest_framework.response import Response
+
+# Cached responses are dropped after this long even if unchanged, bounding how stale one can get should a write
+# bypass invalidate() (raw SQL, a shell), versions are kept until evicted
+RESPONSE_TIMEOUT = 5 * 60
+
+GENERATION = "invoice:generation" # changed to drop every cached response at once
+ALL_INVESTORS = "invoice:version" # changed on any write, versions responses spanning investors
+
+
+def version_key(investor_id):
+    return f"invoice:version:{investor_id}"
+
+
+def new_token():
+    return uuid.uuid4().hex[:16]
+
+
+def enabled():
+    """
+    Whether responses are cached, only when the default cache is shared by every process (database, Redis, memcached, file).
+    A local memory cache lives in a single process, whose versions writes by billing workers and commands would never bump.
+    """
+    return not isinstance(caches["default"], (LocMemCache, DummyCache))
+
+
+def bump(investor_ids=(), everything=False):
+    if not enabled():
+        return
+    tokens = {version_key(investor_id): new_token() for investor_id in set(investor_ids)}
+    tokens[GENERATION if everything else ALL_INVESTORS] = new_token()
+    cache.set_many(tokens, timeout=None)
+
+
+def invalidate(investor_ids=(), everything=False):
+    """
+    Drops the cached responses of investors (ids), and those spanning investors, or every one.
+    Done at once so the connection reads its own writes, and again on commit so responses cached by others
+    from before the commit are dropped too. Without caching, investor_ids (a queryset say) is not even read.
+    """
+    if not enabled():
+        return
+    investor_ids = list(investor_ids)
+    bump(investor_ids, everything)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: bump(investor_ids, everything))
+
+
+def versions(*keys):
+    """
+    Current tokens of keys. Missing ones (never bumped, or evicted) get a fresh token, never one a response may be cached under.
+    """
+    tokens = cache.get_many(keys)
+    for key in keys:
+        if key not in tokens:
+            cache.add(key, new_token(), timeout=None)
+            tokens[key] = cache.get(key)
+    return [tokens[key] for key in keys]
+
+
+class CachedResponseMixin:
+    """
+    Caches the rendered list and detail responses of a viewset, versioned by investor.
+    Lists filtered on investor_id, and investor details, only change with that investor's version;
+    any other response changes on every write. Responses carry an ETag, answered 304 when still current.
+    Nothing is cached unless the cache is shared between processes (see enabled()).
+    """
+    def list(self, request, *args, **kwargs):
+        return self.cached(request, super().list, None if self.basename == "investor" else request.query_params.get("investor_id"), *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(request, super().retrieve, kwargs.get("pk") if self.basename == "investor" else None, *args, **kwargs)
+
+    def cached(self, request, view, investor_id, *args, **kwargs):
+        if not enabled():
+            return view(request, *args, **kwargs)
+        scope = version_key(investor_id) if investor_id and str(investor_id).isdigit() else ALL_INVESTORS
+        generation, version = versions(GENERATION, scope)
+        # The day is part of the key as overdue flags change with it
+        variant = f"{request.get_full_path()}|{request.accepted_media_type}|{date.today()}|{generation}|{version}"
+        etag = f'"{hashlib.md5(variant.encode()).hexdigest()}"'
+        if etag in (tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")):
+            return HttpResponseNotModified(headers={"ETag": etag})
+        key = f"invoice:response:{etag.strip(chr(34))}"
+        hit = cache.get(key)
+        if hit is not None:
+            content, content_type = hit
+            return HttpResponse(content, content_type=content_type, headers={"ETag": etag, "X-Cache": "hit"})
+        request.response_cache = key, etag
+        return view(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key, etag = getattr(request, "response_cache", (None, None))
+        if key and isinstance(response, Response) and response.status_code == 200:
+            response.render()
+            cache.set(key, (response.content, response["Content-Type"]), RESPONSE_TIMEOUT)
+            response["ETag"] = etag
+            response["X-Cache"] = "miss"
+        return response
@@ -0,0 +1,76 @@
+from collections import defaultdict
+from .models import Bill, CashCall, Investor
+
+
+class CashCallIndex:
+    """
+    Unsent cashcalls of investors held in memory, so bills are grouped the way get_cashcall does without querying per bill.
+    Cashcalls are indexed on (investor id, validated) once they hold bills, and on (investor id, None) while empty,
+    as empty ones take bills either way. Cashcalls created on the way are only saved by save_new().
+    """
+    def __init__(self, investors=None):
+        cashcalls = CashCall.objects.filter(sent=False)
+        if investors is not None:
+            cashcalls = cashcalls.filter(investor__in=investors)
+        self.open = defaultdict(list) # in id order, new cashcalls last
+        self.new = []
+        for cashcall in cashcalls.order_by("id"):
+            self.open[cashcall.investor_id, cashcall.validated if cashcall.bill_count else None].append(cashcall)
+
+    def get(self, investor: Investor, validated: bool):
+        matching = self.open[investor.id, bool(validated)]
+        if matching:
+            return max(matching, key=lambda cashcall: cashcall.bill_count) # first of the fullest, as get_cashcall sorts
+        empty = self.open[investor.id, None]
+        if empty:
+            return empty[0]
+        new_cashcall = CashCall(investor=investor, sent=False)
+        empty.append(new_cashcall)
+        self.new.append(new_cashcall)
+        return new_cashcall
+
+    def add(self, bill: Bill):
+        """
+        Places bill in its cashcall for the investor, keeping the in-memory counts current.
+        The saved counts are kept by the balances of the bills once created.
+        """
+        bill.cashcall = cashcall = self.get(bill.investor, bill.validated)
+        if not cashcall.bill_count:
+            self.open[bill.investor_id, None].remove(cashcall)
+            self.file(self.open[bill.investor_id, bool(bill.validated)], cashcall)
+        cashcall.bill_count += 1
+        cashcall.validated_count += bill.validated
+
+    def file(self, cashcalls: list, cashcall: CashCall):
+        # Keeps saved cashcalls in id order ahead of the new ones, so ties go to the oldest
+        if cashcall.pk is None:
+            cashcalls.append(cashcall)
+            return
+        position = next((n for n, other in enumerate(cashcalls) if other.pk is None or other.pk > cashcall.pk), len(cashcalls))
+        cashcalls.insert(position, cashcall)
+
+    def save_new(self):
+        """
+        Saves the new cashcalls empty, as creating their bills counts them, and keeps their in-memory counts for later batches.
+        """
+        counts = [(cashcall.bill_count, cashcall.validated_count) for cashcall in self.new]
+        for cashcall in self.new:
+            cashcall.bill_count = cashcall.validated_count = 0
+        CashCall.objects.bulk_create(self.new)
+        for cashcall, (bill_count, validated_count) in zip(self.new, counts):
+            cashcall.bill_count, cashcall.validated_count = bill_count, validated_count
+        self.new = []
+
+
+def assign_cashcalls(bills: list):
+    """
+    Groups unsaved bills into the open cashcalls of their investors, as get_cashcall would one at a time,
+    with one query for the open cashcalls and one creating those missing. Returns the cashcalls created.
+    """
+    cashcalls = CashCallIndex({bill.investor_id for bill in bills})
+    for bill in bills:
+        cashcalls.add(bill)
+    new = list(cashcalls.new)
+    if new:
+        cashcalls.save_new()
+    return new
@@ -0,0 +1,18 @@
+from datetime import date
+
+
+def shift_years(day: date, years: int):
+    """
+    The same day years later (earlier when negative). Feb 29 falls on Mar 1 in years without one,
+    as a year from Feb 29 has passed once Feb 28 has.
+    """
+    if (day.month, day.day) == (2, 29):
+        try:
+            return day.replace(year=day.year+years)
+        except ValueError:
+            return date(day.year+years, 3, 1)
+    return day.replace(year=day.year+years)
+
+
+next_year = lambda day: shift_years(day, 1)
+year_ago = lambda day: shift_years(day, -1)
@@ -0,0 +1,63 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+
+class ExpandMixin:
+    """
+    Relations named in ?expand= (comma separated, from expandable: {relation: serializer class}) are joined in with
+    select_related and given in full. Lists keep their ids in the results and sideload each related object once,
+    under included[relation], however many of the page's rows refer to it. Details nest them in place.
+    Without ?expand= the viewset is left as is, with relations given as ids.
+    """
+    expandable = {}
+
+    def expansions(self):
+        expand = [name.strip() for name in self.request.query_params.get("expand", "").split(",") if name.strip()]
+        unknown = [name for name in expand if name not in self.expandable]
+        if unknown:
+            raise ValidationError({"expand": f"Cannot expand {', '.join(unknown)}, choose from {', '.join(self.expandable)}"})
+        return list(dict.fromkeys(expand))
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        expand = self.expansions()
+        return queryset.select_related(*expand) if expand else queryset
+
+    def included(self, objects, expand):
+        """
+        {relation: [related object]} of objects, each related object once in the order first referred to.
+        """
+        included = {}
+        for name in expand:
+            related = {}
+            for instance in objects:
+                value = getattr(instance, name)
+                if value is not None:
+                    related.setdefault(value.pk, value)
+            included[name] = self.expandable[name](list(related.values()), many=True).data
+        return included
+
+    def list(self, request, *args, **kwargs):
+        expand = self.expansions()
+        if not expand:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        objects = list(queryset) if page is None else page
+        results = self.get_serializer(objects, many=True).data
+        if page is None:
+            return Response({"results": results, "included": self.included(objects, expand)})
+        response = self.get_paginated_response(results)
+        response.data["included"] = self.included(objects, expand)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        expand = self.expansions()
+        if not expand:
+            return super().retrieve(request, *args, **kwargs)
+        instance = self.get_object()
+        data = self.get_serializer(instance).data
+        for name in expand:
+            value = getattr(instance, name)
+            data[name] = None if value is None else self.expandable[name](value).data
+        return Response(data)
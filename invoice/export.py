@@ -0,0 +1,62 @@
+import csv
+import json
+from datetime import date
+from .models import CashCall, Investment, Bill
+
+# Exportable tables: model, date field filtered on by date ranges, exported columns
+EXPORTS = {
+    "bill": (Bill, "date", (
+        "id", "date", "bill_type", "frequency", "amount", "investor_id", "cashcall_id", "investment_id",
+        "instalment_no", "validated", "ignore", "fulfilled",
+    )),
+    "cashcall": (CashCall, "sent_date", (
+        "id", "investor_id", "sent", "sent_date", "due_date", "billed_total", "paid_total", "bill_count", "validated_count",
+    )),
+    "investment": (Investment, "date_created", (
+        "id", "name", "investor_id", "date_created", "fee_percent", "total_amount", "total_instalments", "amount_waived",
+        "billed_total", "paid_total", "last_instalment_no",
+    )),
+}
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def export_rows(table: str, investors=None, date_from: date = None, date_to: date = None, chunk_size=2000):
+    """
+    Yields the columns of table, then its rows as tuples in id order, for all investors or a queryset of them.
+    date_from and date_to bound the table's date field, both inclusive.
+    Rows are streamed from a server-side cursor chunk_size at a time, no model instances are built.
+    """
+    model, date_field, columns = EXPORTS[table]
+    rows = model.objects.order_by("id")
+    if investors is not None:
+        rows = rows.filter(investor__in=investors)
+    if date_from is not None:
+        rows = rows.filter(**{f"{date_field}__gte": date_from})
+    if date_to is not None:
+        rows = rows.filter(**{f"{date_field}__lte": date_to})
+    yield columns
+    yield from rows.values_list(*columns).iterator(chunk_size=chunk_size)
+
+
+class Echo:
+    """
+    File-like object handing back what is written to it, so csv.writer lines can be yielded.
+    """
+    def write(self, value):
+        return value
+
+
+def to_csv(rows):
+    writer = csv.writer(Echo(), lineterminator="\n")
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def to_ndjson(rows):
+    rows = iter(rows)
+    columns = next(rows)
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=str) + "\n"
+
+
+RENDERERS = {"csv": to_csv, "ndjson": to_ndjson}
@@ -0,0 +1,183 @@
+import datetime
+import decimal
+import json
+from collections import defaultdict
+from django.db import router
+from rest_framework import serializers
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+try:
+    import orjson
+except ImportError: # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+def encode_default(value):
+    """
+    What DRF's JSON encoder makes of values the JSON encoders do not take as is.
+    """
+    if isinstance(value, decimal.Decimal):
+        return float(value) # serializers have coerced decimal fields to strings, property values are left as is
+    if isinstance(value, datetime.datetime):
+        representation = value.isoformat()
+        return representation[:-6] + "Z" if representation.endswith("+00:00") else representation
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONRenderer(BaseRenderer):
+    """
+    Compact JSON with orjson when installed, picked with ?format=fast or Accept: application/vnd.invoicer.fast+json.
+    List actions of FastListMixin viewsets then skip the serializers and build their rows with a FastPlan.
+    """
+    media_type = "application/vnd.invoicer.fast+json"
+    format = "fast"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if orjson is not None:
+            return orjson.dumps(data, default=encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return json.dumps(data, default=encode_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def converter(field):
+    """
+    Function turning a value read for field (as Django converts it) into what field.to_representation() returns,
+    None for values passed as is.
+    """
+    if isinstance(field, serializers.DecimalField) and getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING) and not field.localize:
+        # Saved decimals have no more places than the field, so formatting them gives what quantizing does
+        return f"{{:.{field.decimal_places}f}}".format
+    if isinstance(field, serializers.DateField) and getattr(field, "format", api_settings.DATE_FORMAT).lower() == "iso-8601":
+        return datetime.date.isoformat
+    if isinstance(field, (serializers.BooleanField, serializers.IntegerField, serializers.CharField, serializers.PrimaryKeyRelatedField, serializers.ReadOnlyField)):
+        return None
+    return field.to_representation
+
+
+def read_column(index: int, convert):
+    """
+    Output value of a field read from column index of a row, converted with convert (see converter()).
+    """
+    if convert is None:
+        return lambda row, instance, related: row[index]
+    return lambda row, instance, related: None if row[index] is None else convert(row[index])
+
+
+def read_property(name: str):
+    """
+    Output value of a field computed by a model property, on the instance built from the row.
+    """
+    return lambda row, instance, related: getattr(instance, name)
+
+
+def read_nested(plan):
+    """
+    Output dict of a nested serializer, read from the columns its plan shares with its parent's.
+    """
+    return lambda row, instance, related: plan.render_row(row)
+
+
+def read_related(name: str, pk: int):
+    """
+    Output dicts of a related list, grouped by the id of the row they belong to (see FastPlan.render()).
+    """
+    return lambda row, instance, related: related[name].get(row[pk], [])
+
+
+class FastPlan:
+    """
+    The rows of a ModelSerializer compiled to the columns (values_list() lookups) they read, and a function per field
+    turning a row into its output, so lists are built from plain tuples in the serializer's field order, without serializers.
+    Read-only fields of model properties are computed on model instances built from the row with Model.from_db().
+    Nested serializers (depth or declared) are read through joins, and related lists named in related
+    ({field: (foreign key to this model, serializer class)}) with one more query per page.
+    """
+    def __init__(self, serializer_class, related=None, prefix="", parent=None):
+        serializer = serializer_class()
+        model = serializer.Meta.model
+        self.model = model
+        # Nested plans share the columns of their parent, so its rows hold them all
+        self.columns = [] if parent is None else parent.columns
+        self.pk = self.column(f"{prefix}{model._meta.pk.attname}")
+        self.fields = [] # (name, function of (row, model instance, related lists) giving the output value)
+        self.related = {} # name -> (plan, index of its foreign key column, foreign key)
+        related = related or {}
+        attnames = [field.attname for field in model._meta.concrete_fields]
+        sources = {field.name: field.attname for field in model._meta.concrete_fields}
+        properties = False
+        for name, field in serializer.fields.items():
+            if name in related:
+                foreign_key, related_serializer = related[name]
+                plan = FastPlan(related_serializer)
+                self.related[name] = (plan, plan.column(f"{foreign_key}_id"), foreign_key)
+                self.fields.append((name, read_related(name, self.pk)))
+            elif isinstance(field, serializers.BaseSerializer):
+                self.fields.append((name, read_nested(FastPlan(type(field), prefix=f"{prefix}{field.source}__", parent=self))))
+            elif field.source in sources:
+                self.fields.append((name, read_column(self.column(f"{prefix}{field.source}"), converter(field))))
+            elif isinstance(getattr(model, field.source, None), property):
+                properties = True
+                self.fields.append((name, read_property(field.source)))
+            else:
+                raise ValueError(f"{serializer_class.__name__}.{name} has no fast plan")
+        # Properties read the model's fields, so every field is loaded for them
+        self.instance_columns = [self.column(f"{prefix}{attname}") for attname in attnames] if properties else []
+        self.attnames = attnames
+
+    def column(self, lookup: str):
+        if lookup not in self.columns:
+            self.columns.append(lookup)
+        return self.columns.index(lookup)
+
+    def values(self, queryset):
+        """
+        queryset as rows of the plan's columns, named tuples so they can be paged by id.
+        """
+        return queryset.prefetch_related(None).values_list(*self.columns, named=True)
+
+    def render(self, rows):
+        """
+        Output dicts of rows read with values(), with their related lists.
+        """
+        related = {}
+        ids = [row[self.pk] for row in rows]
+        for name, (plan, foreign_key_index, foreign_key) in self.related.items():
+            grouped = defaultdict(list)
+            for row in plan.values(plan.model.objects.filter(**{f"{foreign_key}__in": ids}).order_by("pk")):
+                grouped[row[foreign_key_index]].append(plan.render_row(row))
+            related[name] = grouped
+        return [self.render_row(row, related) for row in rows]
+
+    def render_row(self, row, related=None):
+        """
+        The output dict of a row, None for an empty nested relation.
+        """
+        if row[self.pk] is None:
+            return None
+        instance = None
+        if self.instance_columns:
+            instance = self.model.from_db(router.db_for_read(self.model), self.attnames, [row[index] for index in self.instance_columns])
+        return {name: read(row, instance, related) for name, read in self.fields}
+
+
+class FastListMixin:
+    """
+    Serves the list action of a viewset with its fast_plan when the fast renderer is picked, in the same JSON shape.
+    """
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, FastJSONRenderer]
+    fast_plan = None
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != FastJSONRenderer.format or self.fast_plan is None:
+            return super().list(request, *args, **kwargs)
+        rows = self.fast_plan.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response(self.fast_plan.render(list(rows)))
+        return self.get_paginated_response(self.fast_plan.render(page))
@@ -0,0 +1,112 @@
+from datetime import date
+from decimal import Decimal
+from bisect import bisect_right
+
+
+class FeeSchedule:
+    """
+    Rates keyed on the date they came into effect. Dates are lower limits, looked up by bisecting the sorted dates.
+    """
+    def __init__(self, rates: dict):
+        self.dates = sorted(rates)
+        self.rates = [rates[date_obj] for date_obj in self.dates]
+
+    def index_on(self, day: date):
+        index = bisect_right(self.dates, day) - 1
+        if index < 0:
+            raise ValueError(f"No rates in effect on {day}")
+        return index
+
+    def rates_on(self, day: date):
+        return self.rates[self.index_on(day)]
+
+
+class DiscountSchedule(FeeSchedule):
+    """
+    Yearly investment discounts (%) by instalment no., with a "default" for instalments not listed.
+    Also compiled to hundredths of a percent (basis points) for integer arithmetic.
+    """
+    def __init__(self, rates: dict):
+        super().__init__(rates)
+        self.basis_points = [{key: int(value * 100) for key, value in discounts.items()} for discounts in self.rates]
+
+    def discount(self, day: date, instalment_no: int):
+        discounts = self.rates_on(day)
+        return discounts.get(instalment_no, discounts["default"])
+
+    def basis_points_on(self, day: date):
+        return self.basis_points[self.index_on(day)]
+
+
+# Rates are changed by adding an entry dated the day the new rates apply
+INVESTMENT_DISCOUNTS = DiscountSchedule({
+    date(2050, 4, 1): {1: Decimal("0"), 2: Decimal("1"), 3: Decimal("2"), "default": Decimal("5")},
+    date(2019, 4, 1): {1: Decimal("0"), 2: Decimal("0"), 3: Decimal("0.2"), 4: Decimal("0.5"), "default": Decimal("1")},
+    date(1950, 1, 1): {1: Decimal("0"), 2: Decimal("0"), 3: Decimal("0"), "default": Decimal("0")},
+    date(1900, 1, 1): {1: Decimal("0.5"), 2: Decimal("1"), 3: Decimal("5"), "default": Decimal("10")},
+})
+MEMBERSHIP_FEES = FeeSchedule({
+    date(2050, 4, 1): {"membership": Decimal("50000"), "membership_waive": Decimal("100000")},
+    date(2030, 6, 1): {"membership": Decimal("25000"), "membership_waive": Decimal("50000")},
+    date(1900, 1, 1): {"membership": Decimal("3000"), "membership_waive": Decimal("50000")},
+})
+
+
+def to_cents(amount):
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def from_cents(cents: int):
+    return Decimal(cents).scaleb(-2)
+
+
+def round_half_even(numerator: int, denominator: int):
+    """
+    numerator/denominator rounded to the nearest integer, ties to even as Decimal amounts are when saved.
+    """
+    quotient, remainder = divmod(numerator, denominator) # floors, so remainder is >= 0
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+def investment_terms(investment):
+    """
+    Compiles what investment_fee_cents needs of an investment:
+    (date_created, fee in basis points, total amount in cents, discounts in basis points by instalment no.)
+    """
+    date_created = investment.date_created
+    return date_created, to_cents(investment.fee_percent), to_cents(investment.total_amount), INVESTMENT_DISCOUNTS.basis_points_on(date_created)
+
+
+def investment_fee_cents(date_created: date, fee_bp: int, total_cents: int, discounts_bp: dict, instalment_no: int, not_billed_cents: int):
+    """
+    Integer-cent twin of calc_amount_due_investment taking investment_terms(), returns (cents to pay, cents to waive).
+    Amounts are computed exactly and only rounded at the end.
+    """
+    discount_bp = discounts_bp.get(instalment_no, discounts_bp["default"])
+    if instalment_no == 1:
+        end_of_year = date(date_created.year, 12, 31)
+        num_of_days = (end_of_year - date_created).days + 1
+        days_in_year = (end_of_year - date(date_created.year, 1, 1)).days + 1
+    else:
+        num_of_days = days_in_year = 1
+    denominator = days_in_year * 10_000
+    not_billed = not_billed_cents * denominator
+    to_pay = min(num_of_days * (fee_bp - discount_bp) * total_cents, not_billed)
+    to_waive = min(num_of_days * discount_bp * total_cents, not_billed - to_pay)
+    return round_half_even(to_pay, denominator), round_half_even(to_waive, denominator)
+
+
+def investment_fees_cents(investments, instalment_nos, not_billed_cents):
+    """
+    Batch calc_amount_due_investment. Takes sequences of investments, instalment nos. and amounts not billed in cents,
+    returns lists of cents to pay and cents to waive. Investments may be Investment objects or investment_terms() tuples.
+    """
+    to_pay, to_waive = [], []
+    for investment, instalment_no, not_billed in zip(investments, instalment_nos, not_billed_cents):
+        terms = investment if isinstance(investment, tuple) else investment_terms(investment)
+        pay, waive = investment_fee_cents(*terms, instalment_no, not_billed)
+        to_pay.append(pay)
+        to_waive.append(waive)
+    return to_pay, to_waive
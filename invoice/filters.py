@@ -0,0 +1,86 @@
+from rest_framework.filters import BaseFilterBackend
+from ast import literal_eval as safe_eval
+from django.shortcuts import get_object_or_404
+from .models import Investor
+
+
+class Filter:
+    """
+    A single query param mapped onto a queryset lookup.
+    """
+    def __init__(self, field_name):
+        self.field_name = field_name
+
+    def parse(self, value):
+        return value
+
+    def filter(self, queryset, value):
+        return queryset.filter(**{self.field_name: value})
+
+
+class BooleanFilter(Filter):
+    def parse(self, value):
+        return bool(safe_eval(value)) # accepts 1/0 as well as True/False
+
+
+class InvestorFilter(Filter):
+    def parse(self, value):
+        return get_object_or_404(Investor, pk=value)
+
+
+class FilterSetMetaclass(type):
+    def __new__(mcs, name, bases, attrs):
+        new_class = super().__new__(mcs, name, bases, attrs)
+        new_class.base_filters = {}
+        for base in reversed(new_class.__mro__):
+            new_class.base_filters.update({key: value for key, value in vars(base).items() if isinstance(value, Filter)})
+        return new_class
+
+
+class FilterSet(metaclass=FilterSetMetaclass):
+    """
+    Minimal django-filter style FilterSet, filters compose on the queryset so they all run in the database.
+    """
+    def __init__(self, data, queryset):
+        self.data = data
+        self.queryset = queryset
+
+    @property
+    def qs(self):
+        queryset = self.queryset
+        for name, filter_ in self.base_filters.items():
+            value = self.data.get(name)
+            if value in (None, ""):
+                continue
+            queryset = filter_.filter(queryset, filter_.parse(value))
+        return queryset
+
+
+class FilterSetBackend(BaseFilterBackend):
+    """
+    Applies the view's `filterset_class` to its queryset.
+    """
+    def filter_queryset(self, request, queryset, view):
+        filterset_class = getattr(view, "filterset_class", None)
+        if filterset_class is None:
+            return queryset
+        return filterset_class(request.query_params, queryset).qs
+
+
+class CashCallFilter(FilterSet):
+    investor_id = InvestorFilter("investor")
+    sent = BooleanFilter("sent")
+    fulfilled = BooleanFilter("is_fulfilled") # annotated by CashCallQuerySet.with_flags()
+    validated = BooleanFilter("is_validated")
+
+
+class InvestmentFilter(FilterSet):
+    investor_id = InvestorFilter("investor")
+    fulfilled = BooleanFilter("is_fulfilled") # annotated by InvestmentQuerySet.with_flags()
+
+
+class BillFilter(FilterSet):
+    investor_id = InvestorFilter("investor")
+    sent = BooleanFilter("cashcall__sent")
+    fulfilled = BooleanFilter("fulfilled")
+    validated = BooleanFilter("validated")
@@ -0,0 +1,93 @@
+from datetime import date
+from collections import defaultdict
+from .billing import last_bills
+from .dates import next_year, shift_years, year_ago
+from .fees import MEMBERSHIP_FEES, investment_fee_cents, investment_terms, to_cents
+from .models import Investment, Investor, Bill, money_sum
+
+
+def membership_cents(spent_cents: int, day: date):
+    """
+    Membership fee due on day in cents, 0 if spent_cents over the past year reaches the waiver threshold.
+    """
+    yearly_fee = MEMBERSHIP_FEES.rates_on(day)
+    if spent_cents >= to_cents(yearly_fee["membership_waive"]):
+        return 0
+    return to_cents(yearly_fee["membership"])
+
+
+def forecast(years: int, investors=None, years_back=2, as_of=None):
+    """
+    Projects the bills the generate action would issue over the {years} years after as_of (today by default),
+    for all investors or a queryset of them.
+    Nothing is written.
+    Returns {(investor_id, year): [membership cents, investment cents, waived cents]}.
+
+    Everything is loaded in a handful of queries and simulated in memory in integer cents.
+    Projected bills are assumed paid on their bill date, so they count towards the membership waiver threshold.
+    """
+    today = as_of or date.today()
+    horizon = shift_years(today, years)
+    bill_date_lower_limit = shift_years(today, -years_back)
+    active = dict((Investor.objects.all() if investors is None else investors).values_list("id", "active_member"))
+    totals = defaultdict(lambda: [0, 0, 0])
+    payments = defaultdict(list) # investor id -> [(date, cents)] of fulfilled and projected bills
+
+    # Investments are billed independently of each other
+    investment_rows = {row["investment"]: row for row in last_bills("INVESTMENT", bill_date_lower_limit, investors)}
+    investments = Investment.objects.all()
+    if investors is not None:
+        investments = investments.filter(investor__in=investors)
+    for investment in investments.iterator(chunk_size=2000):
+        row = investment_rows.get(investment.pk)
+        if row is None:
+            continue
+        investor_id, is_active = row["investor"], active[row["investor"]]
+        terms = investment_terms(investment)
+        total, total_instalments = to_cents(investment.total_amount), investment.total_instalments
+        billed, waived = to_cents(investment.amount_billed), to_cents(investment.amount_waived)
+        instalment_no, last_instalment = row["last_instalment"], investment.last_instalment
+        bill_date = next_year(row["last_date"])
+        while bill_date <= horizon:
+            not_billed = max(total - (waived + billed), 0)
+            if not_billed <= 0 or last_instalment >= total_instalments:
+                break
+            to_pay, to_waive = investment_fee_cents(*terms, instalment_no + 1, not_billed)
+            waived += to_waive
+            year_totals = totals[(investor_id, bill_date.year)]
+            year_totals[2] += to_waive
+            if is_active:
+                billed += to_pay
+                instalment_no += 1
+                last_instalment = max(last_instalment, instalment_no)
+                year_totals[1] += to_pay
+                payments[investor_id].append((bill_date, to_pay))
+            bill_date = next_year(bill_date)
+
+    # Memberships are waived on the spend over the year before each bill
+    membership_rows = last_bills("MEMBERSHIP", bill_date_lower_limit, investors)
+    spent_before = Bill.objects.filter(fulfilled=True, date__gt=year_ago(today), date__lte=today)
+    if investors is not None:
+        spent_before = spent_before.filter(investor__in=investors)
+    for investor_id, day, amount in spent_before.values("investor", "date").annotate(spent=money_sum("amount")).values_list("investor", "date", "spent"):
+        payments[investor_id].append((day, to_cents(amount)))
+    for row in membership_rows:
+        investor_id = row["investor"]
+        investor_payments = sorted(payments[investor_id])
+        window_start = window_end = spent = 0 # sliding window over investor_payments
+        bill_date = next_year(row["last_date"])
+        while bill_date <= horizon:
+            while window_end < len(investor_payments) and investor_payments[window_end][0] <= bill_date:
+                spent += investor_payments[window_end][1]
+                window_end += 1
+            while window_start < window_end and investor_payments[window_start][0] <= year_ago(bill_date):
+                spent -= investor_payments[window_start][1]
+                window_start += 1
+            amount = membership_cents(spent, bill_date) if active[investor_id] else 0
+            totals[(investor_id, bill_date.year)][0] += amount
+            if amount:
+                investor_payments.insert(window_end, (bill_date, amount))
+                spent += amount
+                window_end += 1
+            bill_date = next_year(bill_date)
+    return dict(totals)
@@ -0,0 +1,204 @@
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import date, timedelta
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .billing import BATCH_SIZE, generate_bills, send_cashcalls, validate_cashcalls
+from .models import BillingJob, CashCall, Investor
+
+# Investors per child job of a run over all investors
+PARTITION_SIZE = 1000
+
+# A running job whose worker has not renewed its lease for this long is deemed dead and queued again (see reclaim()),
+# unless it was claimed MAX_ATTEMPTS times already, then it fails
+LEASE = timedelta(minutes=10)
+MAX_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+# Reported by an action with nothing to do, as the endpoints do
+EMPTY_RESULTS = {
+    "generate": "No bills due, no additional cashcalls generated",
+    "validate": "No non-empty unvalidated cashcalls in queue to validate",
+    "send": "No validated cashcalls in queue to send",
+}
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def run_action(job: BillingJob):
+    """
+    Runs the action of job over its investors, returns the lines reported.
+    """
+    dry_run = job.params.get("dry_run", False)
+    as_of = date.fromisoformat(job.params["as_of"]) if job.params.get("as_of") else None
+    if job.action == "generate":
+        return generate_bills(
+            investors=job.investors, dry_run=dry_run, years_back=job.params.get("years_back", 2), batch_size=job.params.get("batch_size", BATCH_SIZE), as_of=as_of,
+            lock_holder=f"job:{job.pk}", # a later attempt takes over the locks of a dead one
+        )
+    cashcalls = CashCall.objects.filter(investor__in=job.investors)
+    if job.action == "validate":
+        return validate_cashcalls(cashcalls, dry_run=dry_run)
+    return send_cashcalls(cashcalls, dry_run=dry_run, as_of=as_of)
+
+
+def enqueue(action: str, params: dict, investor_id: int = None, partition_size: int = PARTITION_SIZE):
+    """
+    Queues action for one investor, or for all investors split into child jobs of partition_size investors.
+    Child jobs cover contiguous id ranges with no gaps, the last one unbounded, so investors added meanwhile are included.
+    """
+    with transaction.atomic():
+        if investor_id is not None:
+            return BillingJob.objects.create(action=action, params=params, investor_from=investor_id, investor_to=investor_id)
+        job = BillingJob.objects.create(action=action, params=params, status="split")
+        ids = Investor.objects.order_by("id").values_list("id", flat=True)
+        starts = [investor_id for n, investor_id in enumerate(ids.iterator()) if n % partition_size == 0][1:]
+        bounds = zip([None] + starts, [start - 1 for start in starts] + [None])
+        BillingJob.objects.bulk_create([
+            BillingJob(action=action, params=params, parent=job, investor_from=investor_from, investor_to=investor_to)
+            for investor_from, investor_to in bounds
+        ])
+    return job
+
+
+def reclaim():
+    """
+    Queues again the running jobs whose worker died, those whose lease expired, or fails them once claimed MAX_ATTEMPTS times.
+    Returns how many jobs were queued again or failed.
+    """
+    expired = BillingJob.objects.filter(status="running", heartbeat__lt=timezone.now() - LEASE)
+    given_up = list(expired.filter(attempts__gte=MAX_ATTEMPTS))
+    for job in given_up:
+        finish(job, status="failed", error=f"Worker {job.worker} stopped renewing the lease of attempt {job.attempts} of {MAX_ATTEMPTS}")
+    return len(given_up) + expired.filter(attempts__lt=MAX_ATTEMPTS).update(status="queued", worker="")
+
+
+def claim(worker: str):
+    """
+    Marks the oldest queued job running for worker and returns it, None when the queue is empty.
+    Jobs whose worker died are queued again first (see reclaim()).
+    A job is claimed with a conditional UPDATE, so concurrent workers never get the same one.
+    """
+    reclaim()
+    while True:
+        job_id = BillingJob.objects.filter(status="queued").order_by("id").values_list("id", flat=True).first()
+        if job_id is None:
+            return None
+        now = timezone.now()
+        if BillingJob.objects.filter(pk=job_id, status="queued").update(status="running", worker=worker, started=now, heartbeat=now, attempts=F("attempts") + 1):
+            return BillingJob.objects.get(pk=job_id)
+
+
+def attempt(job: BillingJob):
+    """
+    The job's rows while the attempt of job (as claimed) is the latest, none once it was reclaimed.
+    """
+    return BillingJob.objects.filter(pk=job.pk, status="running", attempts=job.attempts)
+
+
+@contextmanager
+def heartbeat(job: BillingJob, interval: timedelta = LEASE / 3):
+    """
+    Renews the lease of job every interval from a thread, with its own connection, while the block runs.
+    Renewals that fail are logged and retried. Once the lease is lost, reclaimed or expired without a renewal,
+    the next query of the block raises LeaseLost, so the attempt stops where another may take over.
+    """
+    stop, lost, aborted = threading.Event(), threading.Event(), threading.Event()
+
+    def renew():
+        renewed = job.heartbeat or timezone.now()
+        try:
+            while not stop.wait(interval.total_seconds()):
+                try:
+                    if not attempt(job).update(heartbeat=timezone.now()):
+                        lost.set() # reclaimed
+                        return
+                    renewed = timezone.now()
+                except Exception:
+                    logger.exception("Could not renew the lease of job %s", job.pk)
+                    connection.close() # reconnects on the next renewal
+                    if timezone.now() - renewed >= LEASE:
+                        lost.set()
+                        return
+        finally:
+            connection.close()
+
+    def fence(execute, sql, params, many, context):
+        # Raised once, the queries rolling the attempt back still run
+        if lost.is_set() and not aborted.is_set():
+            aborted.set()
+            raise LeaseLost(f"Attempt {job.attempts} of job {job.pk} lost its lease")
+        return execute(sql, params, many, context)
+    thread = threading.Thread(target=renew, name=f"heartbeat of job {job.pk}", daemon=True)
+    thread.start()
+    try:
+        with connection.execute_wrapper(fence):
+            yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def finish(job: BillingJob, status: str, results: str = "", error: str = ""):
+    """
+    Records the outcome of the attempt of job (ignored if the job was reclaimed meanwhile),
+    then closes its parent once every sibling has finished. Returns whether it was recorded.
+    """
+    job.status, job.results, job.error, job.finished = status, results, error, timezone.now()
+    if not attempt(job).update(status=status, results=results, error=error, finished=job.finished):
+        return False
+    if job.parent_id is not None:
+        children = BillingJob.objects.filter(parent=job.parent_id)
+        if not children.exclude(status__in=["done", "failed"]).exists():
+            status = "failed" if children.filter(status="failed").exists() else "done"
+            BillingJob.objects.filter(pk=job.parent_id, status="split").update(status=status, finished=timezone.now())
+    return True
+
+
+def run(job: BillingJob):
+    """
+    Runs a claimed job, renewing its lease meanwhile, and records its results.
+    An attempt that lost its lease records nothing, the job is queued again by reclaim() if no other attempt took over.
+    """
+    try:
+        with heartbeat(job):
+            results = "\n".join(run_action(job))
+    except LeaseLost:
+        pass
+    except Exception:
+        finish(job, status="failed", error=traceback.format_exc())
+    else:
+        finish(job, status="done", results=results)
+    return job
+
+
+def report(job: BillingJob):
+    """
+    Progress and results of a job, gathered from its child jobs if it was split.
+    """
+    children = list(job.children.order_by("id")) if job.status in ("split", "done", "failed") else []
+    jobs = children or [job]
+    finished = [child for child in jobs if child.status in ("done", "failed")]
+    results = [line for child in finished for line in child.results.splitlines()]
+    lines = len(results)
+    if not results and job.status == "done":
+        results = [EMPTY_RESULTS[job.action]]
+    return {
+        "id": job.id,
+        "action": job.action,
+        "params": job.params,
+        "status": job.status if job.status != "split" else "running" if any(child.status != "queued" for child in jobs) else "queued",
+        "progress": {"finished": len(finished), "total": len(jobs)},
+        "counts": {"lines": lines, "failed": sum(child.status == "failed" for child in jobs)},
+        "results": results,
+        "errors": [child.error for child in jobs if child.error],
+        "created": job.created,
+        "started": min((child.started for child in jobs if child.started), default=None),
+        "finished": job.finished,
+    }
@@ -0,0 +1,30 @@
+import csv
+from datetime import date
+from django.core.management.base import BaseCommand
+from invoice.aging import BUCKETS, aging, aging_total, take_snapshot
+from invoice.models import Investor
+
+
+class Command(BaseCommand):
+    help = "Reports what investors owe on sent cashcalls by days past due as CSV, or stores it as the day's aging snapshot."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--as-of", type=date.fromisoformat, help="Age cashcalls as of this day (YYYY-MM-DD) rather than today")
+        parser.add_argument("--investor-id", type=int, help="Only report cashcalls of this investor")
+        parser.add_argument("--snapshot", action="store_true", help="Store the aging of every investor as the day's snapshot instead of printing it")
+
+    def handle(self, *args, **options):
+        if options["snapshot"]:
+            written = take_snapshot(options["as_of"])
+            self.stdout.write(f"Aging snapshot of {options['as_of'] or date.today()} taken for {written} investors")
+            return
+        investors = None
+        if options["investor_id"]:
+            investors = Investor.objects.filter(pk=options["investor_id"])
+        report, total = aging(options["as_of"], investors=investors), aging_total(options["as_of"], investors=investors)
+        columns = [*BUCKETS, "total"]
+        writer = csv.writer(self.stdout, lineterminator="\n")
+        writer.writerow(["investor_id", *columns])
+        for row in report:
+            writer.writerow([row["investor_id"], *(row[name] for name in columns)])
+        writer.writerow(["total", *(total[name] for name in columns)])
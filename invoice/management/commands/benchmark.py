@@ -0,0 +1,57 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from invoice.benchmark import SCALES, benchmark, compare, environment
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the list endpoints, generate/validate/send all and the fee calculators against synthetic portfolios "
+        "in a throwaway test database, as JSON. Compared with a baseline run, fails on cases slower than the threshold."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scales", default=",".join(map(str, SCALES)), help="Comma separated no. of investors to seed for each run")
+        parser.add_argument("--years", type=int, default=3, help="Years of history seeded")
+        parser.add_argument("--repeat", type=int, default=3, help="Times each case is run, the median is compared")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed of the portfolios")
+        parser.add_argument("--output", help="Write the results to this JSON file rather than stdout")
+        parser.add_argument("--compare", help="Baseline JSON results of an earlier run to check for regressions")
+        parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown over the baseline reported as a regression, 0.2 = 20%%")
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in options["scales"].split(",")]
+        except ValueError:
+            raise CommandError(f"Invalid --scales {options['scales']}, expected comma separated integers")
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                baseline = json.load(file)["results"]
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            output = {
+                "environment": environment(),
+                "settings": {option: options[option] for option in ("years", "repeat", "seed")},
+                "results": benchmark(scales, years=options["years"], repeat=options["repeat"], seed=options["seed"]),
+            }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(output, file, indent=2)
+        else:
+            self.stdout.write(json.dumps(output, indent=2))
+        if baseline is None:
+            return
+        regressions = compare(output["results"], baseline, options["threshold"])
+        for scale, name, before_ms, ms in regressions:
+            self.stderr.write(f"{name} at {scale} investors: {before_ms} ms -> {ms} ms (+{(ms / before_ms - 1) * 100:.0f}%)")
+        if regressions:
+            raise CommandError(f"{len(regressions)} cases over {options['threshold'] * 100:.0f}% slower than {options['compare']}")
+        self.stderr.write(f"No cases over {options['threshold'] * 100:.0f}% slower than {options['compare']}")
@@ -0,0 +1,27 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from invoice.billing import BATCH_SIZE, InvestorsLocked, catch_up
+
+
+class Command(BaseCommand):
+    help = "Issues in one run the bills generate would have issued running every day from --from to --to, e.g. after downtime or to backfill."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, required=True, help="First day billing missed (YYYY-MM-DD)")
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat, default=date.today(), help="Last day to bill (YYYY-MM-DD), today by default")
+        parser.add_argument("--dry-run", action="store_true", help="Report the bills due without issuing them")
+        parser.add_argument("--years-back", type=int, default=2, help="How far back before --from older bills are considered, as for generate")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Bills written per transaction")
+
+    def handle(self, *args, **options):
+        try:
+            lines = catch_up(
+                options["date_from"], options["date_to"], dry_run=options["dry_run"], years_back=options["years_back"], batch_size=options["batch_size"],
+            )
+        except (InvestorsLocked, ValueError) as error:
+            raise CommandError(error)
+        if options["verbosity"] > 1:
+            for line in lines:
+                self.stdout.write(line)
+        tag = "[DRY RUN!!] " if options["dry_run"] else ""
+        self.stdout.write(f"{tag}{len(lines)} bills due from {options['date_from']} to {options['date_to']} issued" if lines else "No bills due, no additional cashcalls generated")
@@ -0,0 +1,26 @@
+from datetime import date
+from django.core.management.base import BaseCommand
+from invoice.export import EXPORTS, RENDERERS, export_rows
+from invoice.models import Investor
+
+
+class Command(BaseCommand):
+    help = "Streams bills, cashcalls or investments as CSV or NDJSON, a chunk of rows at a time."
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", choices=EXPORTS, help="Table to export")
+        parser.add_argument("--format", choices=RENDERERS, default="csv", help="Output format")
+        parser.add_argument("--investor-id", type=int, help="Only export rows of this investor")
+        parser.add_argument("--date-from", type=date.fromisoformat, help="First date exported (YYYY-MM-DD), inclusive")
+        parser.add_argument("--date-to", type=date.fromisoformat, help="Last date exported (YYYY-MM-DD), inclusive")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Rows fetched from the database at a time")
+
+    def handle(self, *args, **options):
+        investors = None
+        if options["investor_id"]:
+            investors = Investor.objects.filter(pk=options["investor_id"])
+        rows = export_rows(
+            options["table"], investors=investors, date_from=options["date_from"], date_to=options["date_to"], chunk_size=options["chunk_size"],
+        )
+        for line in RENDERERS[options["format"]](rows):
+            self.stdout.write(line, ending="")
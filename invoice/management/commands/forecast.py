@@ -0,0 +1,24 @@
+import csv
+from django.core.management.base import BaseCommand
+from invoice.fees import from_cents
+from invoice.forecast import forecast
+from invoice.models import Investor
+
+
+class Command(BaseCommand):
+    help = "Projects membership and investment bills over the coming years as CSV, without writing to the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--years", type=int, default=5, help="How many years ahead to project")
+        parser.add_argument("--investor-id", type=int, help="Only project bills of this investor")
+        parser.add_argument("--years-back", type=int, default=2, help="How far back bills are considered, as for generate")
+
+    def handle(self, *args, **options):
+        investors = None
+        if options["investor_id"]:
+            investors = Investor.objects.filter(pk=options["investor_id"])
+        projection = forecast(years=options["years"], investors=investors, years_back=options["years_back"])
+        writer = csv.writer(self.stdout, lineterminator="\n")
+        writer.writerow(["investor_id", "year", "membership", "investment", "waived"])
+        for (investor_id, year), amounts in sorted(projection.items()):
+            writer.writerow([investor_id, year, *map(from_cents, amounts)])
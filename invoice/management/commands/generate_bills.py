@@ -0,0 +1,30 @@
+from datetime import date
+from functools import partial
+from django.core.management.base import BaseCommand, CommandError
+from invoice.billing import InvestorsLocked, generate_shard
+from invoice.workers import process_pool
+
+
+class Command(BaseCommand):
+    help = "Generates the bills due for all investors, sharded by investor id over a pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Worker processes, each billing the investors whose id modulo workers is its shard")
+        parser.add_argument("--dry-run", action="store_true", help="Report the bills due without issuing them")
+        parser.add_argument("--years-back", type=int, default=2, help="How far back older bills are considered, as for generate")
+        parser.add_argument("--as-of", type=date.fromisoformat, help="Bill what is due on this day (YYYY-MM-DD) rather than today")
+
+    def handle(self, *args, **options):
+        workers, kwargs = options["workers"], {"dry_run": options["dry_run"], "years_back": options["years_back"], "as_of": options["as_of"]}
+        if workers < 1:
+            raise CommandError("--workers should be at least 1")
+        try:
+            if workers == 1:
+                shards = [generate_shard(1, 0, **kwargs)]
+            else:
+                with process_pool(workers) as pool:
+                    shards = list(pool.map(partial(generate_shard, workers, **kwargs), range(workers)))
+        except InvestorsLocked as error:
+            raise CommandError(error)
+        lines = [line for response in shards for line in response]
+        self.stdout.write('\n'.join(lines) if lines else "No bills due, no additional cashcalls generated")
@@ -0,0 +1,26 @@
+from collections import defaultdict
+from django.core.management.commands import loaddata
+from django.db.models import Q
+from invoice.balances import recompute_balances, recompute_spends
+from invoice.models import Bill, CashCall, Investment, Investor
+
+
+class Command(loaddata.Command):
+    help = loaddata.Command.help + " Materialized balances and monthly spends are recomputed for the rows loaded and those their bills count in."
+
+    def loaddata(self, fixture_labels):
+        self.loaded_pks = defaultdict(set) # model -> pks of the rows saved
+        super().loaddata(fixture_labels)
+        # Fixtures are saved raw, without the receivers keeping balances
+        if not self.loaded_object_count:
+            return
+        bills = Bill.objects.filter(pk__in=self.loaded_pks[Bill])
+        loaded = lambda model, field: model.objects.filter(Q(pk__in=self.loaded_pks[model]) | Q(pk__in=bills.values(field)))
+        recompute_balances(cashcalls=loaded(CashCall, "cashcall"), investments=loaded(Investment, "investment"))
+        recompute_spends(loaded(Investor, "investor"))
+
+    def save_obj(self, obj):
+        saved = super().save_obj(obj)
+        if saved:
+            self.loaded_pks[type(obj.object)].add(obj.object.pk)
+        return saved
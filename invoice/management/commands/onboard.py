@@ -0,0 +1,37 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from invoice.billing import BATCH_SIZE
+from invoice.onboarding import onboard_investments, onboard_investors
+from invoice.serializer import InvestmentBulkSerializer, InvestorBulkSerializer
+
+ONBOARDING = {
+    "investor": (InvestorBulkSerializer, onboard_investors),
+    "investment": (InvestmentBulkSerializer, onboard_investments),
+}
+
+
+class Command(BaseCommand):
+    help = "Creates investors or investments from a CSV file in bulk, with the bills creating them one at a time issues."
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", choices=ONBOARDING, help="What the rows are")
+        parser.add_argument("path", help="CSV file with a header row naming the fields, as the API takes them (investor is an id)")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows written at a time")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size should be at least 1")
+        serializer_class, onboard = ONBOARDING[options["table"]]
+        with open(options["path"], newline="") as csv_file:
+            # Empty cells are left out, so fields take their defaults
+            rows = [{field: value for field, value in row.items() if value != ""} for row in csv.DictReader(csv_file)]
+        serializer = serializer_class(data=rows, many=True)
+        if not serializer.is_valid():
+            errors = serializer.errors
+            if isinstance(errors, dict): # checks over the whole list
+                raise CommandError("\n".join(f"{field}: {message}" for field, messages in errors.items() for message in messages))
+            raise CommandError("\n".join(
+                f"line {line}: {field}: {' '.join(messages)}" for line, row_errors in enumerate(errors, start=2) for field, messages in row_errors.items()
+            ))
+        created = onboard(serializer.validated_data, batch_size=options["batch_size"])
+        self.stdout.write(f"Created {len(created)} {options['table']}s")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from invoice.balances import check_balances, recompute_balances, recompute_spends
+
+
+class Command(BaseCommand):
+    help = "Recomputes the materialized cashcall and investment balances, and monthly spends, from the bill table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only report balances that differ from the bill table")
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            recompute_balances()
+            recompute_spends()
+            self.stdout.write("Balances recomputed")
+            return
+        mismatches = check_balances()
+        for model, pk, field, stored, actual in mismatches:
+            self.stdout.write(f"{model} {pk} {field}: stored {stored}, bills give {actual}")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} balances differ from the bill table")
+        self.stdout.write("Balances match the bill table")
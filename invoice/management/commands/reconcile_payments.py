@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from invoice.reconcile import UnreadableStatement, read_statement, reconcile, reconcile_report
+
+
+class Command(BaseCommand):
+    help = "Marks bills paid by a bank statement (CSV with reference and amount columns, or CAMT XML) fulfilled."
+
+    def add_arguments(self, parser):
+        parser.add_argument("statement", help="Path of the statement file")
+        parser.add_argument("--dry-run", action="store_true", help="Report matches without marking bills fulfilled")
+
+    def handle(self, *args, **options):
+        with open(options["statement"], "rb") as statement:
+            try:
+                paid, unmatched = reconcile(read_statement(statement, options["statement"]), dry_run=options["dry_run"])
+            except UnreadableStatement as error:
+                raise CommandError(error)
+        self.stdout.write('\n'.join(reconcile_report(paid, unmatched, dry_run=options["dry_run"])))
@@ -0,0 +1,52 @@
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from invoice.jobs import claim, run
+
+
+class Command(BaseCommand):
+    help = "Runs queued generate, validate and send jobs, with a pool of workers claiming them from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Jobs run at the same time")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty instead of polling")
+
+    def work(self, name, options):
+        ran = 0
+        try:
+            while True:
+                job = claim(name)
+                if job is None:
+                    if options["once"]:
+                        return ran
+                    time.sleep(options["poll_interval"])
+                    continue
+                job = run(job)
+                ran += 1
+                self.stdout.write(f"{name}: {job}")
+        finally:
+            if options["workers"] > 1:
+                connection.close() # each thread has its own connection
+
+    def handle(self, *args, **options):
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        if options["workers"] == 1:
+            self.work(f"{prefix}:0", options)
+            return
+        names = [f"{prefix}:{n}" for n in range(options["workers"])]
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            futures = [pool.submit(self.work, name, options) for name in names]
+        # A worker stops on an error outside of the jobs it runs (its database going away), a job it was running
+        # is queued again once its lease expires
+        errors = []
+        for name, future in zip(names, futures):
+            try:
+                future.result()
+            except Exception as error:
+                errors.append(f"{name}: {error!r}")
+        if errors:
+            raise CommandError("Workers stopped on errors:\n" + "\n".join(errors))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from invoice.portfolio import seed_portfolio
+
+
+class Command(BaseCommand):
+    help = "Bulk creates a synthetic portfolio of investors, investments, cashcalls and bills, for benchmarks and load tests."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--investors", type=int, default=1000, help="How many investors to create")
+        parser.add_argument("--years", type=int, default=5, help="Investors join over this many years back, and are billed since")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, the same seed gives the same portfolio")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Investors written per transaction")
+
+    def handle(self, *args, **options):
+        counts = seed_portfolio(options["investors"], options["years"], seed=options["seed"], batch_size=options["batch_size"])
+        self.stdout.write("Created {} investors, {} investments, {} cashcalls and {} bills".format(*counts))
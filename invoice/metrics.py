@@ -0,0 +1,119 @@
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from django.db import connection
+
+# Literals and IN lists differ between otherwise identical queries, such as those of an N+1 loop
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r"\bIN \((?:[^()]*)\)")
+
+# Requests are gathered under their route, so metrics stay bounded however many paths clients try:
+# requests resolving to no route share one entry per method, and unknown methods share one too
+UNRESOLVED = "<unresolved>"
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+def fingerprint(sql: str):
+    return IN_LISTS.sub("IN (...)", LITERALS.sub("?", sql))
+
+
+class QueryRecorder:
+    """
+    Records the queries run on the default connection while installed, with their duration.
+    """
+    def __init__(self):
+        self.queries = [] # (sql, seconds)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def sql_ms(self):
+        return sum(seconds for _, seconds in self.queries) * 1000
+
+    @property
+    def duplicates(self):
+        """
+        Fingerprints of queries run more than once, with how many times. Usually a query issued per row.
+        """
+        return {sql: count for sql, count in Counter(fingerprint(sql) for sql, _ in self.queries).items() if count > 1}
+
+
+@contextmanager
+def record_queries():
+    recorder = QueryRecorder()
+    with connection.execute_wrapper(recorder):
+        yield recorder
+
+
+class EndpointMetrics:
+    """
+    Query metrics of the requests served by this process, by endpoint.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint: str, recorder: QueryRecorder, total_ms: float):
+        with self.lock:
+            metrics = self.endpoints.setdefault(endpoint, {
+                "requests": 0, "queries": 0, "max_queries": 0, "sql_ms": 0.0, "total_ms": 0.0, "duplicates": Counter(),
+            })
+            metrics["requests"] += 1
+            metrics["queries"] += recorder.count
+            metrics["max_queries"] = max(metrics["max_queries"], recorder.count)
+            metrics["sql_ms"] += recorder.sql_ms
+            metrics["total_ms"] += total_ms
+            metrics["duplicates"].update(recorder.duplicates)
+
+    def report(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    **metrics,
+                    "sql_ms": round(metrics["sql_ms"], 3),
+                    "total_ms": round(metrics["total_ms"], 3),
+                    "duplicates": dict(metrics["duplicates"].most_common(10)),
+                }
+                for endpoint, metrics in sorted(self.endpoints.items())
+            }
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+ENDPOINT_METRICS = EndpointMetrics()
+
+
+class QueryMetricsMiddleware:
+    """
+    Counts and times the queries of each request, reported in a Server-Timing header and gathered by endpoint for /invoice/_metrics.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - start) * 1000
+        match = request.resolver_match
+        endpoint = f"{request.method if request.method in METHODS else 'OTHER'} {match.view_name if match else UNRESOLVED}"
+        ENDPOINT_METRICS.add(endpoint, recorder, total_ms)
+        response["Server-Timing"] = ", ".join([
+            f'db;dur={recorder.sql_ms:.3f};desc="{recorder.count} queries"',
+            f'dup;desc="{sum(recorder.duplicates.values())} repeated queries"',
+            f"total;dur={total_ms:.3f}",
+        ])
+        return response
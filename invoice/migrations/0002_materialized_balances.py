@@ -0,0 +1,74 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:11
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def compute_balances(apps, schema_editor):
+    Bill = apps.get_model('invoice', 'Bill')
+    CashCall = apps.get_model('invoice', 'CashCall')
+    Investment = apps.get_model('invoice', 'Investment')
+
+    def total(group_by, aggregate, output_field):
+        bills = Bill.objects.filter(**{group_by: OuterRef('pk')}).order_by().values(group_by)
+        return Coalesce(Subquery(bills.annotate(total=aggregate).values('total')), 0, output_field=output_field)
+
+    money = models.DecimalField(max_digits=20, decimal_places=2)
+    CashCall.objects.update(
+        billed_total=total('cashcall', Sum('amount'), money),
+        paid_total=total('cashcall', Sum('amount', filter=Q(fulfilled=True)), money),
+        bill_count=total('cashcall', Count('pk'), models.IntegerField()),
+        validated_count=total('cashcall', Count('pk', filter=Q(validated=True)), models.IntegerField()),
+    )
+    Investment.objects.update(
+        billed_total=total('investment', Sum('amount'), money),
+        paid_total=total('investment', Sum('amount', filter=Q(fulfilled=True)), money),
+        last_instalment_no=total('investment', Max('instalment_no'), models.IntegerField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cashcall',
+            name='bill_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cashcall',
+            name='billed_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='cashcall',
+            name='paid_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='cashcall',
+            name='validated_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='investment',
+            name='billed_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='investment',
+            name='last_instalment_no',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='investment',
+            name='paid_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=20),
+        ),
+        migrations.RunPython(compute_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0002_materialized_balances'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['bill_type', 'frequency', 'date'], name='bill_type_frequency_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['investor', 'bill_type', 'frequency', 'date'], name='bill_investor_type_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['investment', 'bill_type', 'frequency', 'date'], name='bill_investment_type_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['investment', '-instalment_no'], name='bill_investment_instalment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(condition=models.Q(('fulfilled', True)), fields=['investor', 'date'], name='bill_fulfilled_investor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cashcall',
+            index=models.Index(condition=models.Q(('sent', False)), fields=['investor'], name='cashcall_unsent_investor_idx'),
+        ),
+    ]
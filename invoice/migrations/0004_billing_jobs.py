@@ -0,0 +1,36 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0003_billing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('generate', 'generate'), ('validate', 'validate'), ('send', 'send')], max_length=10)),
+                ('params', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('split', 'split'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=10)),
+                ('investor_from', models.IntegerField(blank=True, null=True)),
+                ('investor_to', models.IntegerField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, max_length=100)),
+                ('results', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='invoice.billingjob')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='billingjob',
+            index=models.Index(condition=models.Q(('status', 'queued')), fields=['id'], name='billingjob_queued_idx'),
+        ),
+    ]
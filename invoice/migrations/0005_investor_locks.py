@@ -0,0 +1,22 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0004_billing_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestorLock',
+            fields=[
+                ('investor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='invoice.investor')),
+                ('holder', models.CharField(max_length=32)),
+                ('acquired', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0005_investor_locks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='running', max_length=10)),
+                ('years_back', models.IntegerField()),
+                ('batch_size', models.IntegerField()),
+                ('batches', models.IntegerField(default=0)),
+                ('bills_issued', models.IntegerField(default=0)),
+                ('bills_skipped', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='billing_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='bill',
+            constraint=models.UniqueConstraint(fields=('billing_key',), name='bill_unique_billing_key'),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='billing_run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='invoice.billingrun'),
+        ),
+    ]
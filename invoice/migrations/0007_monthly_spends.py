@@ -0,0 +1,40 @@
+# Generated by Django 4.0.4 on 2026-10-18 20:22
+
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+import django.db.models.deletion
+
+
+def compute_spends(apps, schema_editor):
+    Bill = apps.get_model('invoice', 'Bill')
+    MonthlySpend = apps.get_model('invoice', 'MonthlySpend')
+    spends = Bill.objects.filter(fulfilled=True).annotate(month=TruncMonth('date')).order_by().values('investor', 'month').annotate(spent=Sum('amount'))
+    MonthlySpend.objects.bulk_create(
+        MonthlySpend(investor_id=row['investor'], month=row['month'], fulfilled_amount=row['spent'])
+        for row in spends.iterator() if row['spent']
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0006_billing_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlySpend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('fulfilled_amount', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('investor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='invoice.investor')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='monthlyspend',
+            constraint=models.UniqueConstraint(fields=('investor', 'month'), name='monthlyspend_unique_investor_month'),
+        ),
+        migrations.RunPython(compute_spends, migrations.RunPython.noop),
+    ]
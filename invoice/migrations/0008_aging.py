@@ -0,0 +1,40 @@
+# Generated by Django 4.0.4 on 2026-10-18 21:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0007_monthly_spends'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgingSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('current', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('days_0_30', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('days_31_60', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('days_61_90', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('days_over_90', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cashcall',
+            index=models.Index(condition=models.Q(('billed_total__gt', django.db.models.expressions.CombinedExpression(django.db.models.expressions.F('paid_total'), '+', django.db.models.expressions.RawSQL('0.005', (), output_field=models.DecimalField()))), ('sent', True)), fields=['investor', 'due_date', 'billed_total', 'paid_total'], name='cashcall_owing_idx'),
+        ),
+        migrations.AddField(
+            model_name='agingsnapshot',
+            name='investor',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='invoice.investor'),
+        ),
+        migrations.AddConstraint(
+            model_name='agingsnapshot',
+            constraint=models.UniqueConstraint(fields=('day', 'investor'), name='agingsnapshot_unique_day_investor'),
+        ),
+    ]
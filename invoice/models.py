@@ -1,22 +1,161 @@
 from decimal import Decimal
-from django.db import models
-from datetime import date
+from types import SimpleNamespace
+from django.db import models, transaction
+from datetime import date, timedelta
+from django.db.models import Case, Count, F, Max, Q, Sum, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
 from django.core.validators import MinValueValidator, MaxValueValidator
+from .cache import enabled as caching, invalidate
 
 PRICE_VALIDATOR=[MinValueValidator(Decimal('0.00'))]
 PERCENTAGE_VALIDATOR = [MinValueValidator(0), MaxValueValidator(100)]
+# Decimals are stored as floats on SQLite, so sums compared in SQL are given half a cent of slack
+HALF_CENT = Decimal('0.005')
 
-class Investor(models.Model):
+class MoneyOutputField(models.DecimalField):
+    """
+    Output field for money aggregates, rounds database sums back to whole cents.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_digits", 20)
+        kwargs.setdefault("decimal_places", 2)
+        super().__init__(*args, **kwargs)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return Decimal(value).quantize(Decimal('0.01'))
+
+def money_sum(lookup, **kwargs):
+    """
+    Sum of a money column which is 0 EUR (not NULL) when no rows match.
+    """
+    return Coalesce(Sum(lookup, **kwargs), Value(Decimal('0.00')), output_field=MoneyOutputField())
+
+class TrackedFields(models.Model):
+    """
+    Remembers the values of tracked_fields (attnames) as read from the database and as last saved,
+    so pre_save receivers can tell what a save changes without reading the row back.
+    """
+    tracked_fields = ()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.snapshot()
+        return instance
+
+    def snapshot(self, fields=None):
+        """
+        Takes the tracked values of fields (names or attnames, all by default) as the database now holds them.
+        A snapshot missing a field (deferred when loaded) is dropped, as is one taken only in part before a full one.
+        """
+        loaded = self.__dict__.get("_loaded")
+        if fields is not None:
+            if loaded is None:
+                return
+            attnames = {self._meta.get_field(name).attname for name in fields}
+            loaded.update({name: self.__dict__[name] for name in self.tracked_fields if name in attnames})
+            return
+        self._loaded = {name: self.__dict__[name] for name in self.tracked_fields} if self.__dict__.keys() >= set(self.tracked_fields) else None
+
+    def loaded(self):
+        """
+        The tracked fields as an object with their saved values, None when they are not known.
+        """
+        loaded = self.__dict__.get("_loaded")
+        return None if loaded is None else SimpleNamespace(**loaded)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.snapshot(kwargs.get("update_fields"))
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self.snapshot(fields)
+
+
+class InvestorQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        """
+        Bills the investors whose membership the update toggles, as saving them one at a time does.
+        bulk_update() goes through here too.
+        """
+        if "active_member" not in kwargs:
+            investor_ids = list(self.values_list("pk", flat=True)) if caching() else []
+            rows = super().update(**kwargs)
+            invalidate(investor_ids)
+            return rows
+        from .utils import bill_deactivations, bill_reactivations
+        with transaction.atomic():
+            before = dict(self.values_list("pk", "active_member"))
+            rows = super().update(**kwargs)
+            investors = Investor.objects.in_bulk(list(before))
+            bill_deactivations([investor for pk, investor in investors.items() if before[pk] and not investor.active_member])
+            bill_reactivations([investor for pk, investor in investors.items() if not before[pk] and investor.active_member])
+            invalidate(list(before))
+        return rows
+
+
+class Investor(TrackedFields):
     name = models.CharField(max_length=50)
     email = models.EmailField(unique=True)
     join_date = models.DateField(default=date.today)
     active_member = models.BooleanField()
 
+    tracked_fields = ("active_member",)
+    objects = InvestorQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
 
-class Investment(models.Model):
+class MaterializedBalances(models.Model):
+    """
+    Counters kept up to date from the bill table by invoice.balances, never written by a regular save().
+    """
+    balance_fields = ()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields if not field.primary_key and field.name not in self.balance_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+class InvestmentQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotate the bill totals behind the Investment balances computed afresh from the bill table, in a single query.
+        """
+        return self.annotate(
+            billed_sum = money_sum("bill__amount"),
+            paid_sum = money_sum("bill__amount", filter=Q(bill__fulfilled=True)),
+            instalment_max = Coalesce(Max("bill__instalment_no"), 0),
+        )
+
+    def with_flags(self):
+        """
+        Annotate is_fulfilled from the materialized balances, to filter on.
+        """
+        return self.annotate(
+            is_fulfilled = Case(
+                When(total_amount__lte=F("paid_total") + F("amount_waived") + HALF_CENT, then=Value(True)),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            ),
+        )
+
+
+class Investment(MaterializedBalances):
     name = models.CharField(max_length=50)
     date_created = models.DateField(default=date.today)
     fee_percent = models.DecimalField(max_digits=10, decimal_places=2, validators=PERCENTAGE_VALIDATOR)
@@ -24,14 +163,21 @@ class Investment(models.Model):
     amount_waived = models.DecimalField(max_digits=20, decimal_places=2, default=0, validators=PRICE_VALIDATOR)
     total_instalments = models.IntegerField()
     investor = models.ForeignKey(Investor, on_delete=models.CASCADE)
+    # Materialized from the investment's bills
+    billed_total = models.DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
+    paid_total = models.DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
+    last_instalment_no = models.IntegerField(default=0, editable=False)
+
+    balance_fields = ("billed_total", "paid_total", "last_instalment_no")
+    objects = InvestmentQuerySet.as_manager()
 
     @property
     def amount_paid(self):
-        return sum([bill.amount for bill in Bill.objects.filter(investment=self.pk, fulfilled=True)])
+        return self.paid_total
 
     @property
     def amount_billed(self):
-        return sum([bill.amount for bill in Bill.objects.filter(investment=self.pk)])
+        return self.billed_total
 
     @property
     def amount_left(self):
@@ -47,30 +193,131 @@ class Investment(models.Model):
 
     @property
     def last_instalment(self):
-        bill = Bill.objects.filter(investment=self.pk).order_by("-instalment_no").first()
-        return bill.instalment_no if bill else 0
+        return self.last_instalment_no
 
     def __str__(self):
         return f"{self.name} €{self.amount_paid + self.amount_waived} of €{self.total_amount} paid"
 
 
-class CashCall(models.Model):
+# Sent cashcalls with something left to pay. HALF_CENT is inlined, not passed as a parameter, so SQLite matches queries
+# filtering on it to the partial index with the same condition
+OWING = Q(sent=True, billed_total__gt=F("paid_total") + RawSQL(str(HALF_CENT), (), output_field=models.DecimalField()))
+
+class CashCallQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotate the bill totals behind the CashCall balances computed afresh from the bill table, in a single query.
+        """
+        return self.annotate(
+            billed_sum = money_sum("bill__amount"),
+            paid_sum = money_sum("bill__amount", filter=Q(bill__fulfilled=True)),
+            bill_num = Count("bill"),
+            validated_num = Count("bill", filter=Q(bill__validated=True)),
+        )
+
+    def with_flags(self):
+        """
+        Annotate is_fulfilled and is_validated from the materialized balances, to filter on.
+        """
+        return self.annotate(
+            is_fulfilled = Case(
+                When(billed_total__lte=F("paid_total") + HALF_CENT, then=Value(True)),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            ),
+            is_validated = Case(
+                When(bill_count__gt=0, validated_count=F("bill_count"), then=Value(True)),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            ),
+        )
+
+    def with_summary(self):
+        """
+        with_flags(), with the bills to be listed prefetched.
+        """
+        return self.with_flags().prefetch_related("bill_set")
+
+    def unvalidated(self):
+        """
+        Non-empty cashcalls with bills left to validate.
+        """
+        return self.filter(bill_count__gt=0, validated_count__lt=F("bill_count"))
+
+    def joinable(self, validated: bool):
+        """
+        Unsent cashcalls a bill that is/is not validated can be added to: empty ones, and those as validated.
+        """
+        matching = Q(validated_count=F("bill_count")) if validated else Q(validated_count__lt=F("bill_count"))
+        return self.filter(Q(bill_count=0) | matching, sent=False)
+
+    def owing(self):
+        """
+        Sent cashcalls not fully paid.
+        """
+        return self.filter(OWING)
+
+    def sendable(self):
+        """
+        Unsent cashcalls whose bills are all validated.
+        """
+        return self.filter(sent=False, bill_count__gt=0, validated_count=F("bill_count"))
+
+    def validate_bills(self):
+        """
+        Validates every bill of these cashcalls with two UPDATEs, one of the bills and one of the cashcall counts.
+        """
+        with transaction.atomic():
+            investor_ids = list(self.values_list("investor", flat=True).order_by().distinct()) if caching() else []
+            bills = Bill.objects.filter(cashcall__in=self.values("pk"), validated=False)
+            # Only validated_count depends on validated, so it is set here rather than tracked bill by bill
+            models.QuerySet.update(bills, validated=True)
+            self.filter(validated_count__lt=F("bill_count")).update(validated_count=F("bill_count"))
+            invalidate(investor_ids)
+
+    def mark_sent(self, day: date):
+        """
+        Sends these cashcalls on day, due two months (62 days) later.
+        """
+        investor_ids = list(self.values_list("investor", flat=True).order_by().distinct()) if caching() else []
+        rows = self.update(sent=True, sent_date=day, due_date=day + timedelta(days=62))
+        invalidate(investor_ids)
+        return rows
+
+
+class CashCall(MaterializedBalances):
     sent_date = models.DateField(blank=True, null=True)
     due_date = models.DateField(blank=True, null=True)
     sent = models.BooleanField(default=False)
     investor = models.ForeignKey(Investor, on_delete=models.CASCADE)
+    # Materialized from the cashcall's bills
+    billed_total = models.DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
+    paid_total = models.DecimalField(max_digits=20, decimal_places=2, default=0, editable=False)
+    bill_count = models.IntegerField(default=0, editable=False)
+    validated_count = models.IntegerField(default=0, editable=False)
+
+    balance_fields = ("billed_total", "paid_total", "bill_count", "validated_count")
+    objects = CashCallQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Open cashcalls of an investor, as bills are grouped into them
+            models.Index(fields=["investor"], condition=Q(sent=False), name="cashcall_unsent_investor_idx"),
+            # Aging of what is owed on sent cashcalls, read from the index alone
+            models.Index(fields=["investor", "due_date", "billed_total", "paid_total"], condition=OWING, name="cashcall_owing_idx"),
+        ]
 
     @property
     def total_amount(self):
-        return sum([bill.amount for bill in Bill.objects.filter(cashcall=self.pk)])
-        
+        return self.billed_total
+
     @property
     def amount_paid(self):
-        return sum([bill.amount for bill in Bill.objects.filter(cashcall=self.pk) if bill.fulfilled])
+        return self.paid_total
 
     @property
     def validated(self):
-        return all([bill.validated for bill in Bill.objects.filter(cashcall=self.pk)] or [False])
+        return self.bill_count > 0 and self.validated_count == self.bill_count
 
     @property
     def fulfilled(self):
@@ -78,23 +325,62 @@ class CashCall(models.Model):
 
     @property
     def overdue(self):
+        return self.overdue_on(date.today())
+
+    def overdue_on(self, day: date):
         if self.fulfilled or not self.sent:
             return False
-        return date.today() > self.due_date
-
-    @property
-    def bill_count(self):
-        return Bill.objects.filter(cashcall=self.pk).count()
+        return day > self.due_date
 
     @property
     def bills(self):
-        return Bill.objects.filter(cashcall=self.pk)
+        return self.bill_set.all() # Served from the prefetch cache when with_summary() was used
 
     def __str__(self):
         return f"{self.investor.name} €{self.amount_paid} of €{self.total_amount} paid"
 
 
-class Bill(models.Model):
+class BillQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        from .balances import BalanceChanges
+        objs = super().bulk_create(objs, *args, **kwargs)
+        BalanceChanges.from_bills(objs).save()
+        return objs
+
+    def update(self, **kwargs):
+        """
+        Keeps the cashcall and investment balances in step when balance fields are updated in bulk,
+        and zeroes the bills the update sets to ignored, as saving them one at a time does.
+        bulk_update() goes through here too.
+        """
+        if "ignore" not in kwargs:
+            return self.update_balances(**kwargs)
+        from .balances import BalanceChanges
+        with transaction.atomic():
+            counted = list(self.filter(ignore=False).values_list("pk", flat=True))
+            rows = self.update_balances(**kwargs)
+            for chunk in BalanceChanges.chunks(counted):
+                Bill.objects.filter(pk__in=chunk, ignore=True).exclude(amount=0).update_balances(amount=0)
+        return rows
+
+    def update_balances(self, **kwargs):
+        from .balances import BALANCE_FIELDS, BalanceChanges
+        if not {Bill._meta.get_field(name).attname for name in kwargs} & set(BALANCE_FIELDS):
+            investor_ids = list(self.values_list("investor", flat=True).order_by().distinct()) if caching() else []
+            rows = super().update(**kwargs)
+            invalidate(investor_ids)
+            return rows
+        changes = BalanceChanges()
+        before = {row[0]: row[1:] for row in self.values_list("pk", *BALANCE_FIELDS)}
+        rows = super().update(**kwargs)
+        for chunk in changes.chunks(list(before)):
+            for pk, *after in Bill.objects.filter(pk__in=chunk).values_list("pk", *BALANCE_FIELDS):
+                changes.change(before[pk], tuple(after))
+        changes.save()
+        return rows
+
+
+class Bill(TrackedFields):
     frequency = models.CharField(max_length=10) # Y5 (quinquennial), O1 (oneoff), M2 (bimonthly), D1 (daily)
     bill_type = models.CharField(max_length=50) # INVESTMENT, MEMBERSHIP
     amount = models.DecimalField(max_digits=20, decimal_places=2, validators=PRICE_VALIDATOR)
@@ -107,6 +393,142 @@ class Bill(models.Model):
     # specific to yearly investments
     instalment_no = models.IntegerField(blank=True, null=True)
     investment = models.ForeignKey(Investment, on_delete=models.CASCADE, blank=True, null=True)
-    
+    # specific to bills issued by generate runs, the key is unique to the subscription and period billed
+    billing_run = models.ForeignKey("BillingRun", on_delete=models.SET_NULL, blank=True, null=True)
+    billing_key = models.CharField(max_length=64, blank=True, null=True)
+
+    # The balance fields (invoice.balances.BALANCE_FIELDS), and ignore
+    tracked_fields = ("amount", "fulfilled", "validated", "cashcall_id", "investment_id", "instalment_no", "investor_id", "date", "ignore")
+    objects = BillQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Latest bill of each subscription, as looked up by generate and forecast
+            models.Index(fields=["bill_type", "frequency", "date"], name="bill_type_frequency_date_idx"),
+            models.Index(fields=["investor", "bill_type", "frequency", "date"], name="bill_investor_type_date_idx"),
+            models.Index(fields=["investment", "bill_type", "frequency", "date"], name="bill_investment_type_date_idx"),
+            # Last instalment of an investment
+            models.Index(fields=["investment", "-instalment_no"], name="bill_investment_instalment_idx"),
+            # Spend of an investor over a period
+            models.Index(fields=["investor", "date"], condition=Q(fulfilled=True), name="bill_fulfilled_investor_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["billing_key"], name="bill_unique_billing_key"),
+        ]
+
     def __str__(self):
         return f"{self.investor.name} {self.bill_type} {self.amount}"
+
+
+class MonthlySpend(models.Model):
+    """
+    What an investor paid (fulfilled bills) over a calendar month, kept up to date from the bill table by invoice.balances.
+    """
+    investor = models.ForeignKey(Investor, on_delete=models.CASCADE)
+    month = models.DateField() # first day of the month
+    fulfilled_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["investor", "month"], name="monthlyspend_unique_investor_month"),
+        ]
+
+    def __str__(self):
+        return f"{self.investor_id} spent €{self.fulfilled_amount} in {self.month:%Y-%m}"
+
+
+class AgingSnapshot(models.Model):
+    """
+    What an investor owed on sent cashcalls on a day, by how long past due, as reported by invoice.aging.
+    Taken daily by the aging_report command to keep a history.
+    """
+    day = models.DateField()
+    investor = models.ForeignKey(Investor, on_delete=models.CASCADE, blank=True, null=True) # None for the total of all investors
+    current = models.DecimalField(max_digits=20, decimal_places=2, default=0) # not due yet
+    days_0_30 = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    days_31_60 = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    days_61_90 = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    days_over_90 = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["day", "investor"], name="agingsnapshot_unique_day_investor"),
+        ]
+
+    def __str__(self):
+        return f"{self.investor_id} aging on {self.day}"
+
+
+class BillingRun(models.Model):
+    """
+    A generate run which is not a dry run, and how far it got. Its bills are written a batch at a time.
+    """
+    STATUSES = [("running", "running"), ("done", "done"), ("failed", "failed")]
+
+    status = models.CharField(max_length=10, choices=STATUSES, default="running")
+    years_back = models.IntegerField()
+    batch_size = models.IntegerField()
+    batches = models.IntegerField(default=0) # committed
+    bills_issued = models.IntegerField(default=0)
+    bills_skipped = models.IntegerField(default=0) # issued already by an earlier run
+    error = models.TextField(blank=True)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Billing run {self.id} {self.status}, {self.bills_issued} bills issued"
+
+
+class InvestorLock(models.Model):
+    """
+    Advisory lock on an investor held while bills are generated for them (see billing.lock_investors).
+    """
+    investor = models.OneToOneField(Investor, on_delete=models.CASCADE, primary_key=True)
+    holder = models.CharField(max_length=32)
+    acquired = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.investor_id} locked by {self.holder}"
+
+
+class BillingJob(models.Model):
+    """
+    A generate, validate or send run queued for run_billing_worker.
+    Runs over all investors are split into child jobs, each over a range of investor ids, so workers can share them.
+    """
+    ACTIONS = [("generate", "generate"), ("validate", "validate"), ("send", "send")]
+    STATUSES = [("queued", "queued"), ("split", "split"), ("running", "running"), ("done", "done"), ("failed", "failed")]
+
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    params = models.JSONField(default=dict) # dry_run, years_back
+    status = models.CharField(max_length=10, choices=STATUSES, default="queued")
+    parent = models.ForeignKey("self", on_delete=models.CASCADE, blank=True, null=True, related_name="children")
+    # Investor ids covered, both inclusive, unbounded when null
+    investor_from = models.IntegerField(blank=True, null=True)
+    investor_to = models.IntegerField(blank=True, null=True)
+    worker = models.CharField(max_length=100, blank=True)
+    results = models.TextField(blank=True) # lines the action reported
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    # Renewed by the worker running the job, which is deemed dead once it is older than jobs.LEASE
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0) # times claimed, only the latest attempt records its results
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["id"], condition=Q(status="queued"), name="billingjob_queued_idx"),
+        ]
+
+    @property
+    def investors(self):
+        investors = Investor.objects.all()
+        if self.investor_from is not None:
+            investors = investors.filter(pk__gte=self.investor_from)
+        if self.investor_to is not None:
+            investors = investors.filter(pk__lte=self.investor_to)
+        return investors
+
+    def __str__(self):
+        return f"{self.action} job {self.id} {self.status}"
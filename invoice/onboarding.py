@@ -0,0 +1,70 @@
+from django.db import transaction
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from .billing import BATCH_SIZE
+from .cashcalls import assign_cashcalls
+from .models import Bill, Investment, Investor
+from .utils import bill_new_members, first_instalments
+
+
+def batches(rows: list, batch_size: int):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start+batch_size]
+
+
+def onboard_investors(rows: list, batch_size=BATCH_SIZE):
+    """
+    Creates investors from dicts of their fields with bulk_create, issuing each the settled 0 EUR membership bill
+    creating one issues (see bill_new_members). Investors are written a batch at a time, all in one transaction,
+    with a handful of queries per batch. Returns the investors created.
+    """
+    created = []
+    with transaction.atomic():
+        for batch in batches(rows, batch_size):
+            investors = Investor.objects.bulk_create(Investor(**row) for row in batch)
+            bill_new_members(investors) # creating their bills drops the investors' cached responses
+            created += investors
+    return created
+
+
+def onboard_investments(rows: list, batch_size=BATCH_SIZE):
+    """
+    Creates investments from dicts of their fields (investor given as investor_id) with bulk_create,
+    with the first instalment bills and waivers creating them one at a time issues, grouped into cashcalls alike.
+    Investments are written a batch at a time, all in one transaction, with a handful of queries per batch.
+    Returns the investments created.
+    """
+    created = []
+    with transaction.atomic():
+        for batch in batches(rows, batch_size):
+            investments = [Investment(**row) for row in batch]
+            investors = Investor.objects.in_bulk({investment.investor_id for investment in investments})
+            for investment in investments:
+                investment.investor = investors[investment.investor_id]
+            bills = first_instalments(investments) # sets the waivers, saved with the investments
+            Investment.objects.bulk_create(investments)
+            assign_cashcalls(bills)
+            Bill.objects.bulk_create(bills)
+            created += investments
+    return created
+
+
+class BulkCreateMixin:
+    """
+    Adds POST <list url>/bulk to a viewset, creating a JSON list of rows validated with bulk_serializer_class
+    through its onboard function (a staticmethod) in batches of ?batch_size= rows. Answers with the ids created, in the order given.
+    """
+    bulk_serializer_class = None
+    onboard = None
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        try:
+            batch_size = serializers.IntegerField(min_value=1).run_validation(request.query_params.get("batch_size", BATCH_SIZE))
+        except serializers.ValidationError as error:
+            raise serializers.ValidationError({"batch_size": error.detail})
+        serializer = self.bulk_serializer_class(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        created = self.onboard(serializer.validated_data, batch_size=batch_size)
+        return Response({"created": len(created), "ids": [row.pk for row in created]}, status=status.HTTP_201_CREATED)
@@ -0,0 +1,111 @@
+import random
+from collections import Counter
+from datetime import date, timedelta
+from django.db import models, transaction
+from .cache import invalidate
+from .dates import next_year
+from .fees import from_cents, investment_fee_cents, investment_terms, to_cents
+from .models import CashCall, Investment, Investor, Bill, MonthlySpend
+
+
+def seed_portfolio(investors: int, years: int, seed: int = 0, batch_size: int = 1000, today: date = None):
+    """
+    Bulk creates investors who joined over the last {years} years, with their investments, and the bills and cashcalls
+    the billing endpoints would have issued them so far. Bills are mostly paid, bar those of the last few months.
+    Rows are written batch_size investors at a time with bulk_create, so no per-row signals run, and bills skip balance
+    tracking as the seeder sets the materialized balances and monthly spends itself.
+    Returns the number of (investors, investments, cashcalls, bills) created.
+    """
+    rnd = random.Random(seed)
+    today = today or date.today()
+    created = [0, 0, 0, 0]
+    first = (Investor.objects.order_by("-id").values_list("id", flat=True).first() or 0) + 1
+    for start in range(0, investors, batch_size):
+        with transaction.atomic():
+            batch = [seed_investor(rnd, first + n, years, today) for n in range(start, min(start + batch_size, investors))]
+            new_investors = Investor.objects.bulk_create([investor for investor, _, _ in batch])
+            for investor, investments, cashcalls in batch:
+                for investment in investments:
+                    investment.investor = investor
+                for cashcall in cashcalls:
+                    cashcall.investor = investor
+            new_investments = Investment.objects.bulk_create([investment for _, investments, _ in batch for investment in investments])
+            new_cashcalls = CashCall.objects.bulk_create([cashcall for _, _, cashcalls in batch for cashcall in cashcalls])
+            bills, spends = [], Counter()
+            for investor, _, cashcalls in batch:
+                for cashcall in cashcalls:
+                    for bill in cashcall.seeded_bills:
+                        bill.investor, bill.cashcall = investor, cashcall
+                        bills.append(bill)
+                        if bill.fulfilled:
+                            spends[investor.pk, bill.date.replace(day=1)] += to_cents(bill.amount)
+            models.QuerySet.bulk_create(Bill.objects.all(), bills)
+            MonthlySpend.objects.bulk_create([
+                MonthlySpend(investor_id=investor_id, month=month, fulfilled_amount=from_cents(cents))
+                for (investor_id, month), cents in spends.items() if cents
+            ])
+        for n, rows in enumerate((new_investors, new_investments, new_cashcalls, bills)):
+            created[n] += len(rows)
+    invalidate(everything=True)
+    return tuple(created)
+
+
+def seed_investor(rnd: random.Random, n: int, years: int, today: date):
+    """
+    An unsaved investor with unsaved investments, and cashcalls holding their bills in seeded_bills, one cashcall a billing day.
+    """
+    join_date = today - timedelta(days=rnd.randint(0, 365 * years))
+    investor = Investor(name=f"Investor {n}", email=f"investor{n}@example.com", join_date=join_date, active_member=rnd.random() < 0.9)
+    # The dummy membership bill of a new investor comes in its own cashcall, sent on joining
+    joined = CashCall(sent=True, sent_date=join_date, due_date=join_date + timedelta(days=62))
+    joined.seeded_bills = [Bill(frequency="Y1", bill_type="MEMBERSHIP", amount=0, validated=True, ignore=True, fulfilled=True, date=join_date)]
+    bills_by_day = {}
+    day = next_year(join_date)
+    while day <= today:
+        bills_by_day.setdefault(day, []).append(Bill(frequency="Y1", bill_type="MEMBERSHIP", amount=from_cents(300_000)))
+        day = next_year(day)
+
+    investments = []
+    for _ in range(rnd.choices([0, 1, 2, 3], weights=[2, 5, 2, 1])[0]):
+        investment = Investment(
+            name=f"Startup {rnd.randint(1, 10**6)}",
+            date_created=join_date + timedelta(days=rnd.randint(0, (today - join_date).days)),
+            fee_percent=from_cents(rnd.randint(5, 25) * 100),
+            total_amount=from_cents(rnd.randint(1_000, 500_000) * 100),
+            total_instalments=rnd.randint(1, 8),
+        )
+        terms = investment_terms(investment)
+        billed = waived = 0
+        day = investment.date_created
+        for instalment_no in range(1, investment.total_instalments + 1):
+            not_billed = terms[2] - billed - waived
+            if day > today or not_billed <= 0:
+                break
+            to_pay, to_waive = investment_fee_cents(*terms, instalment_no, not_billed)
+            billed, waived = billed + to_pay, waived + to_waive
+            bill = Bill(frequency="Y1", bill_type="INVESTMENT", amount=from_cents(to_pay), investment=investment, instalment_no=instalment_no, date=day)
+            bills_by_day.setdefault(day, []).append(bill)
+            investment.last_instalment_no = instalment_no
+            day = next_year(day)
+        investment.amount_waived = from_cents(waived)
+        investment.billed_total = from_cents(billed)
+        investments.append(investment)
+
+    cashcalls = [joined]
+    for day, bills in sorted(bills_by_day.items(), key=lambda item: item[0]):
+        settled = (today - day).days > 90 # bills of the last three months are still being validated and paid
+        cashcall = CashCall(sent=settled, sent_date=day if settled else None, due_date=day + timedelta(days=62) if settled else None)
+        for bill in bills:
+            bill.validated = settled
+            bill.fulfilled = settled and rnd.random() < 0.95
+            if bill.fulfilled and bill.investment:
+                bill.investment.paid_total += bill.amount
+        cashcall.seeded_bills = bills
+        cashcalls.append(cashcall)
+
+    for cashcall in cashcalls:
+        cashcall.billed_total = sum(bill.amount for bill in cashcall.seeded_bills)
+        cashcall.paid_total = sum(bill.amount for bill in cashcall.seeded_bills if bill.fulfilled)
+        cashcall.bill_count = len(cashcall.seeded_bills)
+        cashcall.validated_count = sum(bill.validated for bill in cashcall.seeded_bills)
+    return investor, investments, cashcalls
@@ -0,0 +1,154 @@
+import csv
+import io
+import re
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from xml.etree.ElementTree import ParseError, iterparse
+from django.db import transaction
+from .fees import from_cents, to_cents
+from .models import Bill
+
+# Payment references name a cashcall (CC-12) or a single bill (BILL-345) anywhere in the remittance text
+REFERENCE = re.compile(r"\b(CC|BILL)-(\d+)\b", re.IGNORECASE)
+
+
+class UnreadableStatement(Exception):
+    pass
+
+
+class Payment:
+    __slots__ = ("line", "reference", "amount")
+
+    def __init__(self, line: int, reference: str, amount: str):
+        self.line, self.reference, self.amount = line, reference, amount
+
+    def __str__(self):
+        return f"line {self.line}: {self.reference or '(no reference)'} {self.amount} EUR"
+
+
+def read_csv(statement):
+    """
+    Payments of a CSV statement with reference and amount columns (any others are ignored).
+    """
+    rows = csv.DictReader(io.TextIOWrapper(statement, encoding="utf-8-sig", newline=""))
+    for row in rows:
+        row = {key.strip().lower(): value for key, value in row.items() if key}
+        yield Payment(rows.line_num, (row.get("reference") or "").strip(), (row.get("amount") or "").strip())
+
+
+def read_camt(statement):
+    """
+    Credit entries of a CAMT.053/054 style XML statement, parsed incrementally.
+    The reference is taken from the entry's remittance information and end to end id.
+    """
+    entry_no = 0
+    for _, element in iterparse(statement):
+        if element.tag.rsplit("}", 1)[-1] != "Ntry":
+            continue
+        entry_no += 1
+        amount, credit, references = "", True, []
+        for child in element.iter():
+            tag = child.tag.rsplit("}", 1)[-1]
+            if tag == "Amt" and not amount:
+                amount = (child.text or "").strip()
+            elif tag == "CdtDbtInd":
+                credit = (child.text or "").strip() == "CRDT"
+            elif tag in ("Ustrd", "Ref", "EndToEndId") and child.text:
+                references.append(child.text.strip())
+        element.clear()
+        if credit:
+            yield Payment(entry_no, " ".join(references), amount)
+
+
+def read_statement(statement, name: str = ""):
+    """
+    Payments of a binary statement file, CAMT XML if named .xml or starting with "<", CSV otherwise.
+    Raises UnreadableStatement, while the payments are read, on malformed XML or CSV that is not UTF-8.
+    """
+    statement = io.BufferedReader(statement) if not hasattr(statement, "peek") else statement
+    if name.lower().endswith(".xml") or statement.peek(64).lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<"):
+        payments, kind = read_camt(statement), "CAMT XML"
+    else:
+        payments, kind = read_csv(statement), "UTF-8 CSV"
+    try:
+        yield from payments
+    except (ParseError, UnicodeDecodeError, csv.Error) as error:
+        raise UnreadableStatement(f"The statement is not a readable {kind} file: {error}")
+
+
+def reconcile(payments, dry_run=False, chunk_size=2000):
+    """
+    Matches payments to unfulfilled bills and marks the bills paid.
+    A CC- reference must pay what is outstanding on the cashcall, a BILL- reference the bill amount, to the cent.
+    Returns (ids of bills fulfilled, [(payment, reason)] for payments left unmatched).
+
+    Referenced bills are loaded in chunks into in-memory indexes, then fulfilled with one UPDATE per chunk.
+    """
+    referenced, unmatched = [], []
+    wanted = {"CC": set(), "BILL": set()}
+    for payment in payments:
+        match = REFERENCE.search(payment.reference)
+        if not match:
+            unmatched.append((payment, "no CC- or BILL- reference"))
+            continue
+        kind, pk = match.group(1).upper(), int(match.group(2))
+        referenced.append((payment, kind, pk))
+        wanted[kind].add(pk)
+
+    # bill id -> (cashcall id, cents, fulfilled), and cashcall id -> ids of its bills
+    bills, cashcall_bills = {}, defaultdict(list)
+    lookups = [("cashcall__in", sorted(wanted["CC"])), ("pk__in", sorted(wanted["BILL"]))]
+    for lookup, pks in lookups:
+        for start in range(0, len(pks), chunk_size):
+            rows = Bill.objects.filter(**{lookup: pks[start:start+chunk_size]}).values_list("pk", "cashcall_id", "amount", "fulfilled")
+            for pk, cashcall_id, amount, fulfilled in rows:
+                if pk not in bills:
+                    bills[pk] = (cashcall_id, to_cents(amount), fulfilled)
+                    if lookup == "cashcall__in":
+                        cashcall_bills[cashcall_id].append(pk)
+
+    paid = set()
+    for payment, kind, pk in referenced:
+        try:
+            amount = Decimal(payment.amount.replace(",", ""))
+        except InvalidOperation:
+            amount = None
+        if amount is None or not amount.is_finite(): # NaN and Infinity parse, but are no amount of cents
+            unmatched.append((payment, "invalid amount"))
+            continue
+        cents = to_cents(amount)
+        if kind == "CC":
+            if pk not in cashcall_bills:
+                unmatched.append((payment, f"no bills in cashcall {pk}"))
+                continue
+            due = [bill for bill in cashcall_bills[pk] if not bills[bill][2] and bill not in paid]
+        else:
+            if pk not in bills:
+                unmatched.append((payment, f"no bill {pk}"))
+                continue
+            due = [] if bills[pk][2] or pk in paid else [pk]
+        if not due:
+            unmatched.append((payment, f"{'cashcall' if kind == 'CC' else 'bill'} {pk} already paid"))
+            continue
+        outstanding = sum(bills[bill][1] for bill in due)
+        if cents != outstanding:
+            unmatched.append((payment, f"{from_cents(outstanding)} EUR outstanding"))
+            continue
+        paid.update(due)
+
+    if not dry_run:
+        paid_ids = sorted(paid)
+        with transaction.atomic():
+            for start in range(0, len(paid_ids), chunk_size):
+                Bill.objects.filter(pk__in=paid_ids[start:start+chunk_size]).update(fulfilled=True)
+    unmatched.sort(key=lambda item: item[0].line)
+    return paid, unmatched
+
+
+def reconcile_report(paid, unmatched, dry_run=False):
+    """
+    Lines reported by the reconcile action and command.
+    """
+    response = [f"{'[DRY RUN!!] ' if dry_run else ''}Marked {len(paid)} bills fulfilled, {len(unmatched)} payments unmatched"]
+    response += [f"Unmatched {payment} ({reason})" for payment, reason in unmatched]
+    return response
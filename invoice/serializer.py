@@ -1,13 +1,20 @@
+from collections import Counter
 from rest_framework import serializers
-from .models import CashCall, Investment, Investor, Bill
+from .models import BillingRun, CashCall, Investment, Investor, Bill
+
+# Ids or emails looked up per query when a list is checked against a table
+CHECK_CHUNK_SIZE = 500
 
 class BillSerializer(serializers.ModelSerializer):
+    """
+    Relations are given as ids, ?expand= sideloads them (see ExpandMixin).
+    """
     fulfilled = serializers.ReadOnlyField()
 
     class Meta:
         model = Bill
         fields = "__all__"
-        depth = 1
+        read_only_fields = ["billing_key"] # issued by generate runs only, see billing.billing_key()
 
 class CashCallSerializer(serializers.ModelSerializer):
     total_amount = serializers.ReadOnlyField()
@@ -20,10 +27,17 @@ class CashCallSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = CashCall
-        fields = "__all__"
+        # The counters behind the properties above are not given twice
+        exclude = ["billed_total", "paid_total", "validated_count"]
 
     def get_bills(self, cashcall):
-        return BillSerializer(cashcall.bills.all(), many=True).data
+        return BillSerializer(cashcall.bills, many=True).data
+
+class CashCallSummarySerializer(CashCallSerializer):
+    """
+    A cashcall without its bills, as included with the bills listed.
+    """
+    bills = None
 
 class InvestmentSerializer(serializers.ModelSerializer):
     fulfilled = serializers.ReadOnlyField()
@@ -35,9 +49,58 @@ class InvestmentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Investment
-        fields = "__all__"
+        # The counters behind the properties above are not given twice
+        exclude = list(Investment.balance_fields)
 
 class InvestorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Investor
         fields = "__all__"
+
+class BillingRunSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BillingRun
+        fields = "__all__"
+
+class InvestorBulkListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        """
+        Emails must be unique over the list and against the table, checked with a query per chunk instead of one per row.
+        """
+        emails = [row["email"] for row in attrs]
+        repeated = {email for email, count in Counter(emails).items() if count > 1}
+        for start in range(0, len(emails), CHECK_CHUNK_SIZE):
+            repeated.update(Investor.objects.filter(email__in=emails[start:start+CHECK_CHUNK_SIZE]).values_list("email", flat=True))
+        if repeated:
+            raise serializers.ValidationError({"email": [f"investor with this email already exists: {email}" for email in sorted(repeated)]})
+        return attrs
+
+class InvestorBulkSerializer(InvestorSerializer):
+    """
+    Investors as created in bulk by onboard_investors, emails are checked unique for the whole list at once.
+    """
+    class Meta(InvestorSerializer.Meta):
+        list_serializer_class = InvestorBulkListSerializer
+        extra_kwargs = {"email": {"validators": []}}
+
+class InvestmentBulkListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        """
+        Investors must exist, checked with a query per chunk instead of one per row.
+        """
+        investor_ids = sorted({row["investor_id"] for row in attrs})
+        missing = set(investor_ids)
+        for start in range(0, len(investor_ids), CHECK_CHUNK_SIZE):
+            missing.difference_update(Investor.objects.filter(pk__in=investor_ids[start:start+CHECK_CHUNK_SIZE]).values_list("pk", flat=True))
+        if missing:
+            raise serializers.ValidationError({"investor": [f'Invalid pk "{pk}" - object does not exist.' for pk in sorted(missing)]})
+        return attrs
+
+class InvestmentBulkSerializer(InvestmentSerializer):
+    """
+    Investments as created in bulk by onboard_investments, investors are given and checked by id for the whole list at once.
+    """
+    investor = serializers.IntegerField(source="investor_id")
+
+    class Meta(InvestmentSerializer.Meta):
+        list_serializer_class = InvestmentBulkListSerializer
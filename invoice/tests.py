@@ -1,9 +1,38 @@
+import json
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
 from decimal import Decimal
 from datetime import date, timedelta
-from django.test import TestCase
+from io import StringIO
+from collections import defaultdict
+from math import ceil
+from unittest import mock
+from django.db import OperationalError, connection, transaction
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
-from .models import Bill, CashCall, Investment, Investor
-from .utils import get_cashcall, yearly_spend, calc_amount_due_investment, calc_amount_due_membership
+from .models import AgingSnapshot, Bill, BillingJob, BillingRun, CashCall, Investment, Investor, InvestorLock, MonthlySpend
+from .utils import get_cashcall, yearly_spend, yearly_spends, calc_amount_due_investment, calc_amount_due_membership
+from .balances import BalanceChanges, check_balances
+from .cashcalls import assign_cashcalls
+from .dates import shift_years
+from .aging import aging, aging_rows, aging_total, history
+from .billing import BATCH_SIZE, InvestorsLocked, bill_due, catch_up, generate_bills, generate_shard, last_bills, lock_investors, plan_bills
+from .jobs import LEASE, MAX_ATTEMPTS, LeaseLost, attempt, claim, enqueue, finish, heartbeat, reclaim, run as run_job
+from .metrics import ENDPOINT_METRICS, record_queries
+from .portfolio import seed_portfolio
+from .fast import FastListMixin
+from .urls import router
+from .benchmark import benchmark, compare
+from .fees import INVESTMENT_DISCOUNTS, investment_fees_cents, investment_terms, to_cents
 
 dcm = lambda x: Decimal(str(x))
 
@@ -14,6 +43,9 @@ class Test(TestCase):
             "active_member": True,
         }
 
+    def setUp(self):
+        cache.clear() # responses cached by earlier tests are keyed on the same ids
+
     def test_create_investor(self):
         """
         Ensure that endpoint to create investor works.
@@ -262,3 +294,1190 @@ class Test(TestCase):
         self.assertEqual(Investment.objects.last().amount_billed, dcm(8838.74))
         self.assertEqual(Investment.objects.last().amount_waived, dcm(3161.26))
         self.assertEqual(Investment.objects.last().amount_not_billed, dcm(0.0))
+
+    def test_investment_with_totals(self):
+        """
+        Ensure materialized Investment balances match the bill totals,
+        and the investment list costs the same number of queries however many rows.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        for fee_percent in (10, 20, 25):
+            Investment.objects.create(name="Borland", fee_percent=Decimal(fee_percent), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        Bill.objects.filter(bill_type="INVESTMENT").update(fulfilled=True)
+        for investment in Investment.objects.with_totals():
+            self.assertEqual(investment.amount_paid, investment.paid_sum)
+            self.assertEqual(investment.amount_billed, investment.billed_sum)
+            self.assertEqual(investment.last_instalment, investment.instalment_max)
+            self.assertEqual(investment.amount_left, investment.total_amount - investment.amount_waived - investment.paid_sum)
+        with self.assertNumQueries(1):
+            response = self.client.get("/invoice/investment/")
+        self.assertEqual(len(response.json()["results"]), 3)
+        for field in Investment.balance_fields:
+            self.assertNotIn(field, response.json()["results"][0])
+
+        # The created investment is answered with the balances of its first bill
+        response = self.client.post("/invoice/investment/", {"name": "Borland", "fee_percent": "20.00", "total_amount": "12000.00", "total_instalments": 4,
+                                                             "date_created": "2019-05-01", "investor": investor.id})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        investment = Investment.objects.get(pk=response.json()["id"])
+        self.assertEqual(dcm(response.json()["amount_billed"]), investment.amount_billed)
+        self.assertEqual(dcm(response.json()["amount_not_billed"]), investment.amount_not_billed)
+        self.assertEqual(response.json()["last_instalment"], 1)
+        self.assertGreater(investment.amount_billed, 0)
+        self.assertNotIn("billed_total", response.json())
+
+    def test_cashcall_with_summary(self):
+        """
+        Ensure materialized CashCall balances match the bill totals,
+        and the cashcall list costs the same number of queries however many bills.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        for fee_percent in (10, 20, 25):
+            Investment.objects.create(name="Borland", fee_percent=Decimal(fee_percent), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        Bill.objects.filter(bill_type="INVESTMENT").update(validated=True)
+        Bill.objects.filter(bill_type="INVESTMENT").first().delete()
+        for cashcall in CashCall.objects.with_totals():
+            self.assertEqual(cashcall.total_amount, cashcall.billed_sum)
+            self.assertEqual(cashcall.amount_paid, cashcall.paid_sum)
+            self.assertEqual(cashcall.bill_count, cashcall.bill_num)
+            self.assertEqual(cashcall.validated, cashcall.bill_num > 0 and cashcall.validated_num == cashcall.bill_num)
+        with self.assertNumQueries(2):
+            response = self.client.get("/invoice/cashcall/")
+        self.assertEqual([len(cashcall["bills"]) for cashcall in response.json()["results"]], [1, 2])
+
+    def test_materialized_balances(self):
+        """
+        Ensure balances stay in step with bills saved, updated in bulk and deleted, and can be recomputed.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        for fee_percent in (10, 20):
+            Investment.objects.create(name="Borland", fee_percent=Decimal(fee_percent), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        bill = Bill.objects.filter(bill_type="INVESTMENT").first()
+        bill.fulfilled = True
+        bill.amount = dcm(100.5)
+        bill.save()
+        Bill.objects.filter(bill_type="MEMBERSHIP").update(validated=True, fulfilled=True)
+        bills = list(Bill.objects.filter(bill_type="INVESTMENT"))
+        for n, bill in enumerate(bills):
+            bill.instalment_no, bill.cashcall = n + 2, CashCall.objects.first()
+        Bill.objects.bulk_update(bills, ["instalment_no", "cashcall"])
+        self.assertEqual(check_balances(), [])
+        self.assertEqual(Investment.objects.get(pk=bills[1].investment_id).last_instalment, 3)
+        Bill.objects.filter(pk=bills[1].pk).first().delete()
+        self.assertEqual(check_balances(), [])
+        self.assertEqual(Investment.objects.get(pk=bills[1].investment_id).last_instalment, 0)
+        CashCall.objects.update(billed_total=0, bill_count=0)
+        self.assertEqual({mismatch[2] for mismatch in check_balances()}, {"billed_total", "bill_count"})
+        out = StringIO()
+        call_command("recompute_balances", stdout=out)
+        self.assertEqual(check_balances(), [])
+        call_command("recompute_balances", check=True, stdout=out)
+        self.assertIn("Balances match", out.getvalue())
+
+        # Deleting an investor cascades to its bills, whose spends go with its MonthlySpend rows
+        self.assertTrue(MonthlySpend.objects.filter(investor=investor).exists())
+        self.assertEqual(self.client.delete(f"/invoice/investor/{investor.id}/").status_code, status.HTTP_204_NO_CONTENT)
+        connection.check_constraints()
+        self.assertFalse(MonthlySpend.objects.exists())
+        self.assertEqual(check_balances(), [])
+
+    def test_list_filters_and_pagination(self):
+        """
+        Ensure fulfilled/validated/sent filters are applied in the database and lists are paged by id.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        Investment.objects.create(name="Borland 2", fee_percent=Decimal('20'), total_amount=0, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        ids = lambda response: [row["id"] for row in response.json()["results"]]
+        with self.assertNumQueries(1):
+            self.assertEqual(ids(self.client.get("/invoice/investment/?fulfilled=1")), [2])
+        self.assertEqual(ids(self.client.get("/invoice/investment/?fulfilled=False")), [1])
+        self.assertEqual(ids(self.client.get("/invoice/cashcall/?fulfilled=1&validated=1")), [1])
+        self.assertEqual(ids(self.client.get("/invoice/cashcall/?fulfilled=0&sent=0")), [2])
+        self.assertEqual(ids(self.client.get("/invoice/bill/?sent=1&investor_id=1")), [1])
+        self.assertEqual(ids(self.client.get("/invoice/bill/?sent=0&fulfilled=0&validated=0")), [2, 3])
+        self.assertEqual(self.client.get("/invoice/bill/?investor_id=9").status_code, status.HTTP_404_NOT_FOUND)
+        first_page = self.client.get("/invoice/bill/?page_size=2").json()
+        self.assertEqual([bill["id"] for bill in first_page["results"]], [1, 2])
+        self.assertEqual(ids(self.client.get(first_page["next"])), [3])
+
+    def test_generate_bulk_engine(self):
+        """
+        Ensure generating for all investors bills every investor's investments,
+        and costs the same number of queries however many investors are due.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        def add_investor(n):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True, join_date=one_year_back)
+            Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+        for n in range(2):
+            add_investor(n)
+        with CaptureQueriesContext(connection) as two_investors:
+            response = self.client.post("/invoice/generate", {"all": 1}, format="json")
+        self.assertEqual(response.content.decode().count("for yearly investment"), 2)
+        for n in range(2, 6):
+            add_investor(n)
+        with CaptureQueriesContext(connection) as four_investors:
+            response = self.client.post("/invoice/generate", {"all": 1}, format="json")
+        self.assertEqual(response.content.decode().count("for yearly investment"), 4)
+        self.assertEqual(len(two_investors), len(four_investors))
+        self.assertEqual(Bill.objects.filter(date=date.today(), bill_type="INVESTMENT").count(), 6)
+        self.assertEqual(Bill.objects.filter(date=date.today(), bill_type="MEMBERSHIP").count(), 6)
+
+    def test_fee_schedule_batch(self):
+        """
+        Ensure the compiled fee schedule matches the rate tables, and the integer-cent batch calculation
+        agrees to the cent with calc_amount_due_investment.
+        """
+        self.assertEqual(INVESTMENT_DISCOUNTS.discount(date(2019,4,1), 3), dcm(0.2))
+        self.assertEqual(INVESTMENT_DISCOUNTS.discount(date(2019,3,31), 3), dcm(0))
+        self.assertEqual(INVESTMENT_DISCOUNTS.discount(date(1901,4,25), 9), dcm(10))
+        rnd = random.Random(7)
+        investments, instalment_nos, not_billed = [], [], []
+        for _ in range(500):
+            investments.append(Investment(
+                fee_percent=dcm(rnd.randint(0, 3000) / 100),
+                total_amount=dcm(rnd.randint(0, 10**9) / 100),
+                date_created=date(1900,1,1) + timedelta(days=rnd.randint(0, 60_000)),
+            ))
+            instalment_nos.append(rnd.randint(1, 6))
+            not_billed.append(dcm(rnd.randint(0, 10**9) / 100))
+        to_pay, to_waive = investment_fees_cents(map(investment_terms, investments), instalment_nos, map(to_cents, not_billed))
+        for n, investment in enumerate(investments):
+            pay, waive = calc_amount_due_investment(investment, instalment_nos[n], amount_not_billed=not_billed[n])
+            self.assertEqual((to_pay[n], to_waive[n]), (to_cents(pay), to_cents(waive)))
+
+    def test_forecast(self):
+        """
+        Ensure the forecast projects what successive generate runs would bill, without writing anything.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=date(1901,4,25), investor=investor)
+        Bill.objects.filter(bill_type="INVESTMENT").update(date=date(1901,4,25))
+        bill_count = Bill.objects.count()
+        response = self.client.get("/invoice/forecast", {"years": 2, "years_back": 200})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Bill.objects.count(), bill_count)
+        rows = {row["year"]: row for row in response.json()["forecast"]}
+        self.assertEqual([rows[year]["investment"] for year in range(1902, 1907)], ["2280.00", "1800.00", "1200.00", "1200.00", "749.59"])
+        self.assertEqual(sum(dcm(rows[year]["waived"]) for year in range(1902, 1907)), dcm(3120))
+        self.assertEqual(rows[date.today().year + 1]["membership"], "3000.00")
+        self.assertEqual(rows[date.today().year + 2]["membership"], "3000.00")
+        out = StringIO()
+        call_command("forecast", years=2, years_back=200, stdout=out)
+        self.assertIn("1,1906,0.00,749.59,0.00", out.getvalue())
+
+        # Projected as of a leap day, bills of periods starting on Feb 29 fall due on Mar 1
+        leap_investor = Investor.objects.create(name="Harry Guile", email="hguile2@gmail.com", active_member=True, join_date=date(2024,2,29))
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=date(2024,2,29), investor=leap_investor)
+        Bill.objects.filter(investor=leap_investor).update(date=date(2024,2,29))
+        response = self.client.get("/invoice/forecast", {"years": 2, "investor_id": leap_investor.pk, "as_of": "2024-02-29"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = {row["year"]: row for row in response.json()["forecast"]}
+        self.assertEqual(sorted(rows), [2025, 2026])
+        billed = self.client.post("/invoice/generate", {"investor_id": leap_investor.pk, "dry_run": True, "as_of": "2025-03-01"}).content.decode()
+        self.assertIn(f"Billed Harry Guile {rows[2025]['investment']} EUR for yearly investment", billed)
+        self.assertIn(f"Billed Harry Guile {rows[2025]['membership']} EUR for yearly membership", billed)
+
+    def test_export_ledger(self):
+        """
+        Ensure ledger exports stream every matching row as CSV or NDJSON, from the endpoint and the command.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        Bill.objects.filter(bill_type="INVESTMENT").update(date=date(2019,5,1))
+        response = self.client.get("/invoice/export/bill")
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "id,date,bill_type,frequency,amount,investor_id,cashcall_id,investment_id,instalment_no,validated,ignore,fulfilled")
+        self.assertEqual(len(lines), 3)
+        response = self.client.get("/invoice/export/bill", {"format": "ndjson", "date_to": "2020-01-01"})
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(row["bill_type"], row["amount"]) for row in rows], [("INVESTMENT", "1610.96")])
+        self.assertEqual(self.client.get("/invoice/export/bill", {"date_from": "01/05/2019"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get("/invoice/export/ledger").status_code, status.HTTP_404_NOT_FOUND)
+        out = StringIO()
+        call_command("export_ledger", "investment", investor_id=investor.id, stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[1], "1,Borland,1,2019-05-01,20.00,12000.00,4,0.00,1610.96,0.00,1")
+
+    def test_reconcile_payments(self):
+        """
+        Ensure statement payments fulfil the bills or cashcalls they reference when the amounts match, and report the rest.
+        """
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        for fee_percent in (10, 20):
+            Investment.objects.create(name="Borland", fee_percent=Decimal(fee_percent), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        cashcall = Bill.objects.filter(bill_type="INVESTMENT").first().cashcall
+        other_investor = Investor.objects.create(name="Harry Guile 2", email="hguile2@gmail.com", active_member=True)
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=other_investor)
+        bill = Bill.objects.get(investor=other_investor, bill_type="INVESTMENT")
+        statement = SimpleUploadedFile("statement.csv", (
+            "date,reference,amount\n"
+            f"2022-05-01,Payment CC-{cashcall.id},{cashcall.total_amount}\n"
+            f"2022-05-01,CC-{cashcall.id},{cashcall.total_amount}\n"
+            f"2022-05-02,BILL-{bill.id},10.00\n"
+            "2022-05-02,thanks,10.00\n"
+        ).encode())
+        response = self.client.post("/invoice/reconcile", {"statement": statement})
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[0], "Marked 2 bills fulfilled, 3 payments unmatched")
+        self.assertEqual(lines[1], f"Unmatched line 3: CC-{cashcall.id} {cashcall.total_amount} EUR (cashcall {cashcall.id} already paid)")
+        self.assertEqual(lines[2], f"Unmatched line 4: BILL-{bill.id} 10.00 EUR ({bill.amount} EUR outstanding)")
+        self.assertTrue(CashCall.objects.get(pk=cashcall.pk).fulfilled)
+        self.assertFalse(Bill.objects.get(pk=bill.pk).fulfilled)
+        camt = (
+            '<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"><BkToCstmrStmt><Stmt>'
+            f'<Ntry><Amt Ccy="EUR">{bill.amount}</Amt><CdtDbtInd>CRDT</CdtDbtInd><NtryDtls><TxDtls><RmtInf><Ustrd>BILL-{bill.id}</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>'
+            '<Ntry><Amt Ccy="EUR">5.00</Amt><CdtDbtInd>DBIT</CdtDbtInd></Ntry>'
+            '</Stmt></BkToCstmrStmt></Document>'
+        )
+        with tempfile.NamedTemporaryFile(suffix=".xml") as path:
+            path.write(camt.encode())
+            path.flush()
+            out = StringIO()
+            call_command("reconcile_payments", path.name, stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Marked 1 bills fulfilled, 0 payments unmatched")
+        self.assertTrue(Bill.objects.get(pk=bill.pk).fulfilled)
+        self.assertEqual(check_balances(), [])
+
+        # Amounts that are no number of cents are unmatched, and statements that cannot be read are rejected
+        statement = SimpleUploadedFile("statement.csv", (
+            "reference,amount\n"
+            f"BILL-{bill.id},NaN\n"
+            f"BILL-{bill.id},Infinity\n"
+            f"BILL-{bill.id},ten\n"
+        ).encode())
+        response = self.client.post("/invoice/reconcile", {"statement": statement, "dry_run": True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content.decode().count("(invalid amount)"), 3)
+        for name, content in (("statement.xml", camt[:-20].encode()), ("statement.csv", f"reference,amount\nBILL-{bill.id},10\n\xe9t\xe9,5\n".encode("latin-1"))):
+            response = self.client.post("/invoice/reconcile", {"statement": SimpleUploadedFile(name, content)})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, name)
+            self.assertIn("not a readable", response.content.decode())
+        with tempfile.NamedTemporaryFile(suffix=".xml") as path:
+            path.write(b"<Document><Ntry>")
+            path.flush()
+            with self.assertRaises(CommandError):
+                call_command("reconcile_payments", path.name, stdout=StringIO())
+
+    def test_validate_and_send_all(self):
+        """
+        Ensure validating and sending all cashcalls reports each as before, with a fixed number of queries.
+        """
+        for n in range(3):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True)
+            Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+            Investment.objects.create(name="Borland 2", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        unvalidated = list(CashCall.objects.filter(validated_count=0).values_list("id", flat=True))
+        response = self.client.post("/invoice/validate", {"all": 1, "dry_run": True})
+        self.assertEqual(response.content.decode().splitlines()[:2], [f"[DRY RUN!!] Cashcall {unvalidated[0]} successfully validated"] * 2)
+        self.assertEqual(CashCall.objects.unvalidated().count(), 3)
+        with self.assertNumQueries(7): # a select and two updates, within savepoints
+            response = self.client.post("/invoice/validate", {"all": 1})
+        self.assertEqual(response.content.decode().splitlines(), [f"Cashcall {cashcall_id} successfully validated" for cashcall_id in unvalidated for _ in range(2)])
+        self.assertEqual(Bill.objects.filter(validated=False).count(), 0)
+        self.assertEqual(check_balances(), [])
+        self.assertEqual(self.client.post("/invoice/validate", {"all": 1}).content.decode(), "No non-empty unvalidated cashcalls in queue to validate")
+        with self.assertNumQueries(4): # a select and an update, within a savepoint
+            response = self.client.post("/invoice/send", {"all": 1})
+        self.assertEqual(response.content.decode().splitlines()[-1], f"Successfully sent cashcall {unvalidated[-1]} to Harry Guile 2 (hguile2@gmail.com)")
+        self.assertEqual(CashCall.objects.filter(sent=True, due_date=date.today() + timedelta(days=62)).count(), 6)
+        self.assertEqual(self.client.post("/invoice/send", {"all": 1}).content.decode(), "No validated cashcalls in queue to send")
+
+    def test_hot_queries_use_indexes(self):
+        """
+        Ensure the billing hot paths are planned as index searches, not table scans.
+        """
+        investors = Investor.objects.filter(pk=1)
+        day = date(2020,1,1)
+        hot_queries = [
+            (last_bills("MEMBERSHIP", day), ["bill_type_frequency_date_idx", "bill_investor_type_date_idx"]),
+            (last_bills("INVESTMENT", day), ["bill_type_frequency_date_idx", "bill_investment_type_date_idx"]),
+            (last_bills("MEMBERSHIP", day, investors), ["bill_investor_type_date_idx"]),
+            (Bill.objects.filter(investor__in=investors, fulfilled=True, date__gt=day, date__lte=day), ["bill_fulfilled_investor_idx"]),
+            (CashCall.objects.filter(investor=1, sent=False), ["cashcall_unsent_investor_idx"]),
+            (aging_rows(after=1), ["cashcall_owing_idx"]),
+            (Bill.objects.filter(investment=1).order_by("-instalment_no")[:1], ["bill_investment_instalment_idx"]),
+        ]
+        for queryset, indexes in hot_queries:
+            plan = queryset.explain()
+            self.assertNotRegex(plan, r"SCAN (invoice_|U0)", plan)
+            for index in indexes:
+                self.assertIn(f"INDEX {index} ", plan)
+
+    def test_billing_jobs(self):
+        """
+        Ensure background runs are queued, split by investor id ranges, and report what the synchronous actions would.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        for n in range(3):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True, join_date=one_year_back)
+            Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+        expected = self.client.post("/invoice/generate", {"all": 1, "dry_run": True}).content.decode().replace("[DRY RUN!!] ", "").splitlines()
+        response = self.client.post("/invoice/generate", {"all": 1, "background": True})
+        self.assertEqual(response.status_code, 202)
+        job_id = int(response.content.decode().split()[3].rstrip(","))
+        self.assertEqual(self.client.get(f"/invoice/jobs/{job_id}").json()["status"], "queued")
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 0)
+        out = StringIO()
+        call_command("run_billing_worker", once=True, stdout=out)
+        report = self.client.get(f"/invoice/jobs/{job_id}").json()
+        self.assertEqual((report["status"], report["progress"]), ("done", {"finished": 1, "total": 1}))
+        self.assertEqual(report["results"], expected)
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 6)
+
+        validate_job = enqueue("validate", {}, partition_size=2)
+        self.assertEqual([(job.investor_from, job.investor_to) for job in validate_job.children.order_by("id")], [(None, 2), (3, None)])
+        call_command("run_billing_worker", once=True, stdout=out)
+        report = self.client.get(f"/invoice/jobs/{validate_job.id}").json()
+        self.assertEqual((report["status"], report["progress"]), ("done", {"finished": 2, "total": 2}))
+        self.assertEqual(report["counts"]["lines"], 9) # one line per bill of each cashcall
+        self.assertEqual(Bill.objects.filter(validated=False).count(), 0)
+        self.assertEqual(self.client.post("/invoice/send", {"all": 1, "background": True}).status_code, 202)
+        call_command("run_billing_worker", once=True, stdout=out)
+        self.assertEqual(CashCall.objects.filter(sent=False).count(), 0)
+        self.assertEqual(self.client.get("/invoice/jobs/99").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_billing_job_leases(self):
+        """
+        Ensure jobs whose worker died are run again once their lease expires, taking over the investor locks left behind,
+        the dead attempt can no longer record results, and jobs are failed after MAX_ATTEMPTS claims.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        for n in range(3):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True, join_date=one_year_back)
+            Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+        parent = enqueue("generate", {}, partition_size=2)
+        dead = claim("dead worker")
+        InvestorLock.objects.bulk_create([InvestorLock(investor=investor, holder=f"job:{dead.pk}") for investor in dead.investors])
+        out = StringIO()
+        call_command("run_billing_worker", once=True, stdout=out) # runs the other job, the first one's lease is current
+        self.assertEqual(list(parent.children.values_list("status", flat=True).order_by("id")), ["running", "done"])
+        self.assertEqual(reclaim(), 0)
+
+        parent.children.filter(pk=dead.pk).update(heartbeat=dead.heartbeat - LEASE)
+        call_command("run_billing_worker", once=True, stdout=out)
+        rerun = BillingJob.objects.get(pk=dead.pk)
+        self.assertEqual((rerun.status, rerun.attempts), ("done", 2))
+        self.assertEqual(self.client.get(f"/invoice/jobs/{parent.pk}").json()["status"], "done")
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 6)
+        self.assertEqual(InvestorLock.objects.count(), 0)
+        self.assertFalse(finish(dead, status="failed", error="finished late"))
+        self.assertEqual(BillingJob.objects.get(pk=dead.pk).status, "done")
+
+        job = enqueue("send", {}, investor_id=1)
+        claim("dead worker")
+        BillingJob.objects.filter(pk=job.pk).update(attempts=MAX_ATTEMPTS, heartbeat=timezone.now() - LEASE * 2)
+        self.assertEqual(reclaim(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertIn("stopped renewing the lease", job.error)
+
+        with mock.patch("invoice.management.commands.run_billing_worker.claim", side_effect=RuntimeError("database gone")):
+            with self.assertRaisesMessage(CommandError, "database gone"):
+                call_command("run_billing_worker", once=True, workers=2, stdout=out)
+
+    def test_sharded_generate_is_deterministic(self):
+        """
+        Ensure generating in 8 investor shards issues the same bills and cashcalls as a single run, and locked investors are waited for.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        rnd = random.Random(13)
+        for n in range(20):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=rnd.random() > 0.2, join_date=one_year_back)
+            for _ in range(rnd.randint(0, 3)):
+                Investment.objects.create(name="Borland", fee_percent=Decimal(rnd.randint(5, 30)), total_amount=rnd.randint(1, 10**6), total_instalments=rnd.randint(1, 6), date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+
+        def generate(workers):
+            with transaction.atomic():
+                lines = sorted(line for index in range(workers) for line in generate_shard(workers, index))
+                fields = ["investor", "bill_type", "investment", "amount", "instalment_no", "validated", "cashcall__investor", "cashcall__bill_count"]
+                bills = list(Bill.objects.filter(date=date.today()).order_by(*fields).values_list(*fields))
+                fields = ["investor", "sent", "bill_count", "validated_count", "billed_total"]
+                cashcalls = list(CashCall.objects.order_by(*fields).values_list(*fields))
+                transaction.set_rollback(True)
+            return lines, bills, cashcalls
+
+        single = generate(1)
+        self.assertTrue(single[1])
+        self.assertEqual(generate(8), single)
+        out = StringIO()
+        call_command("generate_bills", workers=1, stdout=out)
+        self.assertEqual(sorted(out.getvalue().splitlines()), single[0])
+
+        InvestorLock.objects.create(investor=Investor.objects.first(), holder="another run")
+        with self.assertRaises(InvestorsLocked):
+            with lock_investors(Investor.objects.all(), timeout=timedelta(0)):
+                pass
+        with lock_investors(Investor.objects.exclude(pk=Investor.objects.first().pk), timeout=timedelta(0)):
+            self.assertEqual(InvestorLock.objects.count(), 20)
+        self.assertEqual(InvestorLock.objects.count(), 1)
+
+    def test_billing_runs_resume(self):
+        """
+        Ensure generate runs commit a batch at a time, and a rerun after a failure issues only the bills still due.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        for n in range(3):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True, join_date=one_year_back)
+            Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+        amount_waived = Investment.objects.get(pk=1).amount_waived
+        with mock.patch("invoice.billing.calc_amount_due_investment", side_effect=RuntimeError("pricing down")):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/invoice/generate", {"all": 1, "batch_size": 2}, format="json")
+        failed = BillingRun.objects.get()
+        self.assertEqual((failed.status, failed.batches, failed.bills_issued), ("failed", 1, 2))
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 2)
+        self.assertEqual(Investment.objects.get(pk=1).amount_waived, amount_waived)
+
+        response = self.client.post("/invoice/generate", {"all": 1, "batch_size": 2}, format="json")
+        self.assertEqual(len(response.content.decode().splitlines()), 4)
+        run = BillingRun.objects.latest("id")
+        self.assertEqual((run.status, run.batches, run.bills_issued), ("done", 2, 4))
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 6)
+        self.assertEqual(check_balances(), [])
+
+        # Bills looking due again are skipped on their billing key
+        Bill.objects.filter(date=date.today()).update(date=one_year_back)
+        response = self.client.post("/invoice/generate", {"all": 1}, format="json")
+        self.assertEqual(response.content.decode(), "No bills due, no additional cashcalls generated")
+        self.assertEqual(BillingRun.objects.latest("id").bills_skipped, 6)
+        self.assertEqual(Bill.objects.count(), 12)
+
+        # Batches hold at least a bill, however the run is started
+        runs = BillingRun.objects.count()
+        for batch_size in ("0", "-5", "ten", "2.5"):
+            for background in (False, True):
+                response = self.client.post("/invoice/generate", {"all": 1, "batch_size": batch_size, "background": background})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, batch_size)
+        with self.assertRaises(ValueError):
+            bill_due(None, 2, 0)
+        with self.assertRaises(ValueError):
+            generate_bills(batch_size=-1)
+        with self.assertRaises(CommandError):
+            call_command("catch_up", "--from", one_year_back.isoformat(), "--batch-size", "0")
+        self.assertEqual(BillingRun.objects.count(), runs)
+        self.assertFalse(BillingJob.objects.exists())
+
+        # Billing keys are not for clients to set, nor to claim ahead of a run
+        bill, other = Bill.objects.exclude(billing_key=None).order_by("id")[:2]
+        response = self.client.patch(f"/invoice/bill/{bill.id}/", {"billing_key": other.billing_key}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Bill.objects.get(pk=bill.pk).billing_key, bill.billing_key)
+        new_bill = {"frequency": "O1", "bill_type": "OTHER", "amount": "10.00", "investor": bill.investor_id, "cashcall": bill.cashcall_id, "billing_key": "MEMBERSHIP:1:2099-01-01"}
+        response = self.client.post("/invoice/bill/", new_bill, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(response.json()["billing_key"])
+
+    def test_monthly_spend_rollup(self):
+        """
+        Ensure yearly spend read from the monthly rollup matches the fulfilled bills as they are saved, updated and deleted.
+        """
+        rnd = random.Random(5)
+        investors = [Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True) for n in range(3)]
+        for _ in range(60):
+            investor = rnd.choice(investors)
+            Bill.objects.create(
+                frequency="M1", bill_type="A", amount=dcm(rnd.randint(0, 10**6) / 100), investor=investor, fulfilled=rnd.random() > 0.3,
+                cashcall=get_cashcall(investor, 0), date=date(2020,1,1) + timedelta(days=rnd.randint(0, 1000)),
+            )
+        Bill.objects.filter(pk__in=[4, 5, 6]).update(fulfilled=False)
+        Bill.objects.filter(pk__in=[7, 8]).update(date=date(2021,2,28), fulfilled=True)
+        bill = Bill.objects.get(pk=9)
+        bill.fulfilled, bill.amount = True, dcm(1234.56)
+        bill.save()
+        Bill.objects.get(pk=10).delete()
+        self.assertEqual(check_balances(), [])
+        brute_force = lambda investor, day, years_back: sum(
+            bill.amount for bill in Bill.objects.filter(investor=investor, fulfilled=True)
+            if day.replace(year=day.year - years_back) < bill.date <= day
+        )
+        for day in (date(2020,6,15), date(2021,2,28), date(2021,3,1), date(2022,9,30)):
+            for years_back in (0, 1, 2):
+                spent = yearly_spends(Investor.objects.all(), day, years_back)
+                for investor in investors:
+                    expected = brute_force(investor, day, years_back)
+                    with self.assertNumQueries(1):
+                        self.assertEqual(yearly_spend(investor, day, years_back), expected)
+                    self.assertEqual(spent.get(investor.id, 0), expected)
+
+    def seed_due_portfolio(self, investors):
+        """
+        Creates investors in bulk, each with a membership and an investment bill a year old, so both are due again.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        first = Investor.objects.count()
+        new_investors = Investor.objects.bulk_create([
+            Investor(name=f"Harry Guile {first + n}", email=f"hguile{first + n}@gmail.com", active_member=True, join_date=one_year_back) for n in range(investors)
+        ])
+        investments = Investment.objects.bulk_create([
+            Investment(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+            for investor in new_investors
+        ])
+        cashcalls = CashCall.objects.bulk_create([
+            CashCall(investor=investor, sent=True, sent_date=one_year_back, due_date=one_year_back + timedelta(days=62)) for investor in new_investors
+        ])
+        Bill.objects.bulk_create([
+            bill for investor, investment, cashcall in zip(new_investors, investments, cashcalls) for bill in (
+                Bill(frequency="Y1", bill_type="MEMBERSHIP", amount=0, investor=investor, validated=True, ignore=True, fulfilled=True, cashcall=cashcall, date=one_year_back),
+                Bill(frequency="Y1", bill_type="INVESTMENT", amount=1000, investor=investor, validated=True, fulfilled=True, cashcall=cashcall, date=one_year_back, investment=investment, instalment_no=1),
+            )
+        ])
+
+    def test_query_budgets(self):
+        """
+        Ensure no endpoint runs more queries with 1000 rows than with 10, and generate only adds the statements
+        of writes split in batches and chunks, never a query per row. Requests report their queries in a Server-Timing header.
+        """
+        def query_counts(rows):
+            counts = {}
+            with transaction.atomic():
+                self.seed_due_portfolio(rows)
+                ids = {name: model.objects.order_by("id").values_list("id", flat=True).last() for name, model in [
+                    ("investor", Investor), ("cashcall", CashCall), ("investment", Investment), ("bill", Bill),
+                ]}
+                requests = [("get", "/invoice/", {})]
+                for name, pk in ids.items():
+                    requests += [("get", f"/invoice/{name}/", {}), ("get", f"/invoice/{name}/{pk}/", {})]
+                requests += [("post", "/invoice/generate", {"all": 1}), ("post", "/invoice/validate", {"all": 1}), ("post", "/invoice/send", {"all": 1})]
+                for method, url, data in requests:
+                    with record_queries() as recorder:
+                        response = getattr(self.client, method)(url, data)
+                    self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+                    self.assertIn(f'desc="{recorder.count} queries"', response["Server-Timing"])
+                    if method == "get":
+                        self.assertEqual(recorder.duplicates, {}, url)
+                    counts[f"{method} {url}".replace(f"/{ids.get(url.split('/')[2], 0)}/", "/<id>/")] = recorder.count
+                self.assertEqual(CashCall.objects.filter(sent=False).count(), 0)
+                transaction.set_rollback(True)
+            return counts
+
+        def write_chunks(rows):
+            # generate issues 2 bills an investor, in batches of BATCH_SIZE, as INSERTs of as many bills as the database takes,
+            # and moves the balances of an investment and a cashcall an investor in UPDATEs of BalanceChanges.chunk_size rows
+            bills = 2 * rows
+            insert_size = connection.ops.bulk_batch_size(Bill._meta.concrete_fields, [None] * bills)
+            return ceil(bills / BATCH_SIZE) + ceil(bills / insert_size) + ceil(rows / BalanceChanges.chunk_size)
+
+        ENDPOINT_METRICS.reset()
+        budgets = query_counts(10)
+        for rows in (100, 1000):
+            counts = query_counts(rows)
+            for request, count in counts.items():
+                if request == "post /invoice/generate":
+                    # A chunk of bills comes with the cashcalls it opens, in at most as many statements again
+                    self.assertLessEqual(count - budgets[request], 2 * (write_chunks(rows) - write_chunks(10)), request)
+                else:
+                    self.assertEqual(count, budgets[request], request)
+        metrics = self.client.get("/invoice/_metrics").json()
+        self.assertEqual(metrics["GET bill-list"]["requests"], 3)
+        self.assertEqual(metrics["GET bill-list"]["max_queries"], 1)
+        self.assertEqual(metrics["POST generate"]["requests"], 3)
+        for n in range(3):
+            self.assertEqual(self.client.get(f"/wp-admin/{n}.php").status_code, status.HTTP_404_NOT_FOUND)
+        self.client.generic("PROPFIND", "/invoice/bill/")
+        metrics = self.client.get("/invoice/_metrics").json()
+        self.assertEqual(metrics["GET <unresolved>"]["requests"], 3)
+        self.assertEqual(metrics["OTHER bill-list"]["requests"], 1)
+        self.assertFalse([endpoint for endpoint in metrics if "wp-admin" in endpoint])
+
+    def test_seed_portfolio(self):
+        """
+        Ensure seeded portfolios are the same for a seed, keep their balances and spends in step without signals,
+        and leave a year of bills due when seeded as of a year ago.
+        """
+        one_year_back = date.today() - timedelta(days=365)
+        investors, last_bill = Investor.objects.count(), Bill.objects.order_by("id").values_list("id", flat=True).last() or 0
+        seeded = lambda: list(Bill.objects.filter(pk__gt=last_bill).order_by("id").values_list("amount", "date", "fulfilled", "validated"))
+        with transaction.atomic():
+            counts = seed_portfolio(50, 3, seed=1, batch_size=20, today=one_year_back)
+            bills = seeded()
+            transaction.set_rollback(True)
+        self.assertEqual(counts, seed_portfolio(50, 3, seed=1, batch_size=20, today=one_year_back))
+        self.assertEqual(counts[0], 50)
+        self.assertEqual(counts[3], len(bills))
+        self.assertEqual(bills, seeded())
+        self.assertEqual(check_balances(), [])
+        self.assertEqual(Investor.objects.filter(bill__ignore=True).distinct().count(), investors + 50)
+
+        response = self.client.post("/invoice/generate", {"all": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(Bill.objects.filter(billing_run__isnull=False).count(), 0)
+        self.assertEqual(check_balances(), [])
+
+    def test_benchmark(self):
+        """
+        Ensure the benchmark times every case at each scale, leaves no rows behind, and compares medians with a threshold.
+        """
+        bills = Bill.objects.count()
+        results = benchmark(scales=(5, 10), years=2, repeat=2)
+        self.assertEqual(Bill.objects.count(), bills)
+        self.assertEqual(list(results), ["5", "10"])
+        self.assertIn("POST generate all", results["10"])
+        self.assertTrue(all(timings["min_ms"] <= timings["median_ms"] for cases in results.values() for timings in cases.values()))
+
+        baseline = {"10": {"GET bill list": {"median_ms": 10.0}, "POST send all": {"median_ms": 0.2}}}
+        slower = {"10": {"GET bill list": {"median_ms": 12.5}, "POST send all": {"median_ms": 0.9}, "fees investment": {"median_ms": 5.0}}}
+        self.assertEqual(compare(slower, baseline, threshold=0.2), [("10", "GET bill list", 10.0, 12.5)])
+        self.assertEqual(compare(slower, baseline, threshold=0.3), [])
+
+    def test_cached_responses(self):
+        """
+        Ensure list and detail responses are served from a cache shared between processes, answer If-None-Match with a 304 without queries,
+        and are dropped once a bill, cashcall or investment of their investor changes, however it is written. Nothing is cached in local memory.
+        """
+        investors = [Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True) for n in range(2)]
+        self.assertNotIn("X-Cache", self.client.get("/invoice/investor/"))
+        # Nor are the investors written looked up
+        with self.assertNumQueries(7): # the UPDATEs, validate_bills() in a savepoint
+            Investor.objects.filter(pk=investors[0].pk).update(name="Harry Guile")
+            Bill.objects.filter(investor=investors[0]).update(frequency="Y2")
+            CashCall.objects.filter(investor=investors[0]).validate_bills()
+            CashCall.objects.filter(investor=investors[0]).mark_sent(date.today())
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory}}):
+                for investor in investors:
+                    Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+                first, other = (f"/invoice/cashcall/?investor_id={investor.id}" for investor in investors)
+
+                response = self.client.get(first)
+                self.assertEqual(response["X-Cache"], "miss")
+                with self.assertNumQueries(0):
+                    cached = self.client.get(first)
+                    self.assertEqual(self.client.get(first, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual((cached["X-Cache"], cached["ETag"], cached.content), ("hit", response["ETag"], response.content))
+                self.assertEqual(self.client.get(other)["X-Cache"], "miss")
+
+                bill = Bill.objects.get(investor=investors[0], bill_type="INVESTMENT")
+                self.client.patch(f"/invoice/bill/{bill.id}/", {"amount": 300}, content_type="application/json")
+                response = self.client.get(first, HTTP_IF_NONE_MATCH=response["ETag"])
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(sum(Decimal(cashcall["total_amount"]) for cashcall in response.json()["results"]), 300)
+                self.assertEqual(self.client.get(other)["X-Cache"], "hit")
+
+                writes = [
+                    lambda: self.client.post("/invoice/validate", {"all": 1}),
+                    lambda: self.client.post("/invoice/send", {"all": 1}),
+                    lambda: Bill.objects.filter(pk=bill.pk).update(fulfilled=True),
+                    lambda: Bill.objects.filter(pk=bill.pk).update(ignore=True),
+                    lambda: Investment.objects.filter(investor=investors[0]).first().save(),
+                    lambda: self.client.patch(f"/invoice/bill/{bill.id}/", {"frequency": "Y2"}, content_type="application/json"),
+                ]
+                for write in writes:
+                    self.assertEqual(self.client.get(first)["X-Cache"], "hit")
+                    write()
+                    self.assertEqual(self.client.get(first)["X-Cache"], "miss")
+                    self.assertEqual(self.client.get(f"/invoice/investor/{investors[0].id}/")["X-Cache"], "miss")
+                self.assertEqual(self.client.get(f"/invoice/bill/{bill.id}/").json()["cashcall"], bill.cashcall_id)
+                # Saves changing no balance field drop the responses too
+                bills = f"/invoice/bill/?investor_id={investors[0].id}"
+                self.assertEqual(self.client.get(bills)["X-Cache"], "miss")
+                self.assertEqual(self.client.get(bills)["X-Cache"], "hit")
+                self.client.patch(f"/invoice/bill/{bill.id}/", {"frequency": "Y3"}, content_type="application/json")
+                response = self.client.get(bills)
+                self.assertEqual(response["X-Cache"], "miss")
+                self.assertIn("Y3", [row["frequency"] for row in response.json()["results"]])
+                self.assertEqual(self.client.get(f"/invoice/bill/{bill.id}/?expand=cashcall").json()["cashcall"]["sent"], True)
+
+                # Responses cached by other connections before the commit are dropped again once it commits
+                with self.captureOnCommitCallbacks() as callbacks:
+                    with transaction.atomic():
+                        Bill.objects.filter(pk=bill.pk).update(fulfilled=False)
+                self.assertEqual(len(callbacks), 1)
+                self.client.get(first)
+                callbacks[0]()
+                self.assertEqual(self.client.get(first)["X-Cache"], "miss")
+
+    def test_fast_lists(self):
+        """
+        Ensure ?format=fast and the fast media type list the same JSON as the serializers, in fewer queries.
+        """
+        investors = [Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True) for n in range(3)]
+        for n, investor in enumerate(investors):
+            Investment.objects.create(name="Borland", fee_percent=Decimal(10 + n), total_amount=12_345, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        Bill.objects.filter(bill_type="INVESTMENT").update(date=date.today().replace(year=date.today().year - 1))
+        self.client.post("/invoice/generate", {"all": 1})
+        self.client.post("/invoice/validate", {"cashcall_id": CashCall.objects.order_by("id").last().id})
+
+        # Rows with empty and odd values: an inactive member, a bill without investment, amounts with fewer places
+        Investor.objects.filter(pk=investors[2].pk).update(active_member=False)
+        Bill.objects.create(frequency="O1", bill_type="OTHER", amount=dcm(7.5), investor=investors[0], cashcall=get_cashcall(investors[0], 0), date=date(2024,2,29))
+        # Every list endpoint serving fast lists, whole and paged
+        fast_lists = [f"/invoice/{prefix}/" for prefix, viewset, _ in router.registry if issubclass(viewset, FastListMixin)]
+        self.assertEqual(len(fast_lists), 4)
+        urls = [*fast_lists, *(f"{url}?page_size=2" for url in fast_lists), f"/invoice/cashcall/?investor_id={investors[1].id}"]
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                expected = self.client.get(url).json()
+            cache.clear()
+            with CaptureQueriesContext(connection) as fast_queries:
+                response = self.client.get(url + ("&" if "?" in url else "?") + "format=fast")
+            self.assertEqual(response["Content-Type"], "application/vnd.invoicer.fast+json")
+            fast = json.loads(response.content)
+            self.assertEqual(fast["results"], expected["results"], url)
+            self.assertEqual(fast["next"] and fast["next"].replace("format=fast&", "").replace("&format=fast", ""), expected["next"], url) # links keep format=fast
+            self.assertLessEqual(len(fast_queries), len(queries), url)
+            cache.clear()
+            self.assertEqual(json.loads(self.client.get(url, HTTP_ACCEPT="application/vnd.invoicer.fast+json").content), expected, url)
+        with self.assertNumQueries(2):
+            self.client.get("/invoice/cashcall/?format=fast")
+        self.assertEqual(json.loads(self.client.get(f"/invoice/bill/{Bill.objects.last().id}/?format=fast").content)["id"], Bill.objects.last().id)
+
+    def test_bill_expand(self):
+        """
+        Ensure bills give their relations as ids, and ?expand= sideloads each related object once per page
+        in a constant number of queries, or nests it in a bill's detail.
+        """
+        investors = [Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True) for n in range(2)]
+        for investor in investors:
+            for fee_percent in (10, 20, 25):
+                Investment.objects.create(name="Borland", fee_percent=Decimal(fee_percent), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        bill = Bill.objects.order_by("id").first()
+        response = self.client.get("/invoice/bill/").json()
+        self.assertNotIn("included", response)
+        self.assertEqual(response["results"][0]["investor"], bill.investor_id)
+        self.assertEqual(response["results"][0]["investment"], bill.investment_id)
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/invoice/bill/?expand=investor,cashcall,investment,billing_run").json()
+        self.assertEqual([row["investor"] for row in response["results"]], list(Bill.objects.order_by("id").values_list("investor", flat=True)))
+        included = response["included"]
+        self.assertEqual([investor["id"] for investor in included["investor"]], [investor.id for investor in investors])
+        self.assertEqual(sorted(cashcall["id"] for cashcall in included["cashcall"]), list(CashCall.objects.order_by("id").values_list("id", flat=True)))
+        self.assertNotIn("bills", included["cashcall"][0])
+        self.assertEqual(len(included["investment"]), 6)
+        self.assertEqual(Decimal(str(included["investment"][0]["amount_not_billed"])), Investment.objects.get(pk=included["investment"][0]["id"]).amount_not_billed)
+        self.assertEqual(included["billing_run"], [])
+
+        cache.clear()
+        self.assertEqual(self.client.get("/invoice/bill/?expand=investor&page_size=2").json()["included"]["investor"][0]["name"], "Harry Guile 0")
+        self.assertEqual(set(self.client.get(f"/invoice/bill/?expand=investor&investor_id={investors[1].id}&format=fast").json()["included"]), {"investor"})
+        self.assertEqual(self.client.get(f"/invoice/bill/{bill.id}/?expand=investor").json()["investor"]["email"], "hguile0@gmail.com")
+        self.assertEqual(self.client.get("/invoice/bill/?expand=owner").status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_assign_cashcalls(self):
+        """
+        Ensure a batch of bills is grouped into cashcalls as get_cashcall groups them one by one,
+        in the same number of queries however many bills and investors.
+        """
+        investors = [Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True) for n in range(4)]
+        get_cashcall(investors[1], 1)
+        Bill.objects.create(frequency="Y1", bill_type="MEMBERSHIP", amount=100, investor=investors[2], validated=True, cashcall=get_cashcall(investors[2], 1), date=date.today())
+        Bill.objects.create(frequency="Y1", bill_type="MEMBERSHIP", amount=100, investor=investors[3], cashcall=get_cashcall(investors[3], 0), date=date.today())
+        rnd = random.Random(4)
+        bills = lambda count: [
+            Bill(frequency="Y1", bill_type="MEMBERSHIP", amount=100, investor=investor, validated=validated, date=date.today())
+            for investor, validated in ((rnd.choice(investors), rnd.random() < 0.3) for _ in range(count))
+        ]
+
+        batch = bills(40)
+        existing = set(CashCall.objects.values_list("id", flat=True))
+        sid = transaction.savepoint()
+        expected = []
+        for bill in batch:
+            bill.cashcall = get_cashcall(bill.investor, bill.validated)
+            bill.save()
+            expected.append(bill.cashcall_id)
+        transaction.savepoint_rollback(sid)
+        for bill in batch:
+            bill.pk = bill.cashcall = None
+        with self.assertNumQueries(2):
+            new = assign_cashcalls(batch)
+        self.assertEqual([bill.cashcall.id for bill in batch], expected)
+        self.assertEqual({cashcall.id for cashcall in new}, set(expected) - existing)
+        Bill.objects.bulk_create(batch)
+        check_balances()
+
+        with self.assertNumQueries(1):
+            assign_cashcalls(bills(200))
+
+        # A cashcall sent while a run is between batches takes no bills of the later batches
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True, join_date=one_year_back)
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+        Bill.objects.filter(investor=investor).update(date=one_year_back)
+
+        def interleaved(*args):
+            for n, planned in enumerate(plan_bills(*args)):
+                if n == 1: # the first batch is written
+                    self.client.post("/invoice/validate", {"all": 1})
+                    self.assertIn("Successfully sent", self.client.post("/invoice/send", {"all": 1}).content.decode())
+                yield planned
+        with mock.patch("invoice.billing.plan_bills", interleaved):
+            self.assertEqual(len(generate_bills(Investor.objects.filter(pk=investor.pk), batch_size=1)), 2)
+        first, second = Bill.objects.filter(investor=investor, date=date.today()).select_related("cashcall").order_by("id")
+        self.assertTrue(first.cashcall.sent)
+        self.assertFalse(second.cashcall.sent)
+        self.assertFalse(Bill.objects.filter(cashcall__sent=True, validated=False).exists())
+        self.assertEqual(check_balances(), [])
+
+    def test_tracked_saves(self):
+        """
+        Ensure saving a loaded investor or bill does not read it back, updates and bulk updates toggling membership or ignore
+        have the side effects of saves, and fixtures load with their balances.
+        """
+        investors = [Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True) for n in range(3)]
+        investor = Investor.objects.get(pk=investors[0].pk)
+        investor.name = "Harry Guile Jr"
+        with self.assertNumQueries(1):
+            investor.save()
+        bill = Bill.objects.get(investor=investor)
+        bill.date -= timedelta(days=1)
+        with CaptureQueriesContext(connection) as queries:
+            bill.save()
+        self.assertFalse([query for query in queries if query["sql"].startswith('SELECT "invoice_bill"')])
+        Investment.objects.create(name="Borland", fee_percent=Decimal(10), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1), investor=investor)
+        bill = Bill.objects.get(investment__isnull=False)
+        bill.ignore = True
+        bill.save()
+        self.assertEqual(Bill.objects.get(pk=bill.pk).amount, 0)
+        bill = Bill.objects.only("id", "ignore").get(pk=bill.pk) # deferred, read back
+        bill.amount, bill.ignore = 100, False
+        bill.save()
+        self.assertEqual(Bill.objects.get(pk=bill.pk).amount, 100)
+        self.assertEqual(check_balances(), [])
+
+        Bill.objects.filter(pk=bill.pk).update(ignore=True)
+        self.assertEqual(Bill.objects.get(pk=bill.pk).amount, 0)
+        bill.amount, bill.ignore = 100, False
+        Bill.objects.bulk_update([bill], ["amount", "ignore"])
+        bill.ignore = True
+        Bill.objects.bulk_update([bill], ["ignore"])
+        self.assertEqual(Bill.objects.get(pk=bill.pk).amount, 0)
+        self.assertEqual(check_balances(), [])
+
+        Bill.objects.filter(bill_type="MEMBERSHIP").update(date=date.today() - timedelta(days=73))
+        Investor.objects.filter(pk__in=[investors[0].pk, investors[1].pk]).update(active_member=False)
+        self.assertEqual(Bill.objects.filter(bill_type="MEMBERSHIP", ignore=False).count(), 2)
+        pro_rata = calc_amount_due_membership(investor=investors[0], pro_rata_days=73, spent=0)
+        self.assertEqual(Bill.objects.filter(bill_type="MEMBERSHIP", ignore=False).first().amount, pro_rata.quantize(Decimal("0.01")))
+        investors[0].active_member, investors[1].active_member = False, True
+        Investor.objects.bulk_update(investors, ["active_member"])
+        self.assertEqual(Bill.objects.filter(bill_type="MEMBERSHIP", investor=investors[0]).count(), 2)
+        self.assertEqual(Bill.objects.filter(bill_type="MEMBERSHIP", investor=investors[1], amount=0, date=date.today()).count(), 1)
+        self.assertEqual(check_balances(), [])
+
+        Investor.objects.all().delete()
+        fixture = Path(__file__).resolve().parent.parent / "fixtures" / "mydata.json"
+        # Its contenttypes and permissions are those migrate creates
+        call_command("loaddata", fixture, exclude=["auth", "contenttypes"], verbosity=0)
+        self.assertEqual(Bill.objects.count(), 20)
+        self.assertEqual(CashCall.objects.get(pk=2).bill_count, 19)
+        self.assertEqual(check_balances(), [])
+        # Only the balances of what is loaded are recomputed
+        investment = Investment.objects.create(name="Borland", fee_percent=Decimal(10), total_amount=12_000, total_instalments=4, date_created=date(2019,5,1),
+                                               investor=Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True))
+        Investment.objects.update(paid_total=1)
+        call_command("loaddata", fixture, exclude=["auth", "contenttypes"], verbosity=0)
+        self.assertEqual([mismatch[:3] for mismatch in check_balances()], [("Investment", investment.pk, "paid_total")])
+
+    def test_catch_up(self):
+        """
+        Ensure catching up issues in one run the bills and waivers generate issues running every day of the period,
+        and actions bill and send as of the day given.
+        """
+        start = date.today().replace(year=date.today().year - 3, month=1, day=10)
+        for n in range(4):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=n != 3, join_date=start)
+            Investment.objects.create(name="Borland", fee_percent=Decimal(10 + n), total_amount=40_000 * (n + 1), total_instalments=3 + n, date_created=start + timedelta(days=40 * n), investor=investor)
+            Bill.objects.filter(investor=investor).update(date=start + timedelta(days=40 * n))
+        # Paid enough over the year before their next membership bill to have it waived
+        Bill.objects.create(frequency="O1", bill_type="OTHER", amount=60_000, investor=Investor.objects.get(pk=2), fulfilled=True, cashcall=get_cashcall(Investor.objects.get(pk=2), 0), date=start + timedelta(days=200))
+        date_from, date_to = start + timedelta(days=300), date.today()
+        bills = lambda: sorted(Bill.objects.filter(date__gte=start + timedelta(days=300)).values_list("bill_type", "investor", "investment", "date", "amount", "instalment_no", "ignore"))
+        waived = lambda: list(Investment.objects.order_by("id").values_list("amount_waived", flat=True))
+
+        sid = transaction.savepoint()
+        first_bills = {row["last_date"] for bill_type in ("MEMBERSHIP", "INVESTMENT") for row in last_bills(bill_type, start - timedelta(days=1))}
+        # generate only has bills to issue on the day a period starts, or the first day of the period caught up
+        days = sorted({date_from} | {day.replace(year=year) for day in first_bills for year in range(day.year + 1, date_to.year + 1)})
+        for day in days:
+            if date_from <= day <= date_to:
+                self.assertEqual(self.client.post("/invoice/generate", {"all": 1, "as_of": day.isoformat()}).status_code, status.HTTP_200_OK)
+        expected_bills, expected_waived = bills(), waived()
+        transaction.savepoint_rollback(sid)
+
+        self.assertEqual(len(catch_up(date_from, date_to, dry_run=True)), len(expected_bills))
+        self.assertEqual(Bill.objects.filter(date__gte=date_from).count(), 0)
+        with self.assertNumQueries(26): # in one batch, however many periods are caught up
+            lines = catch_up(date_from, date_to)
+        self.assertEqual(len(lines), len(expected_bills))
+        self.assertEqual(bills(), expected_bills)
+        self.assertEqual(waived(), expected_waived)
+        self.assertIn(Decimal(0), [amount for bill_type, investor, *_, amount, _, ignore in expected_bills if bill_type == "MEMBERSHIP" and investor == 2])
+        self.assertEqual(check_balances(), [])
+        self.assertEqual(catch_up(date_from, date_to), [])
+        out = StringIO()
+        call_command("catch_up", "--from", date_from.isoformat(), "--to", date_to.isoformat(), stdout=out)
+        self.assertEqual(out.getvalue().strip(), "No bills due, no additional cashcalls generated")
+        with self.assertRaises(ValueError):
+            catch_up(date_to, date_from)
+
+        self.client.post("/invoice/validate", {"all": 1})
+        sent_on = date_to - timedelta(days=90)
+        self.client.post("/invoice/send", {"all": 1, "as_of": sent_on.isoformat()})
+        cashcall = CashCall.objects.filter(sent_date=sent_on).first()
+        self.assertEqual(cashcall.due_date, sent_on + timedelta(days=62))
+        self.assertTrue(cashcall.overdue)
+        self.assertFalse(cashcall.overdue_on(sent_on))
+        self.assertEqual(self.client.post("/invoice/send", {"all": 1, "as_of": "yesterday"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_leap_days(self):
+        """
+        Ensure runs as of, or catching up from, Feb 29 bill as on other days, a period starting on Feb 29 falling due on Mar 1 in other years.
+        """
+        self.assertEqual(shift_years(date(2024,2,29), 1), date(2025,3,1))
+        self.assertEqual(shift_years(date(2024,2,29), -2), date(2022,3,1))
+        self.assertEqual(shift_years(date(2024,2,29), 4), date(2028,2,29))
+        self.assertEqual(shift_years(date(2025,3,1), -1), date(2024,3,1))
+        leap_day = date(2024,2,29)
+        investor = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True, join_date=leap_day)
+        Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=leap_day, investor=investor)
+        Bill.objects.filter(investor=investor).update(date=leap_day)
+
+        self.assertEqual(generate_bills(dry_run=True, as_of=date(2025,2,28)), [])
+        self.assertEqual(len(generate_bills(dry_run=True, as_of=date(2025,3,1))), 2)
+        out = StringIO()
+        call_command("generate_bills", dry_run=True, as_of=date(2028,2,29), years_back=5, stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+        call_command("catch_up", "--from", leap_day.isoformat(), "--to", "2028-02-29", stdout=out)
+        self.assertEqual(sorted(set(Bill.objects.filter(date__gt=leap_day).values_list("date", flat=True))), [date(2025,3,1), date(2026,3,1), date(2027,3,1)])
+        self.assertEqual(yearly_spend(investor, leap_day, 1), 0)
+        self.assertEqual(check_balances(), [])
+
+    def test_aging_report(self):
+        """
+        Ensure aging buckets what is left to pay on sent cashcalls by days past due, per investor and in total
+        with a query each, agreeing with overdue_on, and snapshots keep its history.
+        """
+        today = date.today()
+        for n in range(3):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True)
+            for sent_days_ago in (10, 62, 70, 100, 130, 200):
+                cashcall = CashCall.objects.create(investor=investor)
+                for amount, fulfilled in ((100 * (n + 1), False), (sent_days_ago, n == 1)):
+                    Bill.objects.create(frequency="O1", bill_type="OTHER", amount=amount, investor=investor, cashcall=cashcall, fulfilled=fulfilled)
+                CashCall.objects.filter(pk=cashcall.pk).mark_sent(today - timedelta(days=sent_days_ago))
+        CashCall.objects.create(investor=investor) # unsent cashcalls are not aged
+        Bill.objects.create(frequency="O1", bill_type="OTHER", amount=500, investor=investor, cashcall=CashCall.objects.last())
+        paid = CashCall.objects.filter(investor=investor, sent=True).first()
+        paid.bill_set.update(fulfilled=True)
+
+        def expected(day):
+            buckets = dict.fromkeys(["current", "days_0_30", "days_31_60", "days_61_90", "days_over_90"], 0)
+            for cashcall in CashCall.objects.filter(sent=True):
+                left, days_past = cashcall.total_amount - cashcall.amount_paid, (day - cashcall.due_date).days
+                if not left:
+                    continue
+                self.assertEqual(cashcall.overdue_on(day), days_past > 0)
+                name = "current" if days_past < 0 else "days_over_90" if days_past > 90 else next(name for name, limit in (("days_0_30", 30), ("days_31_60", 60), ("days_61_90", 90)) if days_past <= limit)
+                buckets[name] += left
+            return {**buckets, "total": sum(buckets.values())}
+
+        with self.assertNumQueries(2):
+            report, total = aging(), aging_total()
+        self.assertEqual(total, expected(today))
+        self.assertEqual(total["total"], sum(row["total"] for row in report))
+        self.assertEqual([row["investor_id"] for row in report], [1, 2, 3])
+        self.assertEqual(report[1]["total"], dcm(6 * 200))
+        self.assertEqual(report[2]["days_0_30"], dcm(300 + 62 + 300 + 70))
+        self.assertEqual(aging_total(today + timedelta(days=40)), expected(today + timedelta(days=40)))
+
+        response = self.client.get("/invoice/reports/aging", {"investor_id": 2, "as_of": (today - timedelta(days=5)).isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data["total"], {name: str(amount) for name, amount in data["investors"][0].items() if name != "investor_id"})
+        self.assertEqual([row["investor_id"] for row in data["investors"]], [2])
+        self.assertEqual(data["total"]["current"], "400.00")
+        self.assertEqual(self.client.get("/invoice/reports/aging", {"as_of": "today"}).status_code, status.HTTP_400_BAD_REQUEST)
+        for params in ({"page_size": 0}, {"page_size": -1}, {"page_size": "ten"}, {"page_size": 10**6}, {"after": "x"}, {"after": -2}):
+            self.assertEqual(self.client.get("/invoice/reports/aging", params).status_code, status.HTTP_400_BAD_REQUEST, params)
+        data = self.client.get("/invoice/reports/aging", {"page_size": 2}).json()
+        self.assertEqual([row["investor_id"] for row in data["investors"]], [1, 2])
+        self.assertEqual([row["investor_id"] for row in self.client.get(data["next"]).json()["investors"]], [3])
+
+        out = StringIO()
+        call_command("aging_report", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "investor_id,current,days_0_30,days_31_60,days_61_90,days_over_90,total")
+        self.assertEqual(lines[-1], "total," + ",".join(str(amount) for amount in expected(today).values()))
+        call_command("aging_report", "--snapshot", "--as-of", (today - timedelta(days=1)).isoformat(), stdout=out)
+        call_command("aging_report", "--snapshot", stdout=out)
+        call_command("aging_report", "--snapshot", stdout=out) # taken again, replacing the first
+        self.assertEqual(AgingSnapshot.objects.count(), 8) # a row per investor and the total, each day
+        rows = self.client.get("/invoice/reports/aging", {"history": 1, "date_from": (today - timedelta(days=7)).isoformat()}).json()["history"]
+        self.assertEqual([row["day"] for row in rows], [(today - timedelta(days=1)).isoformat(), today.isoformat()])
+        self.assertEqual(rows[1]["total"], str(total["total"]))
+        self.assertEqual(history(today, today, investors=Investor.objects.filter(pk=2))[0]["total"], dcm(6 * 200))
+
+    def test_bulk_onboarding(self):
+        """
+        Ensure investors and investments created in bulk, from the endpoints or a CSV file, get the bills, waivers and cashcalls
+        creating them one at a time gives, with a number of queries that does not grow with the rows.
+        """
+        existing = Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        Bill.objects.create(frequency="O1", bill_type="OTHER", amount=50, investor=existing, cashcall=get_cashcall(existing, True), validated=True)
+        investors = [{"name": f"Investor {n}", "email": f"investor{n}@gmail.com", "active_member": n % 3 > 0, "join_date": f"2020-0{n % 9 + 1}-15"} for n in range(12)]
+        investments = lambda ids: [
+            {"name": f"Startup {n}", "fee_percent": f"{10 + n % 5}.50", "total_amount": f"{(n + 1) * 7_000}.00", "total_instalments": 3 + n % 4,
+             "date_created": f"{1905 + 40 * (n % 3)}-0{n % 9 + 1}-1{n % 10}", "investor": ids[n % len(ids)]}
+            for n in range(30)
+        ]
+
+        def state():
+            cashcalls = defaultdict(list)
+            for email, cashcall, *bill in Bill.objects.values_list("investor__email", "cashcall", "bill_type", "amount", "investment__name", "date", "validated", "ignore", "fulfilled"):
+                cashcalls[cashcall].append((email, *bill))
+            return (
+                sorted(sorted(bills) for bills in cashcalls.values()),
+                sorted(CashCall.objects.values_list("investor__email", "sent", "sent_date", "due_date", "billed_total", "paid_total", "bill_count", "validated_count")),
+                sorted(Investment.objects.values_list("name", "investor__email", "amount_waived", "billed_total", "paid_total", "last_instalment_no")),
+                sorted(Investor.objects.values_list("email", "name", "active_member", "join_date")),
+            )
+
+        sid = transaction.savepoint()
+        for row in investors:
+            self.assertEqual(self.client.post("/invoice/investor/", row).status_code, status.HTTP_201_CREATED)
+        ids = [existing.pk, *Investor.objects.exclude(pk=existing.pk).order_by("id").values_list("pk", flat=True)]
+        for row in investments(ids):
+            self.assertEqual(self.client.post("/invoice/investment/", row).status_code, status.HTTP_201_CREATED)
+        expected = state()
+        transaction.savepoint_rollback(sid)
+
+        response = self.client.post("/invoice/investor/bulk/", investors, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()["created"], 12)
+        ids = [existing.pk, *response.json()["ids"]]
+        with self.assertNumQueries(13): # in one batch
+            response = self.client.post("/invoice/investment/bulk/", investments(ids), content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(state(), expected)
+        self.assertEqual(check_balances(), [])
+
+        response = self.client.post("/invoice/investor/bulk/", [{**investors[0], "email": "new@gmail.com"}, investors[1], investors[1]], content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.json()["email"]), 1)
+        response = self.client.post("/invoice/investment/bulk/", [{**investments(ids)[0], "investor": 999}, {"name": "Borland"}], content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("fee_percent", response.json()[1])
+        for batch_size in ("0", "-5", "ten"):
+            response = self.client.post(f"/invoice/investor/bulk/?batch_size={batch_size}", [{**investors[0], "email": "new@gmail.com"}], content_type="application/json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, batch_size)
+            self.assertIn("batch_size", response.json())
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "investments.csv"
+            path.write_text("name,fee_percent,total_amount,total_instalments,date_created,investor\nBorland,20,12000,4,2019-05-01,2\nZilog,15,8000,3,,3\n")
+            out = StringIO()
+            call_command("onboard", "investment", str(path), "--batch-size", "1", stdout=out)
+            self.assertEqual(out.getvalue().strip(), "Created 2 investments")
+            self.assertEqual(Investment.objects.get(name="Zilog").date_created, date.today())
+            self.assertEqual(Bill.objects.get(investment__name="Borland").amount, dcm(1610.96))
+            path.write_text("name,fee_percent,total_amount,total_instalments,investor\nBorland,20,12000,4,999\n")
+            with self.assertRaisesMessage(CommandError, 'Invalid pk "999"'):
+                call_command("onboard", "investment", str(path))
+            with self.assertRaisesMessage(CommandError, "--batch-size should be at least 1"):
+                call_command("onboard", "investment", str(path), "--batch-size", "0")
+        self.assertEqual(check_balances(), [])
+
+
+class WorkerTest(TransactionTestCase):
+    """
+    Tests running work in other processes, which only see what is committed.
+    """
+
+    def test_generate_bills_workers(self):
+        """
+        Ensure generate_bills reports and issues the same bills over a pool of worker processes as in a single process.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        rnd = random.Random(13)
+        for n in range(6):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=n != 2, join_date=one_year_back)
+            for _ in range(rnd.randint(0, 2)):
+                Investment.objects.create(name="Borland", fee_percent=Decimal(rnd.randint(5, 30)), total_amount=rnd.randint(1, 10**6), total_instalments=rnd.randint(1, 6), date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+
+        def generate(workers, dry_run):
+            out = StringIO()
+            call_command("generate_bills", workers=workers, dry_run=dry_run, stdout=out)
+            return sorted(line.replace("[DRY RUN!!] ", "") for line in out.getvalue().splitlines())
+
+        single = generate(1, dry_run=True)
+        self.assertEqual(len(single), 6 + Investment.objects.count())
+        self.assertEqual(generate(2, dry_run=True), single)
+        self.assertEqual(generate(2, dry_run=False), single)
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), len(single))
+        self.assertEqual(generate(1, dry_run=True), ["No bills due, no additional cashcalls generated"])
+        self.assertEqual(check_balances(), [])
+        with self.assertRaisesMessage(CommandError, "--workers should be at least 1"):
+            call_command("generate_bills", workers=0)
+
+    def test_failed_run_resumes(self):
+        """
+        Ensure batches a run committed before failing partway stay committed, with the run's progress, whatever
+        the database's locking features, and a rerun issues only the bills still due.
+        """
+        one_year_back = date.today().replace(year=date.today().year - 1)
+        for n in range(3):
+            investor = Investor.objects.create(name=f"Harry Guile {n}", email=f"hguile{n}@gmail.com", active_member=True, join_date=one_year_back)
+            Investment.objects.create(name="Borland", fee_percent=Decimal('20'), total_amount=12_000, total_instalments=7, date_created=one_year_back, investor=investor)
+            Bill.objects.filter(investor=investor).update(date=one_year_back)
+
+        # As on PostgreSQL or MySQL, where the batches used to be savepoints of a transaction holding row locks
+        with mock.patch.object(connection.features, "has_select_for_update", True):
+            with mock.patch("invoice.billing.calc_amount_due_investment", side_effect=RuntimeError("pricing down")):
+                with self.assertRaises(RuntimeError):
+                    generate_bills(batch_size=2)
+        failed = BillingRun.objects.get()
+        self.assertEqual((failed.status, failed.batches, failed.bills_issued), ("failed", 1, 2))
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 2)
+        self.assertEqual(InvestorLock.objects.count(), 0)
+
+        self.assertEqual(len(generate_bills(batch_size=2)), 4)
+        run = BillingRun.objects.latest("id")
+        self.assertEqual((run.status, run.batches, run.bills_issued), ("done", 2, 4))
+        self.assertEqual(Bill.objects.filter(date=date.today()).count(), 6)
+        self.assertEqual(check_balances(), [])
+
+    def test_heartbeat_outlives_errors(self):
+        """
+        Ensure a lease is renewed again after a renewal fails, and an attempt stops at its next query once the lease is lost.
+        """
+        Investor.objects.create(name="Harry Guile", email="hguile@gmail.com", active_member=True)
+        job = enqueue("send", {}, investor_id=1)
+        job = claim("worker")
+        renewals, renewed = [], threading.Event()
+
+        def flaky(job):
+            renewals.append(job)
+            if len(renewals) == 1:
+                raise OperationalError("database gone")
+            if len(renewals) == 3:
+                renewed.set()
+            return attempt(job)
+        with mock.patch("invoice.jobs.attempt", flaky):
+            with self.assertLogs("invoice.jobs", "ERROR"):
+                with heartbeat(job, interval=timedelta(milliseconds=10)):
+                    self.assertTrue(renewed.wait(5))
+                    Investor.objects.count()
+            self.assertGreater(BillingJob.objects.get(pk=job.pk).heartbeat, job.heartbeat)
+
+            # Reclaimed meanwhile
+            BillingJob.objects.filter(pk=job.pk).update(status="queued", worker="")
+            with self.assertRaises(LeaseLost):
+                with heartbeat(job, interval=timedelta(milliseconds=10)):
+                    for _ in range(500):
+                        Investor.objects.count()
+                        time.sleep(0.01)
+            self.assertEqual(Investor.objects.count(), 1)
+
+        job = claim("worker")
+        with mock.patch("invoice.jobs.run_action", side_effect=LeaseLost):
+            run_job(job)
+        self.assertEqual(BillingJob.objects.get(pk=job.pk).status, "running") # left for reclaim()
@@ -13,4 +13,10 @@ urlpatterns = [
     path("generate", views.generate, name="generate"),
     path("validate", views.validate, name="validate"),
     path("send", views.send, name="send"),
+    path("reconcile", views.reconcile, name="reconcile"),
+    path("jobs/<int:job_id>", views.job, name="job"),
+    path("_metrics", views.metrics, name="metrics"),
+    path("forecast", views.forecast, name="forecast"),
+    path("reports/aging", views.aging_report, name="aging_report"),
+    path("export/<str:table>", views.export, name="export"),
 ]
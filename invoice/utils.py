@@ -1,7 +1,12 @@
 import calendar
+from collections import defaultdict
 from decimal import Decimal
 from datetime import date, timedelta
-from .models import CashCall, Investment, Investor, Bill
+from django.db.models import Max, Q
+from .cashcalls import assign_cashcalls
+from .dates import shift_years
+from .fees import INVESTMENT_DISCOUNTS, MEMBERSHIP_FEES
+from .models import CashCall, Investment, Investor, MonthlySpend, Bill
 
 dcm = lambda x: Decimal(str(x))
 days_in_year = lambda year: 365 + calendar.isleap(year)
@@ -10,77 +15,155 @@ def get_cashcall(investor: Investor, validated: bool):
     """
     Returns the first cashcall for supplied investor that is/is not validated.
     Creates and saves a cashcall if none exists. Helps in grouping bills to appropriate cashcalls.
+    Batches of bills are grouped with assign_cashcalls() instead.
     """
-    not_sent = CashCall.objects.filter(investor=investor, sent=False).all() # Take cashcalls for investor and not yet sent
-    not_sent = [cashcall for cashcall in not_sent if cashcall.validated==validated or cashcall.bill_count==0] # match validity
-    if not_sent:
-        return sorted(not_sent, key=lambda x: x.bill_count, reverse=True)[0] # Prioritize non-empty cashcalls to append bill to
+    open_cashcall = CashCall.objects.filter(investor=investor).joinable(validated).order_by("-bill_count", "id").first()
+    if open_cashcall:
+        return open_cashcall # Prioritize non-empty cashcalls to append bill to
     new_cashcall = CashCall(investor=investor, sent=False) # No existing matching cashcall, so create one
     new_cashcall.save()
     return new_cashcall
 
 
-def calc_amount_due_investment(investment: Investment, instalment_no: int):
+def calc_amount_due_investment(investment: Investment, instalment_no: int, amount_not_billed=None):
     """
     Get the amount due for an investment given the instalment no. (year)
+    Pass amount_not_billed when already known to spare the query for it.
     """
-    year_rates = {
-                date(2050, 4, 1): {1:dcm(0), 2:dcm(1), 3:dcm(2), "default":dcm(5)},
-                date(2019, 4, 1): {1:dcm(0), 2:dcm(0), 3:dcm(0.2), 4:dcm(0.5), "default":dcm(1)},
-                date(1950, 1, 1): {1:dcm(0), 2:dcm(0), 3:dcm(0), "default":dcm(0)},
-                date(1900, 1, 1): {1:dcm(0.5), 2:dcm(1), 3:dcm(5), "default":dcm(10)},
-            } # dates are lower limits, and are the dates rates were changed. Sorted newest to oldest.
-    for date_obj, yearly_discount in year_rates.items():
-        if investment.date_created >= date_obj:
-            discount = yearly_discount.get(instalment_no, yearly_discount.get("default"))
-            break
+    if amount_not_billed is None:
+        amount_not_billed = investment.amount_not_billed
+    discount = INVESTMENT_DISCOUNTS.discount(investment.date_created, instalment_no)
     if instalment_no == 1:
         end_of_year = date(investment.date_created.year, 12, 31)
         num_of_days = dcm((end_of_year - investment.date_created).days + 1)
         days_in_year = dcm((end_of_year - date(investment.date_created.year, 1, 1)).days + 1)
         amount = (num_of_days / days_in_year) * (investment.fee_percent - discount) / 100 * investment.total_amount
-        to_pay = min(amount, investment.amount_not_billed)
+        to_pay = min(amount, amount_not_billed)
         to_waive = (num_of_days / days_in_year) * discount / 100 * investment.total_amount
-        to_waive = min(to_waive, investment.amount_not_billed - to_pay)
+        to_waive = min(to_waive, amount_not_billed - to_pay)
         return to_pay, to_waive
     amount = (investment.fee_percent - discount) / 100 * investment.total_amount
-    to_pay = min(amount, investment.amount_not_billed)
+    to_pay = min(amount, amount_not_billed)
     to_waive = discount / 100 * investment.total_amount
-    to_waive = min(to_waive, investment.amount_not_billed - to_pay)
+    to_waive = min(to_waive, amount_not_billed - to_pay)
     return to_pay, to_waive
 
 
+def spend_rows(investors: dict, start_date: date, years_back: int):
+    """
+    (investor id, amount) rows adding up to what the investors (a filter on investor) spent from {start_year-years_back} to {start_year},
+    in a single query.
+    Months wholly within the period are read from MonthlySpend, at most 12 rows per investor and year.
+    The fulfilled bills of the two months the period starts and ends in are read from the bill table.
+    """
+    period_start = shift_years(start_date, -years_back)
+    first_whole_month = (period_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+    last_month = start_date.replace(day=1)
+    months = MonthlySpend.objects.filter(**investors, month__gte=first_whole_month, month__lt=last_month)
+    bills = Bill.objects.filter(**investors, fulfilled=True, date__gt=period_start, date__lte=start_date)
+    bills = bills.filter(Q(date__lt=first_whole_month) | Q(date__gte=last_month))
+    return months.values_list("investor", "fulfilled_amount").union(bills.values_list("investor", "amount"), all=True)
+
+
 def yearly_spend(investor: Investor, start_date:date, years_back: int):
     """
     Get amount spent by an investor from {start_year-years_back} to {start_year}
     """
-    period_start = start_date.replace(year=start_date.year-years_back)
-    relevant_bills = Bill.objects.filter(investor=investor, fulfilled=True, date__gt=period_start, date__lte=start_date)
-    amount_spent = sum([bill.amount for bill in relevant_bills])
-    return amount_spent
+    return sum(amount for _, amount in spend_rows({"investor": investor}, start_date, years_back))
+
+
+def yearly_spends(investors, start_date:date, years_back: int):
+    """
+    Batch variant of yearly_spend, returns {investor_id: amount spent} for a queryset of investors in a single query.
+    Investors who spent nothing are left out.
+    """
+    spent = defaultdict(Decimal)
+    for investor_id, amount in spend_rows({"investor__in": investors}, start_date, years_back):
+        spent[investor_id] += amount
+    return dict(spent)
 
 
-def calc_amount_due_membership(investor: Investor, pro_rata_days=None):
+def calc_amount_due_membership(investor: Investor, pro_rata_days=None, spent=None, as_of=None):
     """
-    Get membership amount due. Accounts for waiving if over yearly spend.
+    Get membership amount due as of a day (today by default). Accounts for waiving if over yearly spend.
     Also accounts for membership deactivation by pro-rata billing.
+    Pass the investor's spend over the past year as spent when already known to spare the query for it.
     """
-    year_rates = {
-        date(2050, 4, 1): {"membership": dcm(50_000), "membership_waive": dcm(100_000)},
-        date(2030, 6, 1): {"membership": dcm(25_000), "membership_waive": dcm(50_000)},
-        date(1900, 1, 1): {"membership": dcm(3_000), "membership_waive": dcm(50_000)},
-    } # dates are lower limits, and are the dates yearly membership bills were changed. Sorted newest to oldest.
-    for date_obj, yearly_fee in year_rates.items():
-        if date.today() >= date_obj:
-            membership_fee = yearly_fee["membership"]
-            membership_waive = yearly_fee["membership_waive"]
-            break
+    as_of = as_of or date.today()
+    yearly_fee = MEMBERSHIP_FEES.rates_on(as_of)
+    membership_fee = yearly_fee["membership"]
+    membership_waive = yearly_fee["membership_waive"]
     # Spent over fee threshold within year
-    if yearly_spend(investor=investor,start_date=date.today(), years_back=1) >= membership_waive:
+    if spent is None:
+        spent = yearly_spend(investor=investor,start_date=as_of, years_back=1)
+    if spent >= membership_waive:
         return Decimal('0')
     # Handle membership billing prorata on deactivation of account
     if pro_rata_days != None:
-        start_date = date.today() - timedelta(days=pro_rata_days)
+        start_date = as_of - timedelta(days=pro_rata_days)
         return dcm(pro_rata_days)/days_in_year(start_date.year) * membership_fee
     # Handle regular membership
     return membership_fee
+
+
+def bill_deactivations(investors: list, as_of=None):
+    """
+    Bills investors whose membership ended as of a day (today by default) their membership pro-rata
+    from their last membership bill (or joining), in a few queries however many investors.
+    """
+    if not investors:
+        return
+    today = as_of or date.today()
+    last_billed = dict(Bill.objects.filter(bill_type="MEMBERSHIP", investor__in=investors).values("investor").annotate(last=Max("date")).values_list("investor", "last"))
+    spent = yearly_spends([investor.pk for investor in investors], today, 1)
+    bills = [
+        Bill(
+            frequency = "Y1",
+            bill_type = "MEMBERSHIP",
+            amount = calc_amount_due_membership(
+                investor=investor, pro_rata_days=(today - last_billed.get(investor.pk, investor.join_date)).days, spent=spent.get(investor.pk, 0), as_of=today,
+            ),
+            investor = investor,
+            date = today,
+        )
+        for investor in investors
+    ]
+    assign_cashcalls(bills)
+    Bill.objects.bulk_create(bills)
+
+
+def bill_new_members(investors: list, as_of=None):
+    """
+    Issues investors whose membership starts as of a day (today by default), on joining or reactivating,
+    a 0 EUR membership bill in a cashcall of its own, sent and settled, billing starts a year on.
+    """
+    if not investors:
+        return
+    today = as_of or date.today()
+    cashcalls = CashCall.objects.bulk_create(
+        CashCall(sent=True, investor=investor, sent_date=today, due_date=today + timedelta(days=62)) for investor in investors
+    )
+    Bill.objects.bulk_create(
+        Bill(frequency="Y1", bill_type="MEMBERSHIP", amount=0, investor=investor, validated=True, ignore=True, fulfilled=True, cashcall=cashcall, date=today)
+        for investor, cashcall in zip(investors, cashcalls)
+    )
+
+
+def bill_reactivations(investors: list, as_of=None):
+    """
+    Reactivated members start over as new members do, see bill_new_members.
+    """
+    bill_new_members(investors, as_of)
+
+
+def first_instalments(investments: list):
+    """
+    The first instalment bills of new investments, unsaved and not yet in cashcalls (see assign_cashcalls).
+    Sets on each investment the amount its first year waives, left for the caller to save.
+    """
+    bills = []
+    for investment in investments:
+        to_pay, to_waive = calc_amount_due_investment(investment, 1)
+        investment.amount_waived = to_waive
+        bills.append(Bill(frequency="Y1", bill_type="INVESTMENT", amount=to_pay, investor=investment.investor, instalment_no=1, investment=investment))
+    return bills
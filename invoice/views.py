@@ -1,150 +1,121 @@
-from django.db.models import F
-from rest_framework import viewsets
-from datetime import date, timedelta
-from django.http import HttpResponse
+from rest_framework import serializers, viewsets
+from datetime import date
+from django.core.exceptions import BadRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from ast import literal_eval as safe_eval
 from django.shortcuts import get_object_or_404
-from .models import CashCall, Investment, Investor, Bill
-from invoice.utils import calc_amount_due_investment, calc_amount_due_membership, get_cashcall
-from invoice.serializer import BillSerializer, CashCallSerializer, InvestmentSerializer, InvestorSerializer
-
-
-class InvestorViewSet(viewsets.ModelViewSet):
+from .models import BillingJob, CashCall, Investment, Investor, Bill
+from invoice.aging import aging, aging_total, history as aging_history
+from invoice.export import EXPORTS, EXPORT_FORMATS, RENDERERS, export_rows
+from invoice.fees import from_cents
+from invoice.forecast import forecast as forecast_bills
+from invoice.cache import CachedResponseMixin
+from invoice.expand import ExpandMixin
+from invoice.fast import FastListMixin, FastPlan
+from invoice.onboarding import BulkCreateMixin, onboard_investments, onboard_investors
+from invoice.billing import BATCH_SIZE, InvestorsLocked, generate_bills, send_cashcalls, validate_cashcalls
+from invoice.jobs import enqueue, report as job_report
+from invoice.metrics import ENDPOINT_METRICS
+from invoice.pagination import IdCursorPagination
+from invoice.reconcile import UnreadableStatement, read_statement, reconcile as reconcile_payments, reconcile_report
+from invoice.filters import BillFilter, CashCallFilter, FilterSetBackend, InvestmentFilter
+from invoice.serializer import (
+    BillingRunSerializer, BillSerializer, CashCallSerializer, CashCallSummarySerializer,
+    InvestmentBulkSerializer, InvestmentSerializer, InvestorBulkSerializer, InvestorSerializer,
+)
+
+
+class InvestorViewSet(CachedResponseMixin, FastListMixin, BulkCreateMixin, viewsets.ModelViewSet):
     queryset = Investor.objects.all()
     serializer_class = InvestorSerializer
+    bulk_serializer_class = InvestorBulkSerializer
+    onboard = staticmethod(onboard_investors)
+    fast_plan = FastPlan(InvestorSerializer)
+    pagination_class = IdCursorPagination
 
-class CashCallViewSet(viewsets.ModelViewSet):
+class CashCallViewSet(CachedResponseMixin, FastListMixin, viewsets.ModelViewSet):
+    queryset = CashCall.objects.with_summary()
     serializer_class = CashCallSerializer
+    fast_plan = FastPlan(CashCallSerializer, related={"bills": ("cashcall", BillSerializer)})
+    pagination_class = IdCursorPagination
+    filter_backends = [FilterSetBackend]
+    filterset_class = CashCallFilter
 
-    def get_queryset(self):
-        queryset = CashCall.objects.all()
-        sent = self.request.GET.get("sent")
-        fulfilled = self.request.GET.get("fulfilled")
-        validated = self.request.GET.get("validated")
-        investor_id = self.request.GET.get("investor_id")
-        if investor_id:
-            investor = get_object_or_404(Investor, pk=investor_id)
-            queryset = queryset.filter(investor=investor)
-        if fulfilled:
-            queryset = [cashcall for cashcall in queryset if cashcall.fulfilled==safe_eval(fulfilled)]
-        if validated:
-            queryset = [cashcall for cashcall in queryset if cashcall.validated==safe_eval(validated)]
-        if sent:
-            queryset = queryset.filter(sent=sent)
-        return queryset
-
-class InvestmentViewSet(viewsets.ModelViewSet):
+class InvestmentViewSet(CachedResponseMixin, FastListMixin, BulkCreateMixin, viewsets.ModelViewSet):
+    queryset = Investment.objects.with_flags()
     serializer_class = InvestmentSerializer
-
-    def get_queryset(self):
-        queryset = Investment.objects.all()
-        fulfilled = self.request.GET.get("fulfilled")
-        investor_id = self.request.GET.get("investor_id")
-        if investor_id:
-            investor = get_object_or_404(Investor, pk=investor_id)
-            queryset = queryset.filter(investor=investor)
-        if fulfilled:
-            queryset = [investment for investment in queryset if investment.fulfilled==safe_eval(fulfilled)]
-        return Investment.objects.all()
-
-class BillViewSet(viewsets.ModelViewSet):
+    bulk_serializer_class = InvestmentBulkSerializer
+    onboard = staticmethod(onboard_investments)
+    fast_plan = FastPlan(InvestmentSerializer)
+    pagination_class = IdCursorPagination
+    filter_backends = [FilterSetBackend]
+    filterset_class = InvestmentFilter
+
+class BillViewSet(CachedResponseMixin, ExpandMixin, FastListMixin, viewsets.ModelViewSet):
+    queryset = Bill.objects.all()
     serializer_class = BillSerializer
-
-    def get_queryset(self):
-        queryset = Bill.objects.all()
-        sent = self.request.GET.get("sent")
-        fulfilled = self.request.GET.get("fulfilled")
-        validated = self.request.GET.get("validated")
-        investor_id = self.request.GET.get("investor_id")
-        if investor_id:
-            investor = get_object_or_404(Investor, pk=investor_id)
-            queryset = queryset.filter(investor=investor)
-        if fulfilled:
-            queryset = queryset.filter(fulfilled_one=fulfilled)
-        if validated:
-            queryset = queryset.filter(validated=validated)
-        if sent:
-            queryset = [bill for bill in queryset if bill.cashcall.sent==safe_eval(sent)]
-        return queryset
-
+    fast_plan = FastPlan(BillSerializer)
+    expandable = {
+        "investor": InvestorSerializer, "cashcall": CashCallSummarySerializer,
+        "investment": InvestmentSerializer, "billing_run": BillingRunSerializer,
+    }
+    pagination_class = IdCursorPagination
+    filter_backends = [FilterSetBackend]
+    filterset_class = BillFilter
+
+
+def billing_date(value):
+    """
+    The day an action bills or sends as of, from an as_of param (YYYY-MM-DD), today when not given.
+    """
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f"as_of must be a date (YYYY-MM-DD), not {value!r}")
+
+def int_param(params, name: str, default=None, min_value=None, max_value=None):
+    """
+    Integer query param name, default when not given, within min_value and max_value.
+    """
+    value = params.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        return serializers.IntegerField(min_value=min_value, max_value=max_value).run_validation(value)
+    except serializers.ValidationError as error:
+        raise BadRequest(f"{name}: {' '.join(error.detail)}")
+
+def queued(job):
+    return HttpResponse(f"Queued {job.action} job {job.id}, follow it at /invoice/jobs/{job.id}", status=202)
 
 def generate(self):
     investor_id = self.POST.get("investor_id")
     dry_run = safe_eval(self.POST.get("dry_run", "False"))
     all_investors = safe_eval(self.POST.get("all", "False"))
-
-    today = date.today()
     # Use this to set how far back older bills should be considered.
     # Ideally should be a bit (minimum a day) over the maximum period of any recurring bill.
     # To account for system downtime, so as not to miss time window, best to add a few months extra, we use 12 here.
     years_back = safe_eval(self.POST.get("years_back", "2"))
-    bill_date_lower_limit = today.replace(year=today.year-years_back)
+    background = safe_eval(self.POST.get("background", "False"))
+    batch_size = int_param(self.POST, "batch_size", BATCH_SIZE, min_value=1)
+    as_of = billing_date(self.POST.get("as_of"))
 
     if not (investor_id or all_investors):
         return HttpResponse("POST investor ID's whose cashcall & bills are to be generated to this endpoint. eg curl -d 'investor_id=2' -X POST http://localhost:8000/invoice/generate")
 
-    response = []
-
-    # Generate bills for membership
-    bills = Bill.objects.filter(date__gt=bill_date_lower_limit, bill_type="MEMBERSHIP", frequency="Y1").order_by("date") # oldest to newest
+    investors = None
     if investor_id:
         investor = get_object_or_404(Investor, pk=investor_id)
-        bills = bills.filter(investor=investor)
-    last_membership_bill = {bill.investor.id: bill for bill in bills}
-    for investor_id, bill in last_membership_bill.items():
-        next_bill_date = bill.date.replace(year=bill.date.year+1)
-        if next_bill_date <= today:
-            investor = Investor.objects.get(pk=investor_id)
-            active = investor.active_member
-            amount = calc_amount_due_membership(investor=investor)
-            if not dry_run:
-                membership_cashcall = get_cashcall(investor=investor, validated=not active)
-                membership_bill = Bill(
-                    frequency = "Y1",
-                    bill_type = "MEMBERSHIP",
-                    amount = amount if active else 0,
-                    validated = False if active else True,
-                    ignore = False if active else True,
-                    fulfilled = False if active else True,
-                    investor = investor,
-                    cashcall = membership_cashcall,
-                    date = next_bill_date,
-                )
-                membership_bill.save()
-            response.append(f"{'[DRY RUN!!] ' if dry_run else ''}Billed {investor.name} {round(amount, 2) if active else 0} EUR for yearly membership")
-
-    # Generate bills for investment
-    bills = Bill.objects.filter(date__gt=bill_date_lower_limit, bill_type="INVESTMENT", frequency="Y1").order_by("date") # oldest to newest
-    if investor_id:
-        investor = get_object_or_404(Investor, pk=investor_id)
-        bills = bills.filter(investor=investor)
-    bills = [bill for bill in bills if bill.investment.amount_not_billed > 0 and bill.investment.last_instalment < bill.investment.total_instalments]
-    last_investment_bill = {(bill.investor.id, bill.investment.id): bill for bill in bills}
-    for ((investor_id, investment_id), bill) in last_investment_bill.items():
-        next_bill_date = bill.date.replace(year=bill.date.year+1)
-        if next_bill_date <= today:
-            investor = Investor.objects.get(pk=investor_id)
-            active = investor.active_member
-            amount, waived = calc_amount_due_investment(investment=bill.investment, instalment_no=bill.instalment_no + 1)
-            if not dry_run:
-                investment_cashcall = get_cashcall(investor=investor, validated=not active)
-                investment_bill = Bill(
-                    frequency = "Y1",
-                    bill_type = "INVESTMENT",
-                    amount = amount if active else 0,
-                    validated = False if active else True,
-                    ignore = False if active else True,
-                    fulfilled = False if active else True,
-                    investor = investor,
-                    cashcall = investment_cashcall,
-                    date = next_bill_date,
-                    investment = bill.investment,
-                    instalment_no = bill.instalment_no + active,
-                )
-                investment_bill.save()
-                bill.investment.amount_waived = F("amount_waived") + waived
-                bill.investment.save()
-            response.append(f"{'[DRY RUN!!] ' if dry_run else ''}Billed {investor.name} {round(amount, 2) if active else 0} EUR for yearly investment")
+        investors = Investor.objects.filter(pk=investor.pk)
+    if background:
+        params = {"dry_run": dry_run, "years_back": years_back, "batch_size": batch_size, "as_of": as_of and as_of.isoformat()}
+        return queued(enqueue("generate", params, investor_id=investor.pk if investor_id else None))
+    try:
+        response = generate_bills(investors=investors, dry_run=dry_run, years_back=years_back, batch_size=batch_size, as_of=as_of)
+    except InvestorsLocked:
+        return HttpResponse("Bills are being generated for these investors by another run, try again later", status=409)
     if response:
         return HttpResponse('\n'.join(response))
     else:
@@ -154,30 +125,22 @@ def send(self):
     all_cashcalls = safe_eval(self.POST.get("all", "False"))
     cashcall_id = self.POST.get("cashcall_id")
     dry_run = safe_eval(self.POST.get("dry_run", "False"))
+    as_of = billing_date(self.POST.get("as_of"))
     if all_cashcalls:
         # send all validated cashcalls available
-        cashcalls = [cashcall for cashcall in CashCall.objects.filter(sent=False) if cashcall.validated]
-        if not cashcalls:
+        if safe_eval(self.POST.get("background", "False")):
+            return queued(enqueue("send", {"dry_run": dry_run, "as_of": as_of and as_of.isoformat()}))
+        response = send_cashcalls(CashCall.objects.all(), dry_run=dry_run, as_of=as_of)
+        if not response:
             return HttpResponse("No validated cashcalls in queue to send")
-        response = []
-        for cashcall in cashcalls:
-            if not dry_run:
-                cashcall.sent = True
-                cashcall.sent_date = date.today()
-                cashcall.due_date = date.today() + timedelta(days=62)
-                cashcall.save()
-            response.append(f"{'[DRY RUN!!] ' if dry_run else ''}Successfully sent cashcall {cashcall.id} to {cashcall.investor.name} ({cashcall.investor.email})")
         return HttpResponse('\n'.join(response))
     elif cashcall_id:
         # send a specific cash_call
-        cashcall = get_object_or_404(CashCall, pk=cashcall_id)
+        cashcall = get_object_or_404(CashCall.objects.select_related("investor"), pk=cashcall_id)
         if not cashcall.validated:
             return HttpResponse("Unable to send this cashcall, validate it first")
         if not dry_run:
-            cashcall.sent = True
-            cashcall.sent_date = date.today()
-            cashcall.due_date = date.today() + timedelta(days=62)
-            cashcall.save()
+            CashCall.objects.filter(pk=cashcall.pk).mark_sent(as_of or date.today())
         return HttpResponse(f"{'[DRY RUN!!] ' if dry_run else ''}Successfully sent cashcall {cashcall_id} to {cashcall.investor.name} ({cashcall.investor.email})")
     return HttpResponse("POST cashcall ID's to be sent to this endpoint. eg curl -d 'cashcall_id=2' -X POST http://localhost:8000/invoice/send")
 
@@ -186,16 +149,11 @@ def validate(self):
     cashcall_id = self.POST.get("cashcall_id")
     dry_run = safe_eval(self.POST.get("dry_run", "False"))
     if all_cashcalls:
-        cashcalls = [cashcall for cashcall in CashCall.objects.all() if not cashcall.validated and cashcall.bill_count]
-        if not cashcalls:
+        if safe_eval(self.POST.get("background", "False")):
+            return queued(enqueue("validate", {"dry_run": dry_run}))
+        response = validate_cashcalls(CashCall.objects.all(), dry_run=dry_run)
+        if not response:
             return HttpResponse("No non-empty unvalidated cashcalls in queue to validate")
-        response = []
-        for cashcall in cashcalls:
-            for bill in cashcall.bills:
-                if not dry_run:
-                    bill.validated = True
-                    bill.save()
-                response.append(f"{'[DRY RUN!!] ' if dry_run else ''}Cashcall {cashcall.id} successfully validated")
         return HttpResponse('\n'.join(response))
     elif cashcall_id:
         cashcall = get_object_or_404(CashCall, pk=cashcall_id)
@@ -203,9 +161,83 @@ def validate(self):
             return HttpResponse("Cashcall already validated")
         if cashcall.bill_count == 0:
             return HttpResponse("Cashcall contains no bills")
-        for bill in cashcall.bills:
-            if not dry_run:
-                bill.validated = True
-                bill.save()
+        if not dry_run:
+            CashCall.objects.filter(pk=cashcall.pk).validate_bills()
         return HttpResponse(f"{'[DRY RUN!!] ' if dry_run else ''}Cashcall successfully validated")
     return HttpResponse("POST cashcall ID's to be validated to this endpoint. eg curl -d 'cashcall_id=2' -X POST http://localhost:8000/invoice/validate")
+
+def reconcile(self):
+    statement = self.FILES.get("statement")
+    dry_run = safe_eval(self.POST.get("dry_run", "False"))
+    if statement is None:
+        return HttpResponse("POST a bank statement (CSV with reference and amount columns, or CAMT XML) to this endpoint. eg curl -F 'statement=@statement.csv' -X POST http://localhost:8000/invoice/reconcile")
+    try:
+        paid, unmatched = reconcile_payments(read_statement(statement.file, statement.name), dry_run=dry_run)
+    except UnreadableStatement as error:
+        return HttpResponse(str(error), status=400)
+    return HttpResponse('\n'.join(reconcile_report(paid, unmatched, dry_run=dry_run)))
+
+def job(self, job_id):
+    return JsonResponse(job_report(get_object_or_404(BillingJob, pk=job_id)))
+
+def metrics(self):
+    return JsonResponse(ENDPOINT_METRICS.report())
+
+def forecast(self):
+    years = safe_eval(self.GET.get("years", "5"))
+    years_back = safe_eval(self.GET.get("years_back", "2"))
+    investor_id = self.GET.get("investor_id")
+    investors = None
+    if investor_id:
+        investor = get_object_or_404(Investor, pk=investor_id)
+        investors = Investor.objects.filter(pk=investor.pk)
+    projection = forecast_bills(years=years, investors=investors, years_back=years_back, as_of=billing_date(self.GET.get("as_of")))
+    rows = [
+        {"investor_id": investor_id, "year": year, "membership": from_cents(membership), "investment": from_cents(investment), "waived": from_cents(waived)}
+        for (investor_id, year), (membership, investment, waived) in sorted(projection.items())
+    ]
+    return JsonResponse({"years": years, "forecast": rows})
+
+def aging_report(self):
+    investor_id = self.GET.get("investor_id")
+    investors = None
+    if investor_id:
+        investor = get_object_or_404(Investor, pk=investor_id)
+        investors = Investor.objects.filter(pk=investor.pk)
+    if self.GET.get("history"):
+        try:
+            date_from, date_to = (date.fromisoformat(self.GET[key]) if self.GET.get(key) else None for key in ("date_from", "date_to"))
+        except ValueError as error:
+            return HttpResponse(f"Dates should be given as YYYY-MM-DD, {error}", status=400)
+        return JsonResponse({"history": aging_history(date_from, date_to, investors=investors)})
+    as_of = billing_date(self.GET.get("as_of")) or date.today()
+    # Investors are paged by id like the list endpoints, the page after investor id ?after=
+    page_size = int_param(self.GET, "page_size", IdCursorPagination.page_size, min_value=1, max_value=IdCursorPagination.max_page_size)
+    after = int_param(self.GET, "after", min_value=0)
+    rows = aging(as_of, investors=investors, after=after, limit=page_size)
+    next_page = None
+    if len(rows) == page_size:
+        params = self.GET.copy()
+        params["after"] = rows[-1]["investor_id"]
+        next_page = self.build_absolute_uri(f"?{params.urlencode()}")
+    return JsonResponse({"as_of": as_of, "total": aging_total(as_of, investors=investors), "investors": rows, "next": next_page})
+
+def export(self, table):
+    if table not in EXPORTS:
+        raise Http404(f"No export of {table}, choose one of {', '.join(EXPORTS)}")
+    export_format = self.GET.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponse(f"Unknown format {export_format}, choose one of {', '.join(EXPORT_FORMATS)}", status=400)
+    investor_id = self.GET.get("investor_id")
+    investors = None
+    if investor_id:
+        investor = get_object_or_404(Investor, pk=investor_id)
+        investors = Investor.objects.filter(pk=investor.pk)
+    try:
+        date_from, date_to = (date.fromisoformat(self.GET[key]) if self.GET.get(key) else None for key in ("date_from", "date_to"))
+    except ValueError as error:
+        return HttpResponse(f"Dates should be given as YYYY-MM-DD, {error}", status=400)
+    rows = export_rows(table, investors=investors, date_from=date_from, date_to=date_to)
+    response = StreamingHttpResponse(RENDERERS[export_format](rows), content_type=EXPORT_FORMATS[export_format])
+    response["Content-Disposition"] = f'attachment; filename="{table}.{export_format}"'
+    return response
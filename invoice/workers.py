@@ -0,0 +1,25 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.db import connections
+
+# Imports nothing of the app (models need django.setup() first), as spawned workers import this module to set up
+
+
+def setup_worker(databases: dict):
+    """
+    Initializer of process_pool() workers: sets Django up and points each database alias at the database
+    the parent process runs on (the test database under tests). Workers open their own connections on first use.
+    """
+    django.setup()
+    for alias, name in databases.items():
+        connections[alias].settings_dict["NAME"] = name
+
+
+def process_pool(workers: int):
+    """
+    ProcessPoolExecutor of workers processes started fresh (spawned) on every platform, rather than forked where the platform defaults to it,
+    each set up by setup_worker() before running anything.
+    """
+    databases = {connection.alias: connection.settings_dict["NAME"] for connection in connections.all()}
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=setup_worker, initargs=(databases,))
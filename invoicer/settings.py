@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'invoice.metrics.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +59,15 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'invoicer.urls'
 
+# Caches list and detail responses (invoice/cache.py) only with a backend shared by every process (database, Redis,
+# memcached, file), as billing workers and commands write from other processes. Local memory leaves responses uncached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -83,6 +94,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Seconds to wait on another connection's write, billing workers write concurrently
+        'OPTIONS': {'timeout': 60},
+        # On disk rather than in memory, so worker processes the tests start (generate_bills --workers) open it too,
+        # named per process so concurrent test runs each have their own
+        'TEST': {'NAME': BASE_DIR / f'test_db_{os.getpid()}.sqlite3'},
     }
 }
 